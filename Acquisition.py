@@ -0,0 +1,146 @@
+# Acquisition.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Acquisition.py
+# Control.py
+# Leveler.py
+# Rig.py
+# Sensor.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# The GUI and the control API sample both sensors all day so the display and subscribers stay current, even when
+# nobody is leveling and the rig stands still. This page schedules that idle sampling. The Acquisition object is a
+# Leveler listener and has two modes:
+#   fast    a reading pair every `fast` seconds (READING_REFRESH), the old behaviour
+#   idle    a reading pair every `idle` seconds
+# It drops to idle once no axis has moved more than `still` minutes from where it settled, no leveling run has
+# started, finished or pulsed and wake() was not called for `idleAfter` seconds. Movement on either axis, a leveling
+# run, a pulse or wake() (GUI interaction, a control command) switches back to fast at once, and wait() returns early
+# when that happens so the next reading is not delayed by an idle period already under way.
+#
+# The wall time, process CPU time and readings spent in each mode are kept. getUsage() reports them with the CPU time
+# as a percent of the wall time, and each mode change is logged with the usage of the mode that ended.
+
+
+import logging
+import time
+
+log = logging.getLogger("autoleveler.acquisition")
+
+#seconds between reading pairs in each mode
+FAST = 0.06     #same as READING_REFRESH in run_auto_leveler.py
+IDLE = 1.0
+
+#seconds without movement or activity before sampling drops to idle
+IDLE_AFTER = 30.0
+
+#movement from the settled reading of an axis that counts as motion
+STILL = 0.005   #minutes
+
+#modes
+FAST_MODE = "fast"
+IDLE_MODE = "idle"
+
+
+class Acquisition:
+    #clock must provide time() and sleep(), cpu returns process CPU seconds
+    def __init__(self, clock=time, fast=FAST, idle=IDLE, idleAfter=IDLE_AFTER, still=STILL, cpu=time.process_time):
+        self.clock = clock
+        self.fast = fast
+        self.idle = idle
+        self.idleAfter = idleAfter
+        self.still = still
+        self.cpu = cpu
+
+        self.mode = FAST_MODE
+        self.leveling = False
+        self.lastActivity = clock.time()
+        #reading each axis settled at, motion is measured from it
+        self.settled = {"pitch": None, "roll": None}
+        #wall seconds, CPU seconds and readings of each mode, and when the current mode started
+        self.usage = {FAST_MODE: [0.0, 0.0, 0], IDLE_MODE: [0.0, 0.0, 0]}
+        self.modeStart = (clock.time(), cpu())
+
+    #Leveler listener
+    def listener(self, event, data):
+        if event == "start":
+            self.leveling = True
+            self.wake("leveling")
+        elif event == "finish":
+            self.leveling = False
+            self.wake("leveling")
+        elif event == "pulse":
+            self.wake("pulse")
+        elif event == "reading":
+            self.usage[self.mode][2] += 1
+            self.onReading(data["axis"], data["measured"])
+
+    def onReading(self, axis, value):
+        if value is None:
+            return
+        settled = self.settled[axis]
+        if settled is None or abs(value - settled) > self.still:
+            self.settled[axis] = value
+            if settled is not None:
+                self.wake("motion")
+
+    #switches to fast sampling and restarts the idle timer, reason is logged on a mode change
+    def wake(self, reason="gui"):
+        self.lastActivity = self.clock.time()
+        if self.mode != FAST_MODE:
+            self.setMode(FAST_MODE, reason)
+
+    def setMode(self, mode, reason):
+        now = self.clock.time()
+        cpu = self.cpu()
+        usage = self.usage[self.mode]
+        usage[0] += now - self.modeStart[0]
+        usage[1] += cpu - self.modeStart[1]
+        self.modeStart = (now, cpu)
+        log.info("Sampling %s (%s)", mode, reason, extra = {"fields": self.getUsage()})
+        self.mode = mode
+
+    #current mode, drops to idle when the rig has been quiet for idleAfter seconds
+    def getMode(self):
+        if (self.mode == FAST_MODE and not self.leveling
+                and self.clock.time() - self.lastActivity >= self.idleAfter):
+            self.setMode(IDLE_MODE, "quiet")
+        return self.mode
+
+    #seconds until the next reading pair
+    def period(self):
+        return self.idle if self.getMode() == IDLE_MODE else self.fast
+
+    #sleeps until the next reading pair is due, pump is called every `fast` seconds while waiting (the GUI passes
+    #its update function so clicks are seen) and the wait ends early when sampling switches to fast
+    def wait(self, pump=None):
+        end = self.clock.time() + self.period()
+        idle = self.mode == IDLE_MODE
+        while True:
+            left = end - self.clock.time()
+            if left <= 0:
+                return
+            self.clock.sleep(min(left, self.fast))
+            if pump is not None:
+                pump()
+            if idle and self.mode == FAST_MODE:
+                #woken while waiting
+                end = min(end, self.modeStart[0] + self.fast)
+
+    #{mode: {"seconds", "cpu", "percent", "readings"}} including the time spent in the current mode
+    def getUsage(self):
+        report = {}
+        for mode, (seconds, cpu, readings) in self.usage.items():
+            if mode == self.mode:
+                seconds += self.clock.time() - self.modeStart[0]
+                cpu += self.cpu() - self.modeStart[1]
+            report[mode] = {"seconds": seconds, "cpu": cpu, "readings": readings,
+                            "percent": 100 * cpu / seconds if seconds > 0 else 0.0}
+        return report
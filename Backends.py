@@ -0,0 +1,347 @@
+# Backends.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Backends.py
+# Buttons.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Simulator.py
+# hardware.json
+# settings.csv
+
+
+# Overview:
+# This page defines the hardware backends the Rig and the GUI are built on, selected from hardware.json so the same
+# code runs on a Pi, on another Linux board or on a desk without either:
+#
+# Relay outputs, "relays": {"backend": ...}. Each backend looks like the RPi.GPIO module to Relays.py
+#   rpi     RPi.GPIO, the default
+#   gpiod   the Linux GPIO character device through libgpiod (python gpiod 2.x), "chip" is the device,
+#           /dev/gpiochip0 by default, and pins are line offsets on it (the BCM numbers on a Pi)
+#   fake    FakeGPIO, keeps every output change in memory with a time.perf_counter_ns() timestamp so relay timing
+#           can be checked and benchmarked. With the simulated rig it also drives the simulator
+# "pins" optionally replaces LEFT_PIN, RIGHT_PIN, UP_PIN and DOWN_PIN (in that order). Each backend also has the
+# inputs and falling edge callbacks (add_event_detect) the E-stop and jog buttons of Buttons.py are read with.
+#
+# Buttons, "buttons": {"stop": pin, "up": pin, "down": pin, "left": pin, "right": pin, "debounce": seconds}. Each
+# button connects its pin to ground, the pins are pulled up. Buttons without a pin are not used, so there are none
+# by default (see Buttons.py).
+#
+# ADC transport, "adc": {"transport": ...}. Each transport looks like a serial.Serial object to Sensor.py
+#   serial  the RS-232 ADC on "port", /dev/ttyAMA0 by default
+#   tcp     a TCP serial bridge (ser2net or similar) at "host" and "tcpPort" (TcpADC). pyserial's socket:// URL is
+#           not used as its inWaiting() only tells whether anything is waiting, not how much
+#   sim     the simulated rig of Simulator.py, same as --sim
+#
+# Redundant sensors, "sensors": {"pitch": [sensor, ...], "roll": [sensor, ...], "batch": true}. Each sensor is
+# {"channel": "z", "weight": 1.0, "offset": 0.0, "raw": [...], "minutes": [...]} and is read besides the sensor of
+# the axis in settings.csv. "raw" and "minutes" are its calibration table, the one of the axis in settings.csv when
+# they are left out. The sensors of an axis are read in one batched query unless "batch" is false (see Sensor.py).
+#
+# A missing hardware.json, or keys missing from it, mean the defaults in DEFAULT_HARDWARE, which is the Pi the GUI
+# was written for. Only the backend that is selected is imported.
+
+
+import copy
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+
+import serial
+
+HARDWARE_FILE = "hardware.json"
+
+#Serial connection settings:
+PORT = "/dev/ttyAMA0"
+BAUDRATE = 9600
+BYTESIZE = serial.EIGHTBITS
+PARITY = serial.PARITY_NONE
+STOPBITS = serial.STOPBITS_ONE
+TIMEOUT = 1
+
+GPIO_CHIP = "/dev/gpiochip0"
+
+DEFAULT_HARDWARE = {"relays": {"backend": "rpi", "chip": GPIO_CHIP},
+                    "adc": {"transport": "serial", "port": PORT, "host": "localhost", "tcpPort": 4000},
+                    "buttons": {},
+                    "sensors": {}}
+
+RELAY_BACKENDS = ("rpi", "gpiod", "fake")
+ADC_TRANSPORTS = ("serial", "tcp", "sim")
+
+
+#returns the hardware configuration in path merged over DEFAULT_HARDWARE, the defaults if path is None or missing
+def loadHardware(path=HARDWARE_FILE):
+    hardware = copy.deepcopy(DEFAULT_HARDWARE)
+    if path is not None and os.path.exists(path):
+        with open(path) as file:
+            loaded = json.load(file)
+        for section in hardware:
+            hardware[section].update(loaded.get(section, {}))
+    if hardware["relays"]["backend"] not in RELAY_BACKENDS:
+        raise ValueError(f"unknown relay backend {hardware['relays']['backend']!r}, expected one of {RELAY_BACKENDS}")
+    if hardware["adc"]["transport"] not in ADC_TRANSPORTS:
+        raise ValueError(f"unknown ADC transport {hardware['adc']['transport']!r}, expected one of {ADC_TRANSPORTS}")
+    return hardware
+
+
+#returns the RPi.GPIO stand-in for the relays section of a hardware configuration, None for RPi.GPIO itself
+#(Relays.py imports it), sim is the simulated rig the fake backend drives if given
+#clock is the Rig's clock, fake timestamps follow it when it is not the time module (Simulator.SimClock)
+def openRelayOutput(config, sim=None, clock=time):
+    backend = config["backend"]
+    if backend == "gpiod":
+        return GpiodOutput(config.get("chip", GPIO_CHIP))
+    if backend == "fake":
+        if clock is time:
+            return FakeGPIO(forward = sim)
+        return FakeGPIO(forward = sim, timer = lambda: round(clock.time() * 1e9))
+    #rpi, the simulator stands in for it when the rig is simulated
+    return sim
+
+
+#opens the ADC transport of the adc section of a hardware configuration, sim transports are built by the Rig
+def openADC(config):
+    transport = config["transport"]
+    if transport == "tcp":
+        ADC = TcpADC(config["host"], config["tcpPort"])
+    elif transport == "serial":
+        ADC = serial.Serial(port = config["port"],
+                            baudrate = BAUDRATE,
+                            bytesize = BYTESIZE,
+                            parity = PARITY,
+                            stopbits = STOPBITS,
+                            timeout = TIMEOUT)
+    else:
+        raise ValueError(f"the {transport} ADC transport is opened by the Rig")
+    if not ADC.isOpen():
+        raise IOError("Serial Port Error")
+    return ADC
+
+
+class TcpADC:
+    #serial.Serial stand-in for an ADC behind a TCP serial bridge
+    def __init__(self, host, port, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.socket = socket.create_connection((host, port), timeout = timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b""
+
+    def isOpen(self):
+        return self.socket is not None
+
+    def write(self, data):
+        self.socket.sendall(data)
+
+    #waits up to the timeout for the first byte like serial.Serial.read()
+    def read(self, size=1):
+        while len(self.buffer) < size:
+            try:
+                data = self.socket.recv(4096)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    #bytes received and not read yet
+    def inWaiting(self):
+        self.socket.setblocking(False)
+        try:
+            while True:
+                data = self.socket.recv(4096)
+                if not data:
+                    break
+                self.buffer += data
+        except BlockingIOError:
+            pass
+        finally:
+            self.socket.settimeout(self.timeout)
+        return len(self.buffer)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class GpiodOutput:
+    #RPi.GPIO stand-in on the Linux GPIO character device, chip is the device path
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    FALLING = 32
+
+    def __init__(self, chip=GPIO_CHIP):
+        try:
+            import gpiod
+            from gpiod.line import Bias, Direction, Edge, Value
+        except ImportError:
+            raise RuntimeError("gpiod is not available, install the python gpiod 2.x bindings")
+        self.gpiod = gpiod
+        self.Bias = Bias
+        self.Direction = Direction
+        self.Edge = Edge
+        self.values = {self.LOW: Value.INACTIVE, self.HIGH: Value.ACTIVE}
+        self.chip = chip
+        #line request of each pin
+        self.requests = {}
+        #threads waiting for the edge events of input pins
+        self.watchers = {}
+
+    #line offsets are used as they are, on a Pi they are the BCM numbers
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, initial=HIGH, pull_up_down=None):
+        if direction == self.IN:
+            #inputs are requested by add_event_detect() together with their edge detection
+            return
+        if pin in self.requests:
+            self.output(pin, initial)
+            return
+        settings = self.gpiod.LineSettings(direction = self.Direction.OUTPUT, output_value = self.values[initial])
+        self.requests[pin] = self.gpiod.request_lines(self.chip, consumer = "autoleveler", config = {pin: settings})
+
+    def output(self, pin, level):
+        self.requests[pin].set_value(pin, self.values[level])
+
+    def input(self, pin):
+        return self.HIGH if self.requests[pin].get_value(pin) == self.values[self.HIGH] else self.LOW
+
+    #calls callback(pin, nanoseconds) from a watcher thread on every falling edge of a pulled up input, nanoseconds
+    #is the kernel's CLOCK_MONOTONIC timestamp of the edge (time.monotonic_ns()), bouncetime is the kernel
+    #debounce in milliseconds
+    def add_event_detect(self, pin, edge, callback, bouncetime=None):
+        settings = self.gpiod.LineSettings(direction = self.Direction.INPUT, edge_detection = self.Edge.FALLING,
+                                           bias = self.Bias.PULL_UP)
+        if bouncetime:
+            settings.debounce_period = datetime.timedelta(milliseconds = bouncetime)
+        request = self.gpiod.request_lines(self.chip, consumer = "autoleveler", config = {pin: settings})
+        self.requests[pin] = request
+        stop = threading.Event()
+
+        def watch():
+            while not stop.is_set():
+                if request.wait_edge_events(datetime.timedelta(seconds = 0.5)):
+                    for event in request.read_edge_events():
+                        callback(event.line_offset, event.timestamp_ns)
+
+        watcher = threading.Thread(target = watch, name = f"gpio{pin}", daemon = True)
+        self.watchers[pin] = (watcher, stop)
+        watcher.start()
+
+    def remove_event_detect(self, pin):
+        watcher, stop = self.watchers.pop(pin)
+        stop.set()
+        watcher.join()
+        self.requests.pop(pin).release()
+
+    #releases the lines, the kernel returns them to their default state
+    def cleanup(self):
+        for pin in list(self.watchers):
+            self.remove_event_detect(pin)
+        for request in self.requests.values():
+            request.release()
+        self.requests = {}
+
+
+class FakeGPIO:
+    #RPi.GPIO stand-in that records every output change as (nanoseconds, pin, level)
+    #forward is another stand-in (a Simulator.SimRig) that is driven as well, timer returns nanoseconds
+    #inputs are pulled up, press() and unpress() change them like a button to ground would
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    FALLING = 32
+
+    def __init__(self, forward=None, timer=time.perf_counter_ns):
+        self.forward = forward
+        self.timer = timer
+        self.events = []
+        self.levels = {}
+        self.inputs = {}
+        #falling edge callback of each input
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        if self.forward is not None:
+            self.forward.setmode(mode)
+
+    def setup(self, pin, direction, initial=HIGH, pull_up_down=None):
+        if direction == self.IN:
+            self.inputs[pin] = self.HIGH
+            return
+        self.levels[pin] = initial
+        if self.forward is not None:
+            self.forward.setup(pin, direction, initial = initial)
+
+    def output(self, pin, level):
+        self.events.append((self.timer(), pin, level))
+        self.levels[pin] = level
+        if self.forward is not None:
+            self.forward.output(pin, level)
+
+    def input(self, pin):
+        return self.inputs[pin]
+
+    #callback(pin) is called by press() on the thread that presses, like the callback thread of RPi.GPIO
+    def add_event_detect(self, pin, edge, callback, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    #pulls input pin low and calls its callback
+    def press(self, pin):
+        falling = self.inputs[pin] == self.HIGH
+        self.inputs[pin] = self.LOW
+        if falling and pin in self.callbacks:
+            self.callbacks[pin](pin)
+
+    def unpress(self, pin):
+        self.inputs[pin] = self.HIGH
+
+    def cleanup(self):
+        for pin in self.levels:
+            self.output(pin, self.HIGH)
+        self.callbacks = {}
+        if self.forward is not None:
+            self.forward.cleanup()
+
+    #relay pulses as (pin, on nanoseconds, off nanoseconds), the relay module is active low
+    #pin limits the list to one pin, pulses still on are left out
+    def pulses(self, pin=None):
+        pulses = []
+        onAt = {}
+        for t, eventPin, level in self.events:
+            if pin is not None and eventPin != pin:
+                continue
+            if level == self.LOW and eventPin not in onAt:
+                onAt[eventPin] = t
+            elif level == self.HIGH and eventPin in onAt:
+                pulses.append((eventPin, onAt.pop(eventPin), t))
+        return pulses
+
+    #relay on times in seconds
+    def durations(self, pin=None):
+        return [(off - on) / 1e9 for pulsePin, on, off in self.pulses(pin)]
+
+    def clear(self):
+        self.events = []
@@ -0,0 +1,115 @@
+# Backlash.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Backlash.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# SysId.py
+# settings.csv
+
+
+# Overview:
+# When adapt() reverses direction on an axis the first part of the pulse only takes up mechanical slack, so the pulse
+# moves the rig less than the same pulse in the same direction as before. This page learns that take-up time for each
+# relay direction while leveling, and adapt() adds it to every pulse that reverses the last direction of its axis.
+#
+# For each direction the movement of pulses that did not reverse is fitted to a line in the relay on time,
+#   movement = rate * duration + offset
+# (offset is rate * (coast - deadTime), see SysId.py) by least squares over running sums that forget old pulses by
+# FORGET per pulse. A reversing pulse of duration d that moved the rig m minutes then took up
+#   d - (m - offset) / rate
+# seconds of slack, and the take-up time of the direction moves LEARNING_RATE of the way to that value. It starts at
+# the backlash of a SysId.py model when the Rig has one and at 0 otherwise.
+
+
+#weight kept by old pulses for each new pulse in the line fit
+FORGET = 0.98
+
+#fraction of the way each reversal moves the take-up time
+LEARNING_RATE = 0.5
+
+#take-up times are kept between 0 and
+MAX_TAKE_UP = 1.0   #seconds
+
+#pulses in the same direction needed before reversals are learned from
+MIN_PULSES = 3
+
+#sign of the reading change for each direction, same as adapt()
+DIRECTION_SIGNS = {"left": 1, "right": -1, "up": -1, "down": 1}
+
+
+class DirectionFit:
+    #running least squares fit of movement against relay on time for one direction
+    def __init__(self, takeUp=0.0):
+        self.takeUp = takeUp
+        self.count = 0
+        self.n = 0.0
+        self.sumD = 0.0
+        self.sumM = 0.0
+        self.sumDD = 0.0
+        self.sumDM = 0.0
+
+    def addPulse(self, duration, movement):
+        for name in ("n", "sumD", "sumM", "sumDD", "sumDM"):
+            setattr(self, name, getattr(self, name) * FORGET)
+        self.count += 1
+        self.n += 1
+        self.sumD += duration
+        self.sumM += movement
+        self.sumDD += duration * duration
+        self.sumDM += duration * movement
+
+    #returns (rate, offset), offset is 0 while every pulse had the same duration, None before MIN_PULSES pulses
+    def line(self):
+        if self.count < MIN_PULSES or self.sumDD <= 0:
+            return None
+        spread = self.n * self.sumDD - self.sumD ** 2
+        if spread > 1e-9 * self.n * self.sumDD:
+            rate = (self.n * self.sumDM - self.sumD * self.sumM) / spread
+            offset = (self.sumM - rate * self.sumD) / self.n
+        else:
+            rate = self.sumDM / self.sumDD
+            offset = 0.0
+        return (rate, offset) if rate > 0 else None
+
+    def addReversal(self, duration, movement):
+        line = self.line()
+        if line is None:
+            return
+        rate, offset = line
+        takeUp = duration - (movement - offset) / rate
+        self.takeUp += LEARNING_RATE * (min(max(takeUp, 0.0), MAX_TAKE_UP) - self.takeUp)
+
+
+class BacklashLearner:
+    #model is a SysId.py parameter dictionary, its backlash is the starting take-up time of each direction
+    def __init__(self, model=None):
+        self.directions = {}
+        for direction in DIRECTION_SIGNS:
+            backlash = 0.0
+            if model is not None and direction in model["directions"]:
+                backlash = model["directions"][direction]["backlash"]
+            self.directions[direction] = DirectionFit(min(max(backlash, 0.0), MAX_TAKE_UP))
+
+    #seconds added to a pulse in direction that reverses the last direction of its axis
+    def takeUp(self, direction):
+        return self.directions[direction].takeUp
+
+    #learns from a pulse of duration seconds that moved the rig movement minutes in its own direction
+    def observe(self, direction, duration, reversedPulse, movement):
+        if reversedPulse:
+            self.directions[direction].addReversal(duration, movement)
+        else:
+            self.directions[direction].addPulse(duration, movement)
+
+    #take-up time of every direction
+    def getTakeUp(self):
+        return {direction: fit.takeUp for direction, fit in self.directions.items()}
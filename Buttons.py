@@ -0,0 +1,293 @@
+# Buttons.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Backends.py
+# Buttons.py
+# Leveler.py
+# Relays.py
+# Rig.py
+# settings.csv
+
+
+# Overview:
+# Pause and the arrow buttons used to exist only on the screen. The Pause button only sets a flag that autoLevel()
+# looks at between pulses, so a relay stays on until the pulse under way ends (up to xLPulse), and the GUI only sees
+# the click when the main loop next pumps Tk. This page reads physical E-stop and jog buttons on spare GPIO pins
+# (the "buttons" section of hardware.json, see Backends.py) with falling edge callbacks, which run on the interrupt
+# thread of the GPIO backend whatever the GUI or the leveling loop are doing:
+#
+#   stop    Relays.stop() pauses and turns every relay off at once, cutting a pulse or a continuous drive short,
+#           and no relay turns on again until the pause is removed (Pause button, resume command)
+#   up, down, left, right
+#           one xSPulse jog like the arrow buttons, ignored while leveling or paused
+#
+# Every edge within `debounce` seconds of the last one on the same pin is contact bounce and ignored. A stop acts on
+# the first edge; a jog waits out the debounce and only moves if the button is still held, so the bounce of a
+# released button never jogs. Jogs are timed with threading.Timer so the interrupt thread is never blocked and a stop
+# is seen during a jog.
+#
+# The latency from the edge to the relays being off is measured for every stop, from the kernel's edge timestamp
+# with gpiod and from the start of the callback otherwise, and getLatency() reports it.
+#
+# Usage:
+#   python -m autoleveler buttons --presses 40      (benchmark on fake relays, polled pause against the E-stop)
+
+
+import collections
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger("autoleveler.buttons")
+
+#seconds an edge is ignored after the last one on the same pin
+DEBOUNCE = 0.05
+
+#stop latencies kept for getLatency()
+LATENCY_SAMPLES = 1000
+
+#jog buttons, named after the relay direction each one moves, and all buttons
+JOGS = ("up", "down", "left", "right")
+BUTTONS = ("stop",) + JOGS
+
+#benchmark pulse lengths and the gap between pulses, seconds
+BENCH_PULSES = (0.05, 0.2, 0.5)
+BENCH_GAP = 0.02
+
+#stop modes of the benchmark
+POLLED = "polled"
+INTERRUPT = "interrupt"
+
+
+class Buttons:
+    #config is the buttons section of a hardware configuration, gpio is the RPi.GPIO stand-in of relays unless given
+    #settings gives the xSPulse of a jog, leveler is watched so jogs are ignored while it levels
+    #cut False only pauses like the Pause button, used to compare with the old behaviour
+    def __init__(self, relays, config, settings=None, leveler=None, gpio=None, cut=True):
+        self.relays = relays
+        self.settings = settings
+        self.leveler = leveler
+        self.GPIO = gpio or relays.GPIO
+        self.cut = cut
+        self.debounce = config.get("debounce", DEBOUNCE)
+        if not hasattr(self.GPIO, "add_event_detect"):
+            raise RuntimeError("the relay backend has no button inputs, use rpi, gpiod or fake")
+
+        self.pins = {name: config[name] for name in BUTTONS if config.get(name) is not None}
+        if self.settings is None and any(name in self.pins for name in JOGS):
+            raise ValueError("jog buttons need the settings for their pulse")
+        self.names = {pin: name for name, pin in self.pins.items()}
+        #monotonic nanoseconds of the last edge on each pin
+        self.lastEdge = {}
+        self.leveling = False
+        #relay pin of the jog under way and its release timer
+        self.jogging = None
+        self.timers = []
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen = LATENCY_SAMPLES)
+
+        for pin in self.pins.values():
+            self.GPIO.setup(pin, self.GPIO.IN, pull_up_down = self.GPIO.PUD_UP)
+            self.GPIO.add_event_detect(pin, self.GPIO.FALLING, callback = self.onEdge)
+        if leveler is not None:
+            leveler.addListener(self.listener)
+        if self.pins:
+            log.info("Buttons ready", extra = {"fields": dict(self.pins, debounce = self.debounce)})
+
+    #Leveler listener
+    def listener(self, event, data):
+        if event == "start":
+            self.leveling = True
+        elif event == "finish":
+            self.leveling = False
+
+    #GPIO callback for a falling edge on pin, at is the monotonic nanoseconds of the edge if the backend knows it
+    def onEdge(self, pin, at=None):
+        if at is None:
+            at = time.monotonic_ns()
+        name = self.names.get(pin)
+        last = self.lastEdge.get(pin)
+        self.lastEdge[pin] = at
+        if name == "stop":
+            self.stop(at, bounce = last is not None and at - last < self.debounce * 1e9)
+        elif name is not None and (last is None or at - last >= self.debounce * 1e9):
+            self.startTimer(self.debounce, self.confirmJog, name, pin)
+
+    #turns the relays off, bounce edges turn them off again without being logged
+    def stop(self, at, bounce=False):
+        if self.cut:
+            self.relays.stop()
+            self.cancelJog()
+        else:
+            self.relays.setPause(True)
+        if bounce:
+            return
+        latency = (time.monotonic_ns() - at) / 1e3
+        self.latencies.append(latency)
+        log.warning("E-stop", extra = {"fields": {"latency": latency}})
+
+    #starts a jog if the button of pin is still held after the debounce
+    def confirmJog(self, name, pin):
+        if self.GPIO.input(pin) != self.GPIO.LOW:
+            return
+        if self.leveling or self.relays.getPause():
+            log.info("Jog ignored", extra = {"fields": {"button": name, "leveling": self.leveling}})
+            return
+        act = self.relays.getDirections()[name]
+        with self.lock:
+            if self.jogging is not None or not self.relays.energize(act):
+                return
+            self.jogging = act
+        self.startTimer(self.settings.getSetting("xSPulse"), self.endJog, act)
+
+    def endJog(self, act):
+        with self.lock:
+            if self.jogging == act:
+                self.relays.release(act)
+                self.jogging = None
+
+    #forgets the jog under way, stop() has already turned its relay off
+    def cancelJog(self):
+        with self.lock:
+            self.jogging = None
+            timers, self.timers = self.timers, []
+        for timer in timers:
+            timer.cancel()
+
+    def startTimer(self, seconds, function, *args):
+        timer = threading.Timer(seconds, function, args)
+        timer.daemon = True
+        with self.lock:
+            self.timers = [t for t in self.timers if t.is_alive()] + [timer]
+        timer.start()
+
+    #{"stops", "median", "p95", "max"} of the edge to relays off latency in microseconds
+    def getLatency(self):
+        if not self.latencies:
+            return {"stops": 0, "median": None, "p95": None, "max": None}
+        latencies = np.array(self.latencies)
+        return {"stops": len(latencies), "median": float(np.median(latencies)),
+                "p95": float(np.percentile(latencies, 95)), "max": float(latencies.max())}
+
+    def close(self):
+        for pin in self.pins.values():
+            self.GPIO.remove_event_detect(pin)
+        self.cancelJog()
+        if self.leveler is not None:
+            self.leveler.removeListener(self.listener)
+
+
+#relays on after each event of a FakeGPIO, [(nanoseconds, pins on)]
+def relayStates(gpio):
+    on = set()
+    states = []
+    for t, pin, level in gpio.events:
+        if level == gpio.LOW:
+            on.add(pin)
+        else:
+            on.discard(pin)
+        states.append((t, frozenset(on)))
+    return states
+
+
+#nanoseconds from press until the relays were off for good, None if none was on or came on after the press
+#also returns whether a pulse started after the press
+def stopLatency(states, press):
+    before = [on for t, on in states if t < press]
+    previous = before[-1] if before else frozenset()
+    wasOn = bool(previous)
+    after = [(t, on) for t, on in states if t >= press]
+    started = False
+    for t, on in after:
+        started = started or bool(on - previous)
+        previous = on
+    if not wasOn and not started:
+        return None, False
+    offAt = None if wasOn else press
+    for t, on in after:
+        if on:
+            offAt = None
+        elif offAt is None:
+            offAt = t
+    return (None if offAt is None else offAt - press), started
+
+
+#worker standing in for autoLevel(): pulses until done, checking the pause between pulses
+def pulseLoop(relays, lengths, done):
+    i = 0
+    while not done.is_set():
+        if relays.getPause():
+            time.sleep(0.001)
+            continue
+        relays.moveUp(lengths[i % len(lengths)])
+        i += 1
+        time.sleep(BENCH_GAP)
+
+
+#presses a fake E-stop at random times while a worker pulses fake relays, with the old polled pause and with
+#Relays.stop(), returns a report dictionary
+def bench(presses=40, lengths=BENCH_PULSES, seed=0):
+    from Backends import FakeGPIO
+    from Relays import Relays
+
+    rng = random.Random(seed)
+    report = {"presses": presses, "lengths": list(lengths)}
+    for mode in (POLLED, INTERRUPT):
+        gpio = FakeGPIO()
+        relays = Relays(16, 12, 20, 21, gpio = gpio)
+        buttons = Buttons(relays, {"stop": 26}, gpio = gpio, cut = mode == INTERRUPT)
+        done = threading.Event()
+        worker = threading.Thread(target = pulseLoop, args = (relays, lengths, done), daemon = True)
+        worker.start()
+        latencies = []
+        late = 0
+        try:
+            for _ in range(presses):
+                time.sleep(rng.uniform(0.05, max(lengths)))
+                press = gpio.timer()
+                gpio.press(26)
+                #long enough for the worker to finish any pulse it was in
+                time.sleep(max(lengths) + 2 * BENCH_GAP)
+                latency, started = stopLatency(relayStates(gpio), press)
+                if latency is not None:
+                    latencies.append(latency / 1e3)
+                late += started
+                gpio.unpress(26)
+                relays.setPause(False)
+        finally:
+            done.set()
+            worker.join()
+            buttons.close()
+        latencies = np.array(latencies)
+        report[mode] = {"hits": len(latencies), "late": late,
+                        "median": float(np.median(latencies)) if len(latencies) else None,
+                        "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+                        "max": float(latencies.max()) if len(latencies) else None,
+                        "callback": buttons.getLatency()}
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    def cell(value):
+        return "-" if value is None else f"{value:.1f}"
+
+    lines = [f"{report['presses']} E-stop presses during pulses of "
+             f"{', '.join(f'{length:g}' for length in report['lengths'])} s, press to relays off",
+             f"{'':10} {'hits':>5} {'late':>5} {'median us':>10} {'p95 us':>10} {'max us':>10}"]
+    for mode in (POLLED, INTERRUPT):
+        result = report[mode]
+        lines.append(f"{mode:10} {result['hits']:5} {result['late']:5} {cell(result['median']):>10} "
+                     f"{cell(result['p95']):>10} {cell(result['max']):>10}")
+    callback = report[INTERRUPT]["callback"]
+    lines += ["", "hits: presses while a relay was on, late: pulses started after the press",
+              f"callback edge to relays off: median {cell(callback['median'])} us, p95 {cell(callback['p95'])} us, "
+              f"max {cell(callback['max'])} us"]
+    return "\n".join(lines)
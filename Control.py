@@ -0,0 +1,428 @@
+# Control.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# MultiRig.py
+# Acquisition.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Sequence.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines the local control API used by test sequencers to drive and monitor the leveler.
+#
+# RigWorker owns the rig. Only its thread touches the serial port and relays: it runs queued commands one at a time
+# and keeps sampling both sensors while idle, the same as the main loop of the GUI. Every reading, pulse and status
+# change is reported through the Leveler listeners. Idle sampling slows down while the rig is quiet and every command
+# speeds it up again (see Acquisition.py), the status reply includes the sampling mode and CPU usage of each mode,
+# the on time error of the relay pulses so far (see Timing.py), the latency of E-stop button presses (see Buttons.py)
+# and the health of redundant sensors (see Sensor.py).
+#
+# ControlServer is a single asyncio event loop listening on a Unix domain socket (or a TCP port bound to localhost).
+# The protocol is one JSON object per line. Requests carry a "cmd" and an optional "id" which is copied into the reply:
+#   {"id": 1, "cmd": "status"}
+#   {"cmd": "zero", "pitch": 0, "roll": 0}         set zero in minutes, "here": true averages the current position
+#   {"cmd": "level", "wait": false}                 start leveling, "wait": true replies with the outcome
+#   {"cmd": "sequence", "steps": [{"pitch": 0.5, "roll": 0, "dwell": 60}], "slew": null, "wait": false}
+#                                                   level to and hold each setpoint in turn (see Sequence.py)
+#   {"cmd": "pause"}  {"cmd": "resume"}             same as the Pause button
+#   {"cmd": "preset", "rig": "Midload", "level": "T-Level"}
+#   {"cmd": "priority", "axis": "roll"}
+#   {"cmd": "subscribe"}                            push all engine events to this connection
+# Replies are {"id": ..., "ok": true, ...} or {"id": ..., "ok": false, "error": "..."}. Pushed events look like the
+# JSON lines written by autoleveler.py.
+#
+# One server can also drive all the stations of a MultiRig (see MultiRig.py). Requests then name the station they are
+# for, {"station": "bay1", "cmd": "level"}, status, pause and resume without one apply to every station, and pushed
+# events carry the station they came from.
+#
+# Engine events are handed to the event loop with call_soon_threadsafe() and serialized once for all subscribers.
+# Each subscriber has a bounded queue; when a client reads too slowly its oldest events are dropped, so the control
+# loop never waits on a socket.
+
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from Leveler import DONE
+from Acquisition import Acquisition
+from Sensor import SensorArray
+from Sequence import Sequence, parseSteps
+
+log = logging.getLogger("autoleveler.control")
+
+#idle sampling period, same as READING_REFRESH in run_auto_leveler.py
+READING_REFRESH = 0.06  #seconds
+
+#events kept for each subscriber before the oldest are dropped
+SUBSCRIBER_QUEUE = 1000
+
+SOCKET_PATH = "/tmp/autoleveler.sock"
+
+#seconds between sampling attempts after the rig failed to read
+ERROR_RETRY = 5.0
+
+#worker states
+IDLE = "idle"
+LEVELING = "leveling"
+ERROR = "error"
+STOPPED = "stopped"
+
+
+class RigWorker:
+    #initializes worker for a Rig object from Rig.py
+    #acquisition is an Acquisition.Acquisition scheduling idle sampling, one sampling every refresh seconds until the
+    #rig is quiet is used if it is None
+    #name names the thread, MultiRig.py runs a worker for each station
+    def __init__(self, rig, refresh=READING_REFRESH, acquisition=None, name="rig-worker"):
+        self.rig = rig
+        self.refresh = refresh
+        self.acquisition = acquisition if acquisition is not None else Acquisition(fast = refresh)
+        rig.leveler.addListener(self.acquisition.listener)
+        self.commands = queue.Queue()
+        self.state = IDLE
+        self.lastOutcome = None
+        #set by submit() for a leveling job until it has run, so a second one is refused before the first one starts
+        self.busy = False
+        self.busyLock = threading.Lock()
+        #message of the sampling error while the state is ERROR
+        self.error = None
+        self.running = False
+        self.thread = threading.Thread(target = self.run, name = name, daemon = True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.rig.relays.setPause(True)
+        self.thread.join()
+
+    #queues function to run on the worker thread, returns a concurrent.futures.Future
+    #busy marks a leveling job, the worker is busy from now until it has run. Raises RuntimeError if busy is given
+    #while another leveling job is queued or running
+    def submit(self, function, *args, busy=False):
+        if busy:
+            with self.busyLock:
+                if self.busy:
+                    raise RuntimeError("busy leveling")
+                self.busy = True
+        future = concurrent.futures.Future()
+        self.commands.put((future, function, args, busy))
+        return future
+
+    #True while a leveling job is queued or running
+    def isBusy(self):
+        return self.busy or self.state == LEVELING
+
+    def setState(self, state):
+        self.state = state
+        self.rig.leveler.emit("state", state = state)
+
+    def run(self):
+        while self.running:
+            try:
+                timeout = ERROR_RETRY if self.state == ERROR else self.acquisition.period()
+                future, function, args, busy = self.commands.get(timeout = timeout)
+            except queue.Empty:
+                #idle, keep readings flowing to subscribers
+                self.sample()
+                continue
+
+            self.acquisition.wake("command")
+
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            finally:
+                if busy:
+                    self.busy = False
+        self.state = STOPPED
+
+    #reads both sensors, a rig that fails to read or has no signal from either sensor is put in the ERROR state and
+    #retried every ERROR_RETRY seconds instead of ending the worker
+    def sample(self):
+        leveler = self.rig.leveler
+        try:
+            pitch = leveler.getReading(self.rig.pitch)
+            roll = leveler.getReading(self.rig.roll)
+            if pitch is None and roll is None:
+                raise IOError("no signal from the sensors")
+        except Exception as e:
+            if self.state != ERROR:
+                log.error("Sampling failed", extra = {"fields": {"worker": self.thread.name, "error": str(e)}})
+                self.error = str(e)
+                self.setState(ERROR)
+            return
+        if self.state == ERROR:
+            self.error = None
+            self.setState(IDLE)
+
+    # commands, run on the worker thread - - - - - - - - - - - - - - - -
+
+    def level(self):
+        self.setState(LEVELING)
+        try:
+            self.lastOutcome = self.rig.leveler.autoLevel()
+        finally:
+            self.setState(IDLE)
+        return self.lastOutcome
+
+    #runs the setpoints of steps in turn on the rig's Leveler, see Sequence.py
+    def runSequence(self, steps, slew=None):
+        self.setState(LEVELING)
+        try:
+            self.lastOutcome = Sequence(self.rig.leveler, steps, slew = slew).run()
+        finally:
+            self.setState(IDLE)
+        return self.lastOutcome
+
+    def setZero(self, pitchZero, rollZero):
+        self.rig.setZero(pitchZero, rollZero)
+        return pitchZero, rollZero
+
+    def saveZero(self):
+        return self.rig.saveZero()
+
+    def usePreset(self, rigName, levelName):
+        self.rig.usePreset(rigName, levelName)
+
+    def setPriority(self, axis):
+        self.rig.settings.setPriority(axis)
+
+    #snapshot of rig state, safe to call from any thread
+    def getStatus(self):
+        rig = self.rig
+        rigName, levelName = rig.settings.getPresetName()
+        return {"state": self.state,
+                "error": self.error,
+                "paused": rig.relays.getPause(),
+                "rig": rigName,
+                "level": levelName,
+                "priority": rig.settings.getPriority(),
+                "pitch": rig.pitch.reading,
+                "roll": rig.roll.reading,
+                "zero": {"pitch": rig.pitch.getZero(), "roll": rig.roll.getZero()},
+                "lastOutcome": self.lastOutcome,
+                "sampling": self.acquisition.mode,
+                "usage": self.acquisition.getUsage(),
+                "pulseTiming": rig.relays.timer.getSummary(),
+                "estop": rig.buttons.getLatency() if rig.buttons is not None else None,
+                "sensors": {sensor.getName(): sensor.getHealth() for sensor in (rig.pitch, rig.roll)
+                            if isinstance(sensor, SensorArray)}}
+
+
+class Subscriber:
+    #one connection receiving pushed events
+    def __init__(self, writer, size=SUBSCRIBER_QUEUE):
+        self.writer = writer
+        self.queue = asyncio.Queue(size)
+        self.dropped = 0
+
+    #never blocks, drops oldest event if the client is behind
+    def push(self, line):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+    async def drain(self):
+        while True:
+            line = await self.queue.get()
+            self.writer.write(line)
+            await self.writer.drain()
+
+
+class ControlServer:
+    #initializes server for a RigWorker, or for the stations of a MultiRig.MultiRig
+    #path is the Unix socket path, if port is given a TCP socket on localhost is used instead
+    def __init__(self, worker, path=SOCKET_PATH, port=None):
+        if isinstance(worker, RigWorker):
+            self.multi = None
+            self.workers = {None: worker}
+        else:
+            self.multi = worker
+            self.workers = worker.workers
+        self.path = path
+        self.port = port
+        self.subscribers = set()
+        #Leveler listener of each station
+        self.listeners = {}
+        self.loop = None
+        self.server = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        for station, worker in self.workers.items():
+            self.listeners[station] = self.stationListener(station)
+            worker.rig.leveler.addListener(self.listeners[station])
+        if self.port is not None:
+            self.server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+        else:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = await asyncio.start_unix_server(self.handle, self.path)
+
+    async def close(self):
+        for station, listener in self.listeners.items():
+            self.workers[station].rig.leveler.removeListener(listener)
+        self.listeners = {}
+        self.server.close()
+        await self.server.wait_closed()
+        if self.port is None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def serveForever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    #Leveler listener of station, called on its worker thread. Events of a MultiRig station carry its name
+    def stationListener(self, station):
+        def onEvent(event, data):
+            if self.subscribers:
+                if station is not None:
+                    data = dict(data, station = station)
+                self.loop.call_soon_threadsafe(self.broadcast, event, data, time.time())
+        return onEvent
+
+    def broadcast(self, event, data, t):
+        line = {"event": event, "t": round(t, 3)}
+        line.update(data)
+        line = (json.dumps(line) + "\n").encode()
+        for subscriber in self.subscribers:
+            subscriber.push(line)
+
+    async def handle(self, reader, writer):
+        subscriber = None
+        drainTask = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    reply = await self.execute(request)
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                if isinstance(request, dict) and "id" in request:
+                    reply["id"] = request["id"]
+
+                if reply.pop("subscribe", False) and subscriber is None:
+                    subscriber = Subscriber(writer)
+                    self.subscribers.add(subscriber)
+                    drainTask = asyncio.ensure_future(subscriber.drain())
+
+                if subscriber is not None:
+                    subscriber.push((json.dumps(reply) + "\n").encode())
+                else:
+                    writer.write((json.dumps(reply) + "\n").encode())
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if subscriber is not None:
+                self.subscribers.discard(subscriber)
+                drainTask.cancel()
+            writer.close()
+
+    #runs one request, returns reply dictionary
+    async def execute(self, request):
+        cmd = request.get("cmd")
+
+        if cmd == "subscribe":
+            return {"ok": True, "subscribe": True}
+
+        if self.multi is not None and "station" not in request:
+            if cmd == "status":
+                return {"ok": True, "status": self.multi.getStatus()}
+            if cmd in ("pause", "resume"):
+                for worker in self.workers.values():
+                    worker.rig.relays.setPause(cmd == "pause")
+                return {"ok": True}
+            return {"ok": False, "error": "station is required"}
+
+        worker = self.workers.get(request.get("station"))
+        if worker is None:
+            return {"ok": False, "error": f"unknown station {request.get('station')!r}"}
+        relays = worker.rig.relays
+
+        if cmd == "status":
+            return {"ok": True, "status": worker.getStatus()}
+
+        if cmd == "pause":
+            relays.setPause(True)
+            return {"ok": True}
+
+        if cmd == "resume":
+            relays.setPause(False)
+            return {"ok": True}
+
+        if cmd in ("level", "sequence", "zero", "preset", "priority") and worker.isBusy():
+            return {"ok": False, "error": "busy leveling"}
+
+        if cmd == "level":
+            if relays.getPause():
+                return {"ok": False, "error": "paused"}
+            future = worker.submit(worker.level, busy = True)
+            if request.get("wait"):
+                outcome = await asyncio.wrap_future(future)
+                return {"ok": outcome == DONE, "outcome": outcome}
+            return {"ok": True}
+
+        if cmd == "sequence":
+            if relays.getPause():
+                return {"ok": False, "error": "paused"}
+            steps = parseSteps(request.get("steps") or [])
+            slew = None if request.get("slew") is None else float(request["slew"])
+            future = worker.submit(worker.runSequence, steps, slew, busy = True)
+            if request.get("wait"):
+                outcome = await asyncio.wrap_future(future)
+                return {"ok": outcome == DONE, "outcome": outcome}
+            return {"ok": True, "steps": len(steps)}
+
+        if cmd == "zero":
+            if request.get("here"):
+                future = worker.submit(worker.saveZero)
+            else:
+                future = worker.submit(worker.setZero, float(request["pitch"]), float(request["roll"]))
+            pitchZero, rollZero = await asyncio.wrap_future(future)
+            return {"ok": True, "pitch": pitchZero, "roll": rollZero}
+
+        if cmd == "preset":
+            await asyncio.wrap_future(worker.submit(worker.usePreset, request["rig"], request["level"]))
+            return {"ok": True}
+
+        if cmd == "priority":
+            if request.get("axis") not in ("pitch", "roll"):
+                return {"ok": False, "error": "axis must be pitch or roll"}
+            await asyncio.wrap_future(worker.submit(worker.setPriority, request["axis"]))
+            return {"ok": True}
+
+        return {"ok": False, "error": f"unknown command {cmd!r}"}
@@ -0,0 +1,182 @@
+# ControlClient.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines a small blocking client for the control API in Control.py, for use by test sequencers and for
+# checking the server against the simulated rig:
+#
+#   python -m autoleveler serve --sim --sim-tilt 0.5,-0.3 &
+#   python ControlClient.py status
+#   python ControlClient.py zero 0 0
+#   python ControlClient.py level --wait
+#   python ControlClient.py watch
+#
+# Use one client for commands and another for subscribe(); a subscribed connection receives replies mixed in with
+# pushed events.
+
+
+import argparse
+import json
+import socket
+import sys
+
+from Control import SOCKET_PATH
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlClient:
+    #connects to Unix socket path, or to TCP port on localhost if port is given
+    def __init__(self, path=SOCKET_PATH, port=None, timeout=None):
+        if port is not None:
+            self.sock = socket.create_connection(("127.0.0.1", port), timeout = timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        self.file = self.sock.makefile("rb")
+        self.nextId = 0
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, request):
+        self.sock.sendall((json.dumps(request) + "\n").encode())
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise ControlError("connection closed")
+        return json.loads(line)
+
+    #sends command and waits for its reply, raises ControlError if the server refuses it
+    def call(self, cmd, **args):
+        self.nextId += 1
+        request = {"id": self.nextId, "cmd": cmd}
+        request.update(args)
+        self.send(request)
+        while True:
+            reply = self.receive()
+            if reply.get("id") == self.nextId:
+                break
+        if not reply.pop("ok") and "outcome" not in reply:
+            raise ControlError(reply.get("error"))
+        reply.pop("id")
+        return reply
+
+    def status(self):
+        return self.call("status")["status"]
+
+    def setZero(self, pitchZero, rollZero):
+        return self.call("zero", pitch = pitchZero, roll = rollZero)
+
+    def saveZero(self):
+        return self.call("zero", here = True)
+
+    #starts leveling, returns the outcome if wait is True
+    def level(self, wait=False):
+        return self.call("level", wait = wait).get("outcome")
+
+    def pause(self):
+        self.call("pause")
+
+    def resume(self):
+        self.call("resume")
+
+    def usePreset(self, rigName, levelName):
+        self.call("preset", rig = rigName, level = levelName)
+
+    def setPriority(self, axis):
+        self.call("priority", axis = axis)
+
+    #subscribes and yields pushed events forever
+    def subscribe(self):
+        self.call("subscribe")
+        while True:
+            message = self.receive()
+            if "event" in message:
+                yield message
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = "Auto leveler control client")
+    parser.add_argument("--socket", default = SOCKET_PATH)
+    parser.add_argument("--port", type = int, help = "connect to TCP port on localhost instead of the socket")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    commands.add_parser("status")
+    zero = commands.add_parser("zero")
+    zero.add_argument("position", nargs = "*", type = float, metavar = "PITCH ROLL",
+                      help = "zero point in minutes, both or neither (average the current position)")
+    level = commands.add_parser("level")
+    level.add_argument("--wait", action = "store_true")
+    commands.add_parser("pause")
+    commands.add_parser("resume")
+    preset = commands.add_parser("preset")
+    preset.add_argument("rig")
+    preset.add_argument("level")
+    priority = commands.add_parser("priority")
+    priority.add_argument("axis", choices = ["pitch", "roll"])
+    commands.add_parser("watch")
+    args = parser.parse_args(argv)
+    if args.command == "zero" and len(args.position) not in (0, 2):
+        parser.error("zero takes both pitch and roll, or neither to average the current position")
+
+    with ControlClient(args.socket, args.port) as client:
+        try:
+            if args.command == "status":
+                result = client.status()
+            elif args.command == "zero":
+                if not args.position:
+                    result = client.saveZero()
+                else:
+                    result = client.setZero(*args.position)
+            elif args.command == "level":
+                result = {"outcome": client.level(args.wait)}
+            elif args.command == "pause":
+                result = client.pause()
+            elif args.command == "resume":
+                result = client.resume()
+            elif args.command == "preset":
+                result = client.usePreset(args.rig, args.level)
+            elif args.command == "priority":
+                result = client.setPriority(args.axis)
+            else:
+                for event in client.subscribe():
+                    print(json.dumps(event), flush = True)
+        except ControlError as e:
+            print(e, file = sys.stderr)
+            return 1
+        except KeyboardInterrupt:
+            return 0
+
+    if result is not None:
+        print(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
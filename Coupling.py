@@ -0,0 +1,240 @@
+# Coupling.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Coupling.py
+# Leveler.py
+# Optimizer.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# On some rigs the up/down relays also move roll and the left/right relays also move pitch. This page learns the 2x2
+# coupling matrix from the pulses the leveler issues and benchmarks decoupled leveling on the simulated rig.
+#
+# With errors e = (pitch - pitchZero, roll - rollZero) and actuator movements u = (pitch movement, roll movement) a
+# pulse changes the errors by C u with
+#   C = [[1,           rollToPitch],
+#        [pitchToRoll, 1          ]]
+# pitchToRoll is the roll movement per minute the pitch actuators move the rig, rollToPitch the pitch movement per
+# minute of roll movement. Both are columns of the preset in settings.csv, empty means 0 (independent axes), and the
+# Leveler levels decoupled readings inverse(C) e in the sens2 loops (see Leveler.decouple()).
+#
+# CouplingLearner is a Leveler listener. A segment starts at a pulse and collects the pulses on the same axis until
+# the other axis is read again; the change of both measured readings over the segment is one sample. Segments where a
+# pulse on the other axis came first are dropped, as are segments that moved the pulsed axis less than sens2. At the
+# end of a run each coefficient with at least MIN_SEGMENTS samples is moved LEARNING_RATE of the way to its least
+# squares fit
+#   pitchToRoll = sum(dPitch * dRoll) / sum(dPitch ** 2)
+# and saved to the preset, so the matrix follows the rig over time.
+#
+# Usage:
+#   python -m autoleveler level --rig Midload --level T-Level --learn-coupling
+#   python -m autoleveler coupling --rig Midload --level T-Level --sim-coupling 0.3,-0.2 --runs 20
+
+
+import logging
+
+import numpy as np
+
+from Leveler import DONE, TIME_OUT
+
+log = logging.getLogger("autoleveler.coupling")
+
+#fewest segments needed to update a coefficient
+MIN_SEGMENTS = 1
+
+#fraction of the way each run moves a coefficient to its fitted value
+LEARNING_RATE = 0.5
+
+#coupling large enough to make inverse(C) meaningless is not saved
+MAX_COUPLING = 0.9
+
+#coupling used by the benchmark when none is given
+SIM_COUPLING = (0.3, -0.2)
+#largest starting tilt of the benchmark runs, minutes. Larger tilts saturate the Midload sensors and the readings
+#stop following the rig
+TILT = 0.3
+
+#other axis and preset setting each pulsed axis is learned into
+LEARNED = {"pitch": ("roll", "pitchToRoll"), "roll": ("pitch", "rollToPitch")}
+
+
+class CouplingLearner:
+    #learns the coupling of the current preset of a Settings object
+    #save writes the learned coupling to settings.csv, otherwise it only changes the preset in memory
+    def __init__(self, settings, save=True):
+        self.settings = settings
+        self.save = save
+        self.reset()
+
+    def reset(self):
+        #latest measured reading of each axis
+        self.last = {"pitch": None, "roll": None}
+        #open segment: axis, before, otherBefore and after once the pulsed axis was read again
+        self.segment = None
+        #(moved, otherMoved) samples for each pulsed axis
+        self.samples = {"pitch": [], "roll": []}
+
+    def listener(self, event, data):
+        if event == "start":
+            self.reset()
+        elif event == "reading":
+            self.onReading(data["axis"], data["measured"])
+        elif event == "pulse":
+            self.onPulse(data["axis"])
+        elif event == "finish" and data["outcome"] == DONE:
+            self.learn()
+
+    def onReading(self, axis, value):
+        if value is None:
+            return
+        segment = self.segment
+        if segment is not None:
+            if axis == segment["axis"]:
+                segment["after"] = value
+            elif "after" in segment:
+                self.samples[segment["axis"]].append((segment["after"] - segment["before"],
+                                                      value - segment["otherBefore"]))
+                self.segment = None
+            else:
+                #the other axis was read before the pulsed axis settled, its movement cannot be split
+                self.segment = None
+        self.last[axis] = value
+
+    def onPulse(self, axis):
+        segment = self.segment
+        if segment is not None and segment["axis"] == axis:
+            #readings taken between pulses on the same axis are not the end of the segment
+            segment.pop("after", None)
+            return
+        other = LEARNED[axis][0]
+        self.segment = None
+        if self.last[axis] is not None and self.last[other] is not None:
+            self.segment = {"axis": axis, "before": self.last[axis], "otherBefore": self.last[other]}
+
+    #least squares coupling of each pulsed axis from this run's samples, None where there are too few
+    def fit(self):
+        minimum = self.settings.getSetting("sens2")
+        fits = {}
+        for axis, samples in self.samples.items():
+            samples = np.array(samples).reshape(-1, 2)
+            samples = samples[np.abs(samples[:, 0]) >= minimum]
+            if len(samples) < MIN_SEGMENTS:
+                fits[axis] = None
+            else:
+                fits[axis] = float(samples[:, 0] @ samples[:, 1] / (samples[:, 0] @ samples[:, 0]))
+        return fits
+
+    #moves the preset's coupling towards this run's fit and saves it
+    def learn(self):
+        values = {}
+        for axis, fit in self.fit().items():
+            name = LEARNED[axis][1]
+            current = self.settings.getSetting(name)
+            values[name] = current if fit is None else current + LEARNING_RATE * (fit - current)
+        if all(abs(value) < MAX_COUPLING for value in values.values()):
+            log.info("Coupling", extra = {"fields": values})
+            if self.save:
+                self.settings.setCoupling(values["pitchToRoll"], values["rollToPitch"])
+            else:
+                self.settings.setPresetValues(values)
+        else:
+            log.warning("Coupling not saved, fit out of range: %s", values)
+        return values
+
+
+#levels the simulated rig once from every Optimizer.scenarios() start with a coupled simulator
+#coupling is the (pitchToRoll, rollToPitch) the preset starts from, learn turns on a CouplingLearner that carries its
+#coupling from run to run, sim holds more Simulator.SimRig arguments
+#returns a list of (outcome, seconds, pulses) and the coupling at the end
+def simulate(settingsFile, rigName, levelName, runs, simCoupling, coupling=(0.0, 0.0), learn=False, sim=None,
+             timeOut=TIME_OUT):
+    from Rig import Rig
+    from Simulator import SimClock
+
+    results = []
+    for pitch, roll, seed in runs:
+        rig = Rig(settingsFile, rigName, levelName, clock = SimClock(), timeOut = timeOut,
+                  sim = dict(sim or {}, pitch = pitch, roll = roll, seed = seed, coupling = simCoupling))
+        rig.settings.setPresetValues({"pitchToRoll": coupling[0], "rollToPitch": coupling[1]})
+        rig.setZero(0.0, 0.0)
+        if learn:
+            rig.leveler.addListener(CouplingLearner(rig.settings, save = False).listener)
+
+        pulses = 0
+        finish = {}
+
+        def onEvent(event, data):
+            nonlocal pulses
+            if event == "pulse":
+                pulses += 1
+            elif event == "finish":
+                finish.update(data)
+
+        rig.leveler.addListener(onEvent)
+        rig.leveler.autoLevel()
+        rig.close()
+        coupling = (rig.settings.getSetting("pitchToRoll"), rig.settings.getSetting("rollToPitch"))
+        results.append((finish["outcome"], finish["elapsed"], pulses))
+    return results, coupling
+
+
+#summary dictionary of simulate() results
+def summarise(results, coupling):
+    seconds = np.array([elapsed for outcome, elapsed, pulses in results if outcome == DONE])
+    pulses = np.array([pulses for outcome, elapsed, pulses in results])
+    return {"runs": len(results),
+            "timeouts": sum(outcome != DONE for outcome, elapsed, pulses in results),
+            "pulses": float(pulses.mean()),
+            "median": float(np.median(seconds)) if len(seconds) else None,
+            "p95": float(np.percentile(seconds, 95)) if len(seconds) else None,
+            "coupling": [float(value) for value in coupling]}
+
+
+#compares leveling a coupled simulated rig as independent axes, while learning the coupling from zero and with the
+#simulated coupling known, returns a report dictionary
+def bench(settingsFile, rigName, levelName, simCoupling=SIM_COUPLING, runs=20, tilt=TILT, seed=0, sim=None,
+          timeOut=TIME_OUT):
+    from Optimizer import scenarios
+
+    starts = scenarios(runs, tilt, seed)
+    report = {"rig": rigName, "level": levelName, "simCoupling": list(simCoupling)}
+    report["independent"] = summarise(*simulate(settingsFile, rigName, levelName, starts, simCoupling, sim = sim,
+                                                timeOut = timeOut))
+    report["learning"] = summarise(*simulate(settingsFile, rigName, levelName, starts, simCoupling, learn = True,
+                                             sim = sim, timeOut = timeOut))
+    report["known"] = summarise(*simulate(settingsFile, rigName, levelName, starts, simCoupling,
+                                          coupling = simCoupling, sim = sim, timeOut = timeOut))
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    def cell(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    baseline = report["independent"]
+    lines = [f"{report['rig']} {report['level']}: simulated pitchToRoll {report['simCoupling'][0]:g}, "
+             f"rollToPitch {report['simCoupling'][1]:g}",
+             f"{'':12} {'runs':>5} {'timeouts':>8} {'pulses':>7} {'median s':>9} {'p95 s':>7} {'pulses':>7} "
+             f"{'median':>7}   coupling"]
+    for name in ("independent", "learning", "known"):
+        summary = report[name]
+        pulseChange = 100 * (summary["pulses"] / baseline["pulses"] - 1)
+        timeChange = None
+        if summary["median"] is not None and baseline["median"]:
+            timeChange = 100 * (summary["median"] / baseline["median"] - 1)
+        lines.append(f"{name:12} {summary['runs']:5} {summary['timeouts']:8} {summary['pulses']:7.1f} "
+                     f"{cell(summary['median']):>9} {cell(summary['p95']):>7} {pulseChange:+6.0f}% "
+                     f"{'-' if timeChange is None else f'{timeChange:+.0f}%':>7}   "
+                     f"{summary['coupling'][0]:.3f}, {summary['coupling'][1]:.3f}")
+    return "\n".join(lines)
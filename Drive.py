@@ -0,0 +1,248 @@
+# Drive.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Drive.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# SysId.py
+# settings.csv
+
+
+# Overview:
+# Far from zero adapt() used to give a burst of XL pulses, each one followed by the full xLDelay and a new reading, so
+# a large correction was many stop-start moves. With continuous drive (Rig continuous=True or --continuous) an error
+# that would get an XL pulse is corrected by ContinuousDrive.drive() instead: the relay stays energized while the axis is read
+# as fast as the sensor allows, and it is released at the point the rig is predicted to coast to HANDOFF of mDiff
+# short of zero. The sens2 and sens1 loops then finish with fine pulses as before.
+#
+# The speed of the rig is the least squares slope of the last RATE_SAMPLES readings (RateFit), so it is measured on
+# the move and dead time or backlash at the start only delay the first prediction. The coast is kept in seconds of
+# travel at the driving speed for each relay direction: after a release the axis is read until it
+# stops, the distance it moved after the relay turned off is divided by the speed, and the coast of that direction
+# moves LEARNING_RATE of the way to the result. It starts at the coast of a SysId.py model when the Rig has one.
+# No drive is longer than MAX_PULSES XL pulses, and the relay is released as soon as the rig is paused.
+#
+# Usage:
+#   python -m autoleveler level --rig Midload --level T-Level --continuous
+#   python -m autoleveler drive --rig Midload --level T-Level --runs 20
+
+
+import numpy as np
+
+from Backlash import DIRECTION_SIGNS
+from Leveler import DONE, TIME_OUT
+
+#readings the driving speed is fitted over, and the fewest that give a speed
+RATE_SAMPLES = 5
+MIN_SAMPLES = 3
+
+#part of mDiff the drive aims to stop short of zero
+HANDOFF = 0.5
+
+#longest drive in XL pulses of the preset
+MAX_PULSES = 10
+
+#default coast before one is learned, same as Simulator.COAST
+COAST = 0.05            #seconds
+
+#fraction of the way each drive moves the coast of its direction, and the largest coast kept
+LEARNING_RATE = 0.5
+MAX_COAST = 2.0         #seconds
+
+#after a release the axis is read until a reading moves less than STOPPED of a reading interval at the driving
+#speed, or for at most COAST_LIMIT seconds
+STOPPED = 0.2
+COAST_LIMIT = 3.0       #seconds
+
+#starting errors of the benchmark runs, minutes. Pitch starts positive, the Midload pitch sensor saturates at about
+#-0.38
+TILTS = (1.2, 2.5)
+
+
+class RateFit:
+    #least squares slope of the last RATE_SAMPLES readings of a moving axis
+    def __init__(self):
+        self.times = []
+        self.values = []
+
+    def add(self, t, value):
+        self.times = (self.times + [t])[-RATE_SAMPLES:]
+        self.values = (self.values + [value])[-RATE_SAMPLES:]
+
+    #minutes per second, None before MIN_SAMPLES readings
+    def rate(self):
+        if len(self.times) < MIN_SAMPLES:
+            return None
+        t = np.array(self.times) - self.times[0]
+        return float(np.polyfit(t, self.values, 1)[0])
+
+    #mean seconds between readings, None before two readings
+    def interval(self):
+        if len(self.times) < 2:
+            return None
+        return (self.times[-1] - self.times[0]) / (len(self.times) - 1)
+
+
+class ContinuousDrive:
+    #model is a SysId.py parameter dictionary, its coast is the starting coast of each direction
+    def __init__(self, model=None):
+        self.directions = {}
+        for direction in DIRECTION_SIGNS:
+            coast = COAST
+            if model is not None and direction in model["directions"]:
+                coast = model["directions"][direction]["coast"]
+            self.directions[direction] = min(max(coast, 0.0), MAX_COAST)
+
+    #seconds of travel at the driving speed the rig moves after the relay of direction is released
+    def coast(self, direction):
+        return self.directions[direction]
+
+    #learns from a drive at rate minutes per second that went on for moved minutes after the release
+    def observe(self, direction, rate, moved):
+        if rate <= 0:
+            return
+        coast = min(max(moved / rate, 0.0), MAX_COAST)
+        self.directions[direction] += LEARNING_RATE * (coast - self.directions[direction])
+
+    #coast of every direction
+    def getCoast(self):
+        return dict(self.directions)
+
+    #drives axis of leveler towards zero with the relay act of direction, sensor is the Sensor of axis
+    #returns the relay on time and the seconds spent reading the coast after the release
+    def drive(self, leveler, sensor, axis, direction, act):
+        settings = leveler.settings
+        clock = leveler.clock
+        relays = leveler.relays
+        #sign that turns the error into the distance left to zero in the direction of travel
+        toward = -DIRECTION_SIGNS[direction]
+        zero = sensor.getZero()
+        handOff = HANDOFF * settings.getSetting("mDiff")
+        coast = self.coast(direction)
+        limit = settings.getSetting("xLPulse") * MAX_PULSES
+        fit = RateFit()
+        speed = None
+        remaining = None
+        readTime = None
+
+        start = clock.time()
+        relays.energize(act)
+        try:
+            while not relays.getPause() and clock.time() - start < limit:
+                readTime = clock.time()
+                reading = leveler.decouple(axis, leveler.sample(sensor))
+                if reading is None:
+                    break
+                #error left before zero in the direction of travel, and the speed towards zero
+                remaining = (reading - zero) * toward
+                fit.add(readTime, remaining)
+                rate = fit.rate()
+                speed = -rate if rate is not None else None
+                if remaining <= handOff:
+                    break
+                if speed is not None and speed > 0:
+                    #seconds from the reading until the relay has to be released
+                    wait = (remaining - handOff) / speed - coast
+                    if wait < clock.time() - readTime + fit.interval():
+                        clock.sleep(max(wait - (clock.time() - readTime), 0.0))
+                        break
+        finally:
+            relays.release(act)
+        release = clock.time()
+        onTime = release - start
+
+        #reads the axis until it stops and learns how far it coasted
+        if speed is None or speed <= 0 or remaining is None:
+            return onTime, 0.0
+        atRelease = remaining - speed * (release - readTime)
+        interval = fit.interval()
+        last = None
+        while clock.time() - release < COAST_LIMIT:
+            reading = leveler.decouple(axis, leveler.sample(sensor))
+            if reading is None:
+                break
+            now = (reading - zero) * toward
+            if last is not None and abs(last - now) < STOPPED * speed * interval:
+                last = now
+                break
+            last = now
+        if last is not None:
+            self.observe(direction, speed, atRelease - last)
+        return onTime, clock.time() - release
+
+
+#benchmark starting tilts, (pitch, roll, seed) like Optimizer.scenarios() but far enough out for XL pulses
+def scenarios(runs, tilts=TILTS, seed=0):
+    rng = np.random.default_rng(seed)
+    pitch = rng.uniform(*tilts, runs)
+    roll = rng.uniform(*tilts, runs) * rng.choice((-1, 1), runs)
+    return [(float(p), float(r), seed * runs + i) for i, (p, r) in enumerate(zip(pitch, roll))]
+
+
+#levels the simulated rig once from every start, continuous turns on continuous drive
+#returns a list of (outcome, seconds, pulses, drives)
+def simulate(settingsFile, rigName, levelName, runs, continuous, sim=None, timeOut=TIME_OUT):
+    from Rig import Rig
+    from Simulator import SimClock
+
+    results = []
+    for pitch, roll, seed in runs:
+        rig = Rig(settingsFile, rigName, levelName, clock = SimClock(), timeOut = timeOut, continuous = continuous,
+                  sim = dict(sim or {}, pitch = pitch, roll = roll, seed = seed))
+        rig.setZero(0.0, 0.0)
+        counts = {"pulses": 0, "drives": 0}
+        finish = {}
+
+        def onEvent(event, data):
+            if event == "pulse":
+                counts["drives" if data["drive"] else "pulses"] += 1
+            elif event == "finish":
+                finish.update(data)
+
+        rig.leveler.addListener(onEvent)
+        rig.leveler.autoLevel()
+        rig.close()
+        results.append((finish["outcome"], finish["elapsed"], counts["pulses"], counts["drives"]))
+    return results
+
+
+#summary dictionary of simulate() results
+def summarise(results):
+    seconds = np.array([elapsed for outcome, elapsed, pulses, drives in results if outcome == DONE])
+    return {"runs": len(results),
+            "timeouts": sum(outcome != DONE for outcome, elapsed, pulses, drives in results),
+            "pulses": float(np.mean([pulses for outcome, elapsed, pulses, drives in results])),
+            "drives": float(np.mean([drives for outcome, elapsed, pulses, drives in results])),
+            "median": float(np.median(seconds)) if len(seconds) else None,
+            "p95": float(np.percentile(seconds, 95)) if len(seconds) else None}
+
+
+#compares XL pulses with continuous drive from the same large starting tilts, returns a report dictionary
+def bench(settingsFile, rigName, levelName, runs=20, tilts=TILTS, seed=0, sim=None, timeOut=3 * TIME_OUT):
+    starts = scenarios(runs, tilts, seed)
+    report = {"rig": rigName, "level": levelName, "tilts": list(tilts)}
+    for name, continuous in (("pulsed", False), ("continuous", True)):
+        report[name] = summarise(simulate(settingsFile, rigName, levelName, starts, continuous, sim, timeOut))
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    def cell(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    lines = [f"{report['rig']} {report['level']}: starting tilts {report['tilts'][0]:g} to {report['tilts'][1]:g} min",
+             f"{'':11} {'runs':>5} {'timeouts':>8} {'pulses':>7} {'drives':>7} {'median s':>9} {'p95 s':>7}"]
+    for name in ("pulsed", "continuous"):
+        summary = report[name]
+        lines.append(f"{name:11} {summary['runs']:5} {summary['timeouts']:8} {summary['pulses']:7.1f} "
+                     f"{summary['drives']:7.1f} {cell(summary['median']):>9} {cell(summary['p95']):>7}")
+    return "\n".join(lines)
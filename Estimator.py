@@ -0,0 +1,162 @@
+# Estimator.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Estimator.py
+# Filters.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# SysId.py
+# settings.csv
+
+
+# Overview:
+# This page defines a Kalman filter for each axis that combines what the leveler commanded with what the sensor
+# reads. The state of an axis is
+#   angle       tilt in minutes
+#   risingRate  minutes per second of relay on time for the direction that raises the reading (left, down)
+#   fallingRate minutes per second of relay on time for the direction that lowers the reading (right, up)
+#
+# predict() is called for every pulse: the angle moves by the rate of that direction times the relay on time less
+# the dead time (and backlash when the direction reverses), plus the coast. The uncertainty of the angle grows by
+# PULSE_NOISE of the expected travel, and with DRIFT while the rig stands still. update() fuses each reading as a
+# measurement of the angle with MEASUREMENT_STD noise, which also corrects the rates, so the actuator rate is
+# learned while leveling. Dead time, backlash, coast and the starting rates come from a SysId.py model if one is
+# given.
+#
+# The Leveler uses the estimate instead of single readings when estimating is turned on (Rig estimate=True or
+# --estimate): readings are less noisy so convergence is decided sooner, and inside the sens2 loops a reading is
+# skipped when the predicted angle after a pulse is still clearly outside sens2 (see isOutside()).
+
+
+import numpy as np
+
+#default actuator model used until rates are learned, see Simulator.py
+RATE = 0.05         #minutes/second
+RATE_STD = 0.05     #minutes/second
+DEAD_TIME = 0.05    #seconds
+COAST = 0.05        #seconds
+BACKLASH = 0.0      #seconds
+
+#sensor noise of one reading
+MEASUREMENT_STD = 0.001     #minutes
+#random walk of a standing rig
+DRIFT = 0.0005              #minutes/sqrt(second)
+#uncertainty of each pulse's travel as a fraction of the expected travel
+PULSE_NOISE = 0.1
+#random walk of the actuator rates per pulse
+RATE_DRIFT = 0.001          #minutes/second
+
+#starting angle uncertainty before the first reading
+START_STD = 100.0           #minutes
+
+#standard deviations an estimate must be outside a band to skip reading the sensor
+CONFIDENCE = 3.0
+
+#state index
+ANGLE = 0
+RISING = 1
+FALLING = 2
+
+#movement direction of each relay direction, same as Simulator.DIRECTION_AXES
+DIRECTION_SIGNS = {"left": 1, "right": -1, "up": -1, "down": 1}
+
+
+class AxisEstimator:
+    #initializes estimator of one axis, time is the clock time at the start
+    #rising and falling are (rate, deadTime, coast, backlash) of the two movement directions
+    def __init__(self, time, rising=(RATE, DEAD_TIME, COAST, BACKLASH), falling=(RATE, DEAD_TIME, COAST, BACKLASH),
+                 measurementStd=MEASUREMENT_STD):
+        self.models = {1: rising, -1: falling}
+        self.measurementVar = measurementStd ** 2
+        self.x = np.array([0.0, rising[0], falling[0]])
+        self.P = np.diag([START_STD ** 2, RATE_STD ** 2, RATE_STD ** 2])
+        self.time = time
+        self.lastSign = 0
+
+    #grows angle uncertainty for the time the rig stood still
+    def drift(self, time):
+        if time > self.time:
+            self.P[ANGLE, ANGLE] += DRIFT ** 2 * (time - self.time)
+            self.time = time
+
+    #moves the estimate by a pulse of sign 1 (reading rises) or -1 for duration seconds starting at time
+    def predict(self, sign, duration, time):
+        self.drift(time)
+        rate, deadTime, coast, backlash = self.models[sign]
+        lost = deadTime + (backlash if self.lastSign == -sign else 0.0)
+        self.lastSign = sign
+        driven = max(duration - lost, 0.0)
+        if driven > 0:
+            driven += coast
+
+        rateIndex = RISING if sign > 0 else FALLING
+        F = np.eye(3)
+        F[ANGLE, rateIndex] = sign * driven
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T
+        self.P[ANGLE, ANGLE] += (PULSE_NOISE * driven * self.x[rateIndex]) ** 2
+        self.P[RISING, RISING] += RATE_DRIFT ** 2
+        self.P[FALLING, FALLING] += RATE_DRIFT ** 2
+
+    #fuses a reading of the angle taken at time, returns the new angle estimate
+    def update(self, reading, time):
+        self.drift(time)
+        innovation = reading - self.x[ANGLE]
+        S = self.P[ANGLE, ANGLE] + self.measurementVar
+        K = self.P[:, ANGLE] / S
+        self.x = self.x + K * innovation
+        self.P = self.P - np.outer(K, self.P[ANGLE, :])
+        #rates cannot turn negative
+        self.x[RISING] = max(self.x[RISING], 0.0)
+        self.x[FALLING] = max(self.x[FALLING], 0.0)
+        return self.x[ANGLE]
+
+    def getAngle(self):
+        return float(self.x[ANGLE])
+
+    def getStd(self):
+        return float(np.sqrt(self.P[ANGLE, ANGLE]))
+
+    #learned (rising, falling) actuator rates in minutes per second
+    def getRates(self):
+        return float(self.x[RISING]), float(self.x[FALLING])
+
+    #True if the angle is outside zero +- band with CONFIDENCE
+    def isOutside(self, zero, band):
+        return abs(self.x[ANGLE] - zero) - CONFIDENCE * self.getStd() > band
+
+
+class Estimator:
+    #initializes estimators for both axes
+    #model is a SysId.py parameter dictionary, the default actuator model is used if it is None
+    def __init__(self, clock, model=None, measurementStd=MEASUREMENT_STD):
+        self.clock = clock
+        self.axes = {}
+        for axis, (rising, falling) in (("roll", ("left", "right")), ("pitch", ("down", "up"))):
+            self.axes[axis] = AxisEstimator(clock.time(), directionModel(model, rising),
+                                            directionModel(model, falling), measurementStd)
+
+    def predict(self, axis, direction, duration, start):
+        self.axes[axis].predict(DIRECTION_SIGNS[direction], duration, start)
+
+    def update(self, axis, reading):
+        return self.axes[axis].update(reading, self.clock.time())
+
+    def __getitem__(self, axis):
+        return self.axes[axis]
+
+
+#(rate, deadTime, coast, backlash) of a direction in a SysId.py model
+def directionModel(model, direction):
+    if model is None or direction not in model["directions"]:
+        return RATE, DEAD_TIME, COAST, BACKLASH
+    fit = model["directions"][direction]
+    return fit["rate"], fit["deadTime"], fit["coast"], fit["backlash"]
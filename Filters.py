@@ -0,0 +1,188 @@
+# Filters.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Filters.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines the reading filters used between Sensor.read() and the leveling decisions, so one noisy reading
+# does not cause an unneeded pulse or a pulse in the wrong direction. Each axis has its own FilterChain. Every filter
+# keeps its buffers from reading to reading and builds no new list per reading. The mean and ema keep running values
+# and do a constant amount of work; the median keeps its window sorted and moves one reading out and one in with bisect,
+# a search plus a shift of at most MAX_WINDOW items:
+#   median<n>  median of the last n readings, removes single spikes (n odd, at most MAX_WINDOW)
+#   ema<a>     exponential moving average with weight a for the newest reading, 0 < a <= 1
+#   mean<n>    moving average of the last n readings
+#
+# The chain for a preset is the filter column of settings.csv, filter names separated by spaces, for example
+# "median3 mean4". An empty column means no filtering.
+#
+# Group delay is how many readings the filtered value lags behind a step, (n - 1) / 2 for median and mean and
+# (1 - a) / a for ema. After a pulse the Leveler restarts the chain of that axis and takes settleReadings() fresh
+# readings, so decisions are never made on readings from before the rig moved.
+
+
+import bisect
+import math
+
+#largest median and mean window
+MAX_WINDOW = 25
+
+
+class MedianFilter:
+    def __init__(self, n):
+        if n < 1 or n % 2 == 0 or n > MAX_WINDOW:
+            raise ValueError(f"median window must be odd and 1 to {MAX_WINDOW}, got {n}")
+        self.n = n
+        self.buffer = [0.0] * n
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.index = 0
+        #readings in the buffer in ascending order
+        self.ordered = []
+
+    def update(self, value):
+        if self.count == self.n:
+            #the reading about to be overwritten leaves the sorted window
+            del self.ordered[bisect.bisect_left(self.ordered, self.buffer[self.index])]
+        else:
+            self.count += 1
+        self.buffer[self.index] = value
+        bisect.insort(self.ordered, value)
+        self.index = (self.index + 1) % self.n
+        #until the buffer is full the median of what was read is used
+        return self.ordered[self.count // 2]
+
+    def groupDelay(self):
+        return (self.n - 1) / 2
+
+    def window(self):
+        return self.n
+
+    def __str__(self):
+        return f"median{self.n}"
+
+
+class EmaFilter:
+    def __init__(self, alpha):
+        if not 0 < alpha <= 1:
+            raise ValueError(f"ema weight must be above 0 and at most 1, got {alpha}")
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.value = None
+
+    def update(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def groupDelay(self):
+        return (1 - self.alpha) / self.alpha
+
+    #readings until a step is 95% through
+    def window(self):
+        return 1 if self.alpha == 1 else math.ceil(math.log(0.05) / math.log(1 - self.alpha))
+
+    def __str__(self):
+        return f"ema{self.alpha:g}"
+
+
+class MovingAverage:
+    def __init__(self, n):
+        if n < 1 or n > MAX_WINDOW:
+            raise ValueError(f"mean window must be 1 to {MAX_WINDOW}, got {n}")
+        self.n = n
+        self.buffer = [0.0] * n
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.index = 0
+        self.total = 0.0
+
+    def update(self, value):
+        if self.count == self.n:
+            self.total -= self.buffer[self.index]
+        else:
+            self.count += 1
+        self.buffer[self.index] = value
+        self.total += value
+        self.index = (self.index + 1) % self.n
+        #start over from the buffer each time round so rounding errors cannot build up
+        if self.index == 0:
+            self.total = math.fsum(self.buffer[:self.count])
+        return self.total / self.count
+
+    def groupDelay(self):
+        return (self.n - 1) / 2
+
+    def window(self):
+        return self.n
+
+    def __str__(self):
+        return f"mean{self.n}"
+
+
+FILTERS = {"median": (MedianFilter, int), "ema": (EmaFilter, float), "mean": (MovingAverage, int)}
+
+
+class FilterChain:
+    #filters are applied in order, an empty chain passes readings through
+    def __init__(self, filters=()):
+        self.filters = list(filters)
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+
+    #filters one reading, None (no signal) is passed through without changing the filters
+    def update(self, value):
+        if value is None:
+            return None
+        for f in self.filters:
+            value = f.update(value)
+        return value
+
+    #lag of the filtered reading in readings
+    def groupDelay(self):
+        return sum(f.groupDelay() for f in self.filters)
+
+    #fresh readings needed after a restart before the output only depends on new readings
+    def settleReadings(self):
+        return sum(f.window() for f in self.filters) - len(self.filters) + 1 if self.filters else 0
+
+    def __str__(self):
+        return " ".join(str(f) for f in self.filters)
+
+
+#builds a FilterChain from a settings.csv filter column such as "median3 ema0.3"
+def parseChain(text):
+    filters = []
+    for token in (text or "").split():
+        name = token.rstrip("0123456789.")
+        if name not in FILTERS or name == token:
+            raise ValueError(f"Unknown filter {token!r}, expected median<n>, ema<a> or mean<n>")
+        cls, convert = FILTERS[name]
+        try:
+            parameter = convert(token[len(name):])
+        except ValueError:
+            raise ValueError(f"Bad filter parameter in {token!r}")
+        filters.append(cls(parameter))
+    return FilterChain(filters)
@@ -0,0 +1,558 @@
+# Leveler.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines the leveling engine. The autoLevel() and adapt() functions used to live in run_auto_leveler.py
+# and wrote straight to Tk labels. They now report progress to listener functions instead, so the same engine is used
+# by the GUI and by the headless command line entry point in autoleveler.py.
+#
+# A listener is called as listener(event, data) where data is a dictionary. Events:
+#   "start"   - pitchZero, rollZero, priority,       autoLevel() started leveling, filterDelay is the group delay
+#               filter, filterDelay, coupling        of the reading filters in readings (see Filters.py), coupling
+#                                                    is the preset's (pitchToRoll, rollToPitch)
+#   "reading" - axis, value, raw, zero, difference, a sensor was read, value is the filtered reading used for
+#               measured, std                        leveling, measured the reading from Sensor.read() and raw
+#                                                    the ADC code. With an Estimator value is the estimate and
+#                                                    std its standard deviation
+#   "status"  - text                                 main display text ('Leveling...', 'Done', ...)
+#   "move"    - text                                 current movement ('--Pitch Up--', ...)
+#   "pulse"   - axis, direction, bucket, act,       a relay pulse was issued, start is the time the relay
+#               pulse, delay, start, zero, takeUp,   turned on, takeUp the part of pulse added to take up backlash.
+#               drive                                drive is True for a continuous drive (see Drive.py), pulse is
+#                                                    its relay on time and delay the time spent reading the coast
+#   "estimate"- axis, value, std                     a reading was skipped, value is the Estimator.py prediction
+#   "intervention" - axis, action, pulseScale,      the axis was hunting around zero and the run was changed to
+#               delayScale, bandScale                stop it, see Oscillation.py
+#   "finish"  - outcome, elapsed, reads, cached      autoLevel() returned, reads is the number of sensor reads
+#                                                    (ADC transactions) of the run and cached the reads saved
+#
+# When the preset has a cross axis coupling (see Coupling.py) the sens2 loops level decoupled readings: the error of
+# each axis less the part the pending correction of the other axis will take out. Pulses on one axis then only move
+# the decoupled reading of that axis, so correcting the second axis does not push the first back out of sens2. The
+# sens1 checks always use the readings themselves.
+#
+# A pulse that reverses the last direction of its axis is lengthened by the take-up time Backlash.py learned for its
+# relay. In the sens1 phase pulses that keep approaching zero from the side the run started on are sized for half a
+# sens1 less than the reading, so the last pulses creep up on zero from that side rather than overshoot it and need a
+# reversal.
+#
+# autoLevel() asks for the current reading of an axis several times with nothing moving in between (before the
+# loop, for the sens2 check and again first thing in the sens2 loop). Those reads go through current(), which reuses
+# the last reading of the axis when it is at most maxAge seconds old and no pulse has started since, and only reads
+# the sensor otherwise. Every pulse clears the cache of both axes, as a pulse on one axis can move the other. The
+# "finish" event reports the sensor reads of the run (reads) and the reads the cache saved (cached).
+#
+# With a Drive.ContinuousDrive an error that would get an XL pulse is driven towards zero in one move with the relay
+# held on, and released at a point predicted from the readings streamed meanwhile (see Drive.py).
+
+
+import logging
+import time
+
+from Filters import FilterChain, parseChain
+from Backlash import BacklashLearner, DIRECTION_SIGNS
+from Oscillation import OscillationMonitor
+
+log = logging.getLogger("autoleveler.leveler")
+
+#loop pass details are only logged every:
+SAMPLE_PASSES = 10
+
+#program halts if autoleveling takes longer than:
+TIME_OUT = 90  #seconds
+
+#autoLevel() outcomes
+DONE = "done"
+TIMEOUT = "timeout"
+PAUSED = "paused"
+
+
+#readings up to this old are reused by current() until the next pulse
+MAX_AGE = 0.25  #seconds
+
+#part of sens1 the pulse size of the sens1 phase is reduced by when approaching zero from the starting side
+APPROACH_MARGIN = 0.5
+
+#settings used by each pulse size
+BUCKET_PULSE = {"XL": "xLPulse", "L": "lPulse", "M": "mPulse", "S": "sPulse", "XS": "xSPulse"}
+BUCKET_DELAY = {"XL": "xLDelay", "L": "lDelay", "M": "mDelay", "S": "sDelay", "XS": "xSDelay"}
+
+
+class Leveler:
+    #initializes leveling engine
+    #parameters are the pitch and roll Sensor objects, Relays object and Settings object
+    #clock must provide time() and sleep(), the time module is used on the rig
+    #estimator is an Estimator.Estimator, readings are used as they are if it is None
+    #backlash is a Backlash.BacklashLearner, one starting from no backlash is used if it is None
+    #drive is a Drive.ContinuousDrive, XL pulses are used if it is None
+    #maxAge is the age in seconds up to which current() reuses a reading, 0 reads the sensor every time
+    def __init__(self, pitch, roll, relays, settings, clock=time, timeOut=TIME_OUT, estimator=None, backlash=None,
+                 drive=None, maxAge=MAX_AGE):
+        self.pitch = pitch
+        self.roll = roll
+        self.relays = relays
+        self.settings = settings
+        self.clock = clock
+        self.timeOut = timeOut
+        self.estimator = estimator
+        self.backlash = backlash if backlash is not None else BacklashLearner()
+        self.drive = drive
+        self.maxAge = maxAge
+        #limit cycle detection, its interventions last until the next run
+        self.oscillation = OscillationMonitor()
+
+        self.listeners = []
+
+        #reading filters for each axis, set from the preset's filter column by useFilter()
+        self.filterSpec = None
+        self.filters = {"pitch": FilterChain(), "roll": FilterChain()}
+        self.useFilter(self.settings.getSetting("filter"))
+        #axes whose filter has to be refilled after a pulse, see settle()
+        self.stale = {"pitch": False, "roll": False}
+        #latest reading or estimate of each axis, used by decouple()
+        self.last = {"pitch": None, "roll": None}
+        #last pulse direction of each axis, kept between runs as the slack stays where it was
+        self.lastDirection = {"pitch": None, "roll": None}
+        #latest Sensor.read() of each axis and the pulse waiting for its next one, see learnBacklash()
+        self.measured = {"pitch": None, "roll": None}
+        self.pending = {"pitch": None, "roll": None}
+        #direction of the first pulse of each axis in the current run, the side zero is approached from
+        self.approach = {"pitch": None, "roll": None}
+        #(time read, reading) of each axis reused by current(), cleared when a pulse starts
+        self.cache = {}
+        #sensor reads and reads saved by the cache since the run started
+        self.reads = 0
+        self.cached = 0
+
+    #listener list is replaced rather than changed so listeners can be added from other threads while emitting
+    def addListener(self, listener):
+        self.listeners = self.listeners + [listener]
+
+    def removeListener(self, listener):
+        self.listeners = [l for l in self.listeners if l is not listener]
+
+    #sends event to all listeners
+    def emit(self, event, **data):
+        for listener in self.listeners:
+            listener(event, data)
+
+    #reports current movement
+    def move(self, text):
+        log.info(text)
+        self.emit("move", text = text)
+
+    #logs both sensors once every SAMPLE_PASSES loop passes
+    def logSensors(self):
+        log.debug("%s%s", self.roll, self.pitch, extra = {"sample": SAMPLE_PASSES})
+
+    #verify settings are set correctly
+    def logSettings(self):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("settings", extra = {"fields": {setting: self.settings.getSetting(setting) for setting in
+                ["sens1", "sens2", "xLDiff", "lDiff", "mDiff", "sDiff", "xLPulse", "lPulse", "mPulse",
+                 "sPulse", "xSPulse", "xLDelay", "lDelay", "mDelay", "sDelay", "xSDelay", "filter",
+                 "pitchToRoll", "rollToPitch"]}})
+
+    #builds the reading filters from a filter column such as "median3 ema0.3", kept if spec has not changed
+    def useFilter(self, spec):
+        if spec != self.filterSpec:
+            self.filters = {"pitch": parseChain(spec), "roll": parseChain(spec)}
+            self.filterSpec = spec
+
+    #reads sensor, filters the reading and reports it to listeners
+    def getReading(self, sensor):
+        axis = sensor.getName()
+        if self.stale[axis]:
+            #fill the filter with readings taken after the pulse first
+            self.stale[axis] = False
+            for _ in range(self.filters[axis].settleReadings() - 1):
+                self.getReading(sensor)
+
+        readTime = self.clock.time()
+        measured = sensor.read()
+        self.reads += 1
+        self.learnBacklash(axis, measured)
+        reading = self.filters[axis].update(measured)
+        std = None
+        if self.estimator is not None and reading is not None:
+            reading = self.estimator.update(axis, reading)
+            std = self.estimator[axis].getStd()
+        self.last[axis] = reading
+        if reading is not None:
+            self.cache[axis] = (readTime, reading)
+        self.emit("reading", axis = axis, value = reading, measured = measured, raw = sensor.rawReading,
+                  zero = sensor.getZero(), difference = reading - sensor.getZero() if reading is not None else None,
+                  std = std)
+        return reading
+
+    #returns the last reading of sensor if it is at most maxAge seconds old and no pulse started since, otherwise reads
+    #the sensor
+    def current(self, sensor):
+        cached = self.cache.get(sensor.getName())
+        if cached is not None and self.clock.time() - cached[0] <= self.maxAge:
+            self.cached += 1
+            self.last[sensor.getName()] = cached[1]
+            return cached[1]
+        return self.getReading(sensor)
+
+    #reads sensor without the filters or the estimator and reports it to listeners, used while the rig is moving
+    def sample(self, sensor):
+        axis = sensor.getName()
+        measured = sensor.read()
+        self.reads += 1
+        if measured is not None:
+            self.measured[axis] = measured
+            self.last[axis] = measured
+        self.emit("reading", axis = axis, value = measured, measured = measured, raw = sensor.rawReading,
+                  zero = sensor.getZero(), difference = measured - sensor.getZero() if measured is not None else None,
+                  std = None)
+        return measured
+
+    #returns the estimated reading without reading the sensor if the estimate is clearly outside zero +- band,
+    #otherwise reads the sensor
+    def readOrEstimate(self, sensor, zero, band):
+        axis = sensor.getName()
+        if self.estimator is not None and self.estimator[axis].isOutside(zero, band):
+            estimate = self.estimator[axis]
+            self.emit("estimate", axis = axis, value = estimate.getAngle(), std = estimate.getStd())
+            self.last[axis] = estimate.getAngle()
+            return estimate.getAngle()
+        return self.current(sensor)
+
+    #returns the decoupled reading of axis: zero plus the error that is left for the actuators of axis once the
+    #other axis is corrected, using the latest reading of the other axis. Readings are returned as they are without a
+    #coupling
+    def decouple(self, axis, reading):
+        pitchToRoll = self.settings.getSetting("pitchToRoll")
+        rollToPitch = self.settings.getSetting("rollToPitch")
+        other = "roll" if axis == "pitch" else "pitch"
+        if reading is None or self.last[other] is None or (pitchToRoll == 0 and rollToPitch == 0):
+            return reading
+
+        #errors e change by C u for actuator movements u, C = [[1, rollToPitch], [pitchToRoll, 1]] in (pitch, roll)
+        #order, the decoupled error is the row of inverse(C) e for axis
+        otherSensor = self.roll if axis == "pitch" else self.pitch
+        otherError = self.last[other] - otherSensor.getZero()
+        factor = rollToPitch if axis == "pitch" else pitchToRoll
+        zero = self.pitch.getZero() if axis == "pitch" else self.roll.getZero()
+        determinant = 1 - pitchToRoll * rollToPitch
+        return zero + (reading - zero - factor * otherError) / determinant
+
+    #passes how far the last pulse on axis moved the rig to the backlash learner
+    def learnBacklash(self, axis, measured):
+        pending = self.pending[axis]
+        if measured is not None:
+            self.measured[axis] = measured
+        if pending is None or measured is None:
+            return
+        self.pending[axis] = None
+        direction, duration, reversedPulse, before = pending
+        self.backlash.observe(direction, duration, reversedPulse, (measured - before) * DIRECTION_SIGNS[direction])
+
+    #restarts the filter of axis after a pulse, the next reading refills it so it only holds readings taken after
+    #the pulse
+    def settle(self, axis):
+        chain = self.filters[axis]
+        if chain.filters:
+            chain.reset()
+            self.stale[axis] = True
+
+    #Allows for variable movement response given distance from zero point. Also allows for uniqe delays for each type of movement
+    #input requires current reading from sensors and axis to be moved
+    #margin is added to the difference when choosing the pulse size, see approachMargin(), bucket forces a pulse size
+    def adapt(self, reading, axis, margin=0.0, bucket=None):
+        settings = self.settings
+        directions = self.relays.getDirections()
+
+        #calc difference between zero point and current reading
+        if axis == "roll":
+            difference = reading - self.roll.getZero()
+            if difference > 0:
+                direction = "right"
+            else:
+                direction = "left"
+        else:
+            difference = reading - self.pitch.getZero()
+            if difference > 0:
+                direction = "up"
+            else:
+                direction = "down"
+        act = directions[direction]
+        zero = self.roll.getZero() if axis == "roll" else self.pitch.getZero()
+        log.debug("reading %s zero %s diff %s act %s axis %s", reading, zero, difference, act, axis)
+
+        #smaller pulses and longer settling if the axis is hunting around zero
+        oscillation = self.oscillation
+        action = oscillation.observe(axis, difference)
+        if action is not None:
+            self.emit("intervention", axis = axis, action = action, pulseScale = oscillation.pulseScale(axis),
+                      delayScale = oscillation.delayScale(axis), bandScale = oscillation.bandScale(axis))
+
+        difference = abs(difference) + margin
+
+        if bucket is None:
+            bucket = selectBucket(difference, settings.getSetting)
+        if bucket is None:
+            log.warning("ADAPT ERROR: difference %s", difference)
+            return
+
+        pulse = settings.getSetting(BUCKET_PULSE[bucket]) * oscillation.pulseScale(axis)
+        delay = settings.getSetting(BUCKET_DELAY[bucket]) * oscillation.delayScale(axis)
+
+        #the first part of a reversing pulse takes up slack, a drive measures its movement and needs no take-up
+        driving = bucket == "XL" and self.drive is not None
+        reversedPulse = self.lastDirection[axis] not in (None, direction)
+        takeUp = self.backlash.takeUp(direction) if reversedPulse and not driving else 0.0
+        pulse += takeUp
+        self.lastDirection[axis] = direction
+        if self.approach[axis] is None:
+            self.approach[axis] = direction
+
+        #the rig is about to move, cached readings are out of date
+        self.cache = {}
+        start = self.clock.time()
+        if driving:
+            #hold the relay until the rig is predicted to coast close to zero
+            pulse, delay = self.drive.drive(self, self.roll if axis == "roll" else self.pitch, axis, direction, act)
+        else:
+            #move actuator for pulse length
+            self.relays.moveAct(act, pulse)
+        if self.estimator is not None:
+            self.estimator.predict(axis, direction, pulse, start)
+        if not driving:
+            #delay for given delay
+            self.clock.sleep(delay)
+        #filtered readings from before the pulse are out of date
+        self.settle(axis)
+        #the next reading of axis shows how far the pulse moved, unless the other axis moves it first
+        other = "roll" if axis == "pitch" else "pitch"
+        self.pending[other] = None
+        self.pending[axis] = None
+        if self.measured[axis] is not None and not driving:
+            self.pending[axis] = (direction, pulse, reversedPulse, self.measured[axis])
+        #update display
+        self.emit("pulse", axis = axis, direction = direction, bucket = bucket, act = act, pulse = pulse, delay = delay,
+                  start = start, zero = zero, takeUp = takeUp, drive = driving)
+        log.info("Pulse: %s", "drive" if driving else bucket, extra = {"fields": {"axis": axis, "pulse": pulse,
+                                                                                  "delay": delay, "takeUp": takeUp}})
+
+    #margin for adapt() in the sens1 phase, a pulse in the direction of the run's first pulse on axis is sized for
+    #APPROACH_MARGIN of sens1 less so it stops short of zero rather than past it
+    def approachMargin(self, axis, direction, sens1):
+        return -APPROACH_MARGIN * sens1 if self.approach[axis] == direction else 0.0
+
+    #performs autoleveling function when called, returns DONE, TIMEOUT or PAUSED
+    def autoLevel(self):
+        self.logSettings()
+        #do not run if eStop is engaged
+        if self.relays.getPause():
+            self.move("Zero not taken")
+            return PAUSED
+
+        roll = self.roll
+        pitch = self.pitch
+        getReading = self.getReading
+
+        self.emit("status", text = "Leveling...")
+        #save start time
+        start = self.clock.time()
+        log.info("Leveling")
+        self.useFilter(self.settings.getSetting("filter"))
+        self.approach = {"pitch": None, "roll": None}
+        self.oscillation.reset()
+        self.reads = 0
+        self.cached = 0
+        self.emit("start", pitchZero = pitch.getZero(), rollZero = roll.getZero(), priority = self.settings.getPriority(),
+                  filter = self.filterSpec, filterDelay = self.filters["pitch"].groupDelay(),
+                  coupling = (self.settings.getSetting("pitchToRoll"), self.settings.getSetting("rollToPitch")))
+
+        zeroRoll = roll.getZero()
+        zeroPitch = pitch.getZero()
+        sens1 = self.settings.getSetting("sens1")
+        sens2 = self.settings.getSetting("sens2")
+
+        if self.settings.getPriority() == "roll":
+            first = roll
+            second = pitch
+            zeroFirst = zeroRoll
+            zeroSecond = zeroPitch
+            firstAxis = "roll"
+            secondAxis = "pitch"
+            firstPos = "Roll Right"
+            firstNeg = "Roll Left"
+            firstClose = "--Roll Close--"
+            secondPos = "Pitch Up"
+            secondNeg = "Pitch Down"
+            secondClose = "--Roll Close--"
+        else:
+            first = pitch
+            second = roll
+            zeroFirst = zeroPitch
+            zeroSecond = zeroRoll
+            firstAxis = "pitch"
+            secondAxis = "roll"
+            firstPos = "--Pitch Up--"
+            firstNeg = "--Pitch Down--"
+            firstClose = "--Pitch Close--"
+            secondPos = "--Roll Right--"
+            secondNeg = "--Roll Left--"
+            secondClose = "--Roll Close--"
+
+        decouple = self.decouple
+        current = self.current
+        r = getReading(roll)
+        p = getReading(pitch)
+        #sens1 of each axis, widened while an axis is hunting (see Oscillation.py)
+        sens1Roll = sens1
+        sens1Pitch = sens1
+
+        #while current reading is not within sensitivity setting 1 continue to loop
+        while not ((r < zeroRoll+sens1Roll
+                and r > zeroRoll-sens1Roll
+                and p < zeroPitch+sens1Pitch
+                and p > zeroPitch-sens1Pitch)
+                or self.relays.getPause()):
+
+            #If FIRST is not within sens2
+            f = decouple(firstAxis, current(first))
+            if not(f < zeroFirst+sens2 and f > zeroFirst-sens2):
+                #loop until Ax is within sens2 or eStop is engaged
+                while not((f < zeroFirst+sens2 and f > zeroFirst-sens2) or self.relays.getPause()):
+                    #udpate Ax and Ay, the reading is skipped while the estimate is clearly outside sens2
+                    f = decouple(firstAxis, self.readOrEstimate(first, zeroFirst, sens2))
+
+                    self.logSensors()
+
+                    #if reading is greater than zero+sens2 move right using adapt() function
+                    if(f >= zeroFirst+sens2):
+                        self.move(firstPos)
+                        self.adapt(f, firstAxis)
+
+                    #if reading is less than zero-sens2 move left
+                    elif(f <= zeroFirst-sens2):
+                        self.move(firstNeg)
+                        self.adapt(f, firstAxis)
+
+                    #else X is close, do nothing
+                    else:
+                        self.move(firstClose)
+
+                    if self.clock.time() - start > self.timeOut:
+                        return self.finish(TIMEOUT, start)
+
+            #same process for Y
+            #If Y is not within sens2 adjust until within sens2
+            s = decouple(secondAxis, current(second))
+            if not(s < zeroSecond+sens2 and s > zeroSecond-sens2):
+                while not ((s < zeroSecond+sens2 and s > zeroSecond-sens2) or self.relays.getPause()):
+                    s = decouple(secondAxis, self.readOrEstimate(second, zeroSecond, sens2))
+
+                    self.logSensors()
+
+                    if(s >= zeroSecond+sens2):
+                        self.move(secondPos)
+                        self.adapt(s, secondAxis)
+
+                    elif(s <= zeroSecond-sens2):
+                        self.move(secondNeg)
+                        self.adapt(s, secondAxis)
+
+                    else:
+                        self.move(secondClose)
+
+                    if self.clock.time() - start > self.timeOut:
+                        return self.finish(TIMEOUT, start)
+
+            #after getting X and Y within sens2, the program will bypass the above 2 while loops and attempt to get rig within sens1
+            if not self.relays.getPause():
+                r = current(roll)
+                p = current(pitch)
+                sens1Roll = sens1 * self.oscillation.bandScale("roll")
+                sens1Pitch = sens1 * self.oscillation.bandScale("pitch")
+
+                self.logSensors()
+
+                #if X is greater than zero+sens1 move right
+                if(r >= zeroRoll+sens1Roll):
+                    self.move("--Roll right--")
+                    self.adapt(r, "roll", self.approachMargin("roll", "right", sens1Roll))
+
+                #if X is less than zero-sens1 move left
+                elif(r <= zeroRoll-sens1Roll):
+                    self.move("--Roll left--")
+                    self.adapt(r, "roll", self.approachMargin("roll", "left", sens1Roll))
+
+                #else X is good do nothing
+                else:
+                    self.move("--Roll good--")
+
+                #if Y is greater than zero+sens1 move up
+                if(p >= zeroPitch+sens1Pitch):
+                    self.move("--Pitch up--")
+                    self.adapt(p, "pitch", self.approachMargin("pitch", "up", sens1Pitch))
+
+                #if Y is less than zero-sens1 move down
+                elif(p <= zeroPitch-sens1Pitch):
+                    self.move("--Pitch down--")
+                    self.adapt(p, "pitch", self.approachMargin("pitch", "down", sens1Pitch))
+
+                #else Y is good, do nothing
+                else:
+                    self.move("--Pitch good--")
+
+                #check time elapsed, if elapsed time exceeds time out quit
+                if self.clock.time() - start > self.timeOut:
+                    return self.finish(TIMEOUT, start)
+
+        # *** END OUTER WHILE LOOP ***
+        #while loop exits here only if Ax and Ay are within sens1 or eStop has been engaged (time outs return from inside the loop). If none of these happen
+        # the while loop will continue to loop from the beginning. Each if statement will be checked again meaning X or Y may be changed even if
+        #they were level at one point. It is also possible that the program may reenter the initial while loops that adjust X and Y within sens2.
+
+        #if eStop has been engaged
+        if self.relays.getPause():
+            return self.finish(PAUSED, start)
+        return self.finish(DONE, start)
+
+    #reports the outcome of autoLevel() to listeners
+    def finish(self, outcome, start):
+        elapsed = self.clock.time() - start
+        log.info("Leveling %s after %.2f s", outcome, elapsed, extra = {"fields": {"reads": self.reads,
+                                                                                   "cached": self.cached}})
+        self.emit("status", text = {DONE: "Done", TIMEOUT: "Time Out", PAUSED: "Paused.."}[outcome])
+        self.emit("finish", outcome = outcome, elapsed = elapsed, reads = self.reads, cached = self.cached)
+        return outcome
+
+
+#returns the pulse size adapt() uses for an absolute difference, or None if difference is not a number
+#getSetting is Settings.getSetting or the get method of a preset dictionary from Settings.getPreset()
+def selectBucket(difference, getSetting):
+    #Extra long pulse
+    if difference > getSetting("xLDiff"):
+        return "XL"
+    #Long pulse
+    elif difference <= getSetting("xLDiff") and difference > getSetting("lDiff"):
+        return "L"
+    #Medium pulse
+    elif difference <= getSetting("lDiff") and difference > getSetting("mDiff"):
+        return "M"
+    #Small pulse
+    elif difference <= getSetting("mDiff") and difference > getSetting("sDiff"):
+        return "S"
+    #Extra small pulse
+    elif difference <= getSetting("sDiff"):
+        return "XS"
+    return None
@@ -0,0 +1,161 @@
+# Logs.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Logs.py
+# Recorder.py
+# Replay.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page sets up logging for the control loop. Modules log through logging.getLogger("autoleveler.<module>")
+# instead of print(). setupLogging() attaches a single QueueHandler to the "autoleveler" logger, so the control
+# thread only formats a record and puts it on a queue. A QueueListener thread writes the records to the console and,
+# if requested, to a rotating log file. Rotated files are gzip compressed by the listener thread as well.
+#
+# Records that repeat every loop pass can be sampled by adding extra={"sample": n}. Only every nth record with the
+# same message template is kept. Extra structured values can be attached with extra={"fields": {...}}. They are
+# appended to console lines and written as JSON properties in the log file.
+
+
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+
+LOGGER = "autoleveler"
+
+#log file rotation
+LOG_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 10
+
+CONSOLE_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s%(fieldText)s"
+
+#active listener, see setupLogging()
+listener = None
+
+
+#keeps every nth record of each message template marked with extra={"sample": n}
+class SampleFilter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.counts = {}
+
+    def filter(self, record):
+        every = getattr(record, "sample", None)
+        if not every or every <= 1:
+            return True
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1
+        return count % every == 0
+
+
+#queue handler that only renders the message on the calling thread, timestamps and layout are done by the listener
+class ControlQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        #render arguments now, objects such as Sensor may change before the listener gets to them
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+#console formatter, appends structured fields as key=value
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, "fields", None)
+        record.fieldText = "" if not fields else "  " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return super().format(record)
+
+
+#log file formatter, one JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {"t": round(record.created, 3),
+                "level": record.levelname,
+                "logger": record.name,
+                "thread": record.threadName,
+                "msg": record.getMessage()}
+        fields = getattr(record, "fields", None)
+        if fields:
+            line.update(fields)
+        if record.exc_text:
+            line["exc"] = record.exc_text
+        return json.dumps(line, default = str)
+
+
+def gzipNamer(name):
+    return name + ".gz"
+
+
+def gzipRotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+#sets up queued logging for the "autoleveler" loggers and starts the listener thread
+#level is the lowest level logged, console is a stream (stderr by default, None for no console output)
+#file is a log file path for JSON lines, rotated at LOG_BYTES and compressed
+def setupLogging(level=logging.INFO, console=sys.stderr, file=None):
+    global listener
+    stopLogging()
+
+    handlers = []
+    if console is not None:
+        consoleHandler = logging.StreamHandler(console)
+        consoleHandler.setFormatter(ConsoleFormatter(CONSOLE_FORMAT))
+        handlers.append(consoleHandler)
+    if file is not None:
+        fileHandler = logging.handlers.RotatingFileHandler(file, maxBytes = LOG_BYTES, backupCount = LOG_BACKUPS)
+        fileHandler.namer = gzipNamer
+        fileHandler.rotator = gzipRotator
+        fileHandler.setFormatter(JsonFormatter())
+        handlers.append(fileHandler)
+
+    records = queue.SimpleQueue()
+    queueHandler = ControlQueueHandler(records)
+    queueHandler.addFilter(SampleFilter())
+
+    logger = logging.getLogger(LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queueHandler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level = True)
+    listener.start()
+    return listener
+
+
+#flushes queued records and stops the listener thread
+def stopLogging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+atexit.register(stopLogging)
@@ -0,0 +1,269 @@
+# MultiRig.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Acquisition.py
+# Backends.py
+# Control.py
+# MultiRig.py
+# Rig.py
+# Relays.py
+# Settings.py
+# Simulator.py
+# hardware.json
+# settings.csv
+
+
+# Overview:
+# The GUI keeps one rig in module globals (ADC, pitch, roll, relays, settings), so every rig needed its own Pi and
+# process. A MultiRig drives several rigs, called stations, from one process. Each station is a Rig (see Rig.py) with
+# its own ADC, relay pins, preset and Leveler, owned by its own Control.RigWorker thread that samples it while idle and
+# runs its commands, so stations level at the same time and a station waiting on its sensors never holds up another.
+# Reading the sensors and pulsing the relays is nearly all waiting, so the threads share one CPU with room to spare.
+#
+# Failures stay with their station. A station that cannot be opened (missing serial port, relay pins used by another
+# station, unknown preset) is reported and left out, a worker whose sensors stop answering goes to the error state and
+# retries, and an exception in a command fails only that command. getStatus() gives the status of every station and a
+# count of stations in each state. `autoleveler multi` serves the control API for all stations (see Control.py).
+#
+# The stations are listed in stations.json:
+#   {"stations": [{"station": "bay1", "rig": "Midload", "level": "T-Level", "port": "/dev/ttyUSB0",
+#                  "pins": [16, 12, 20, 21]},
+#                 {"station": "bay2", "rig": "ABCS", "level": "1 Level", "hardware": "bay2.json"},
+#                 {"station": "desk", "rig": "Midload", "level": "T-Level", "sim": {"pitch": 0.5}}]}
+# "hardware" is a hardware.json for the station (the --hardware file by default), "port" and "pins" replace its ADC
+# port and relay pins, "sim" simulates the station with these Simulator.SimRig arguments and "continuous" turns on
+# continuous drive (see Drive.py).
+#
+# Usage:
+#   python -m autoleveler multi stations.json --socket /tmp/autoleveler.sock
+#   python -m autoleveler multi --bench 8 --rig Midload --level T-Level
+
+
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from Acquisition import Acquisition, FAST, IDLE, IDLE_AFTER, STILL
+from Backends import HARDWARE_FILE, loadHardware
+from Control import RigWorker
+from Leveler import DONE, TIME_OUT
+from Rig import Rig, SETTINGS_FILE
+
+log = logging.getLogger("autoleveler.multirig")
+
+STATIONS_FILE = "stations.json"
+
+#station keys
+STATION_KEYS = ("station", "rig", "level", "hardware", "port", "pins", "sim", "continuous")
+
+#seconds of idle sampling and largest starting tilt in minutes of each benchmark case
+BENCH_SECONDS = 10.0
+BENCH_TILT = 0.2
+
+
+#returns the station list of a stations file
+def loadStations(path=STATIONS_FILE):
+    with open(path) as file:
+        stations = json.load(file)["stations"]
+    names = set()
+    for station in stations:
+        for key in ("station", "rig", "level"):
+            if key not in station:
+                raise ValueError(f"station {station.get('station', '?')} has no {key!r}")
+        unknown = set(station) - set(STATION_KEYS)
+        if unknown:
+            raise ValueError(f"station {station['station']} has unknown keys {sorted(unknown)}")
+        if station["station"] in names:
+            raise ValueError(f"station {station['station']} is listed twice")
+        names.add(station["station"])
+    return stations
+
+
+class MultiRig:
+    #stations is a list of station dictionaries (see loadStations()), settingsFile has the presets of all of them
+    #hardwareFile is used by stations without their own, record is a directory for a telemetry recording of each
+    #station (see Recorder.py), idle, idleAfter and still schedule the idle sampling of each station (see
+    #Acquisition.py)
+    def __init__(self, stations, settingsFile=SETTINGS_FILE, hardwareFile=HARDWARE_FILE, clock=time,
+                 timeOut=TIME_OUT, record=None, idle=IDLE, idleAfter=IDLE_AFTER, still=STILL):
+        self.workers = {}
+        #error message of each station that could not be opened
+        self.failures = {}
+        #relay pins and ADC ports taken by the hardware stations opened so far
+        self.taken = set()
+
+        for station in stations:
+            name = station["station"]
+            try:
+                rig = self.openStation(station, settingsFile, hardwareFile, clock, timeOut, record)
+            except Exception as e:
+                log.error("Station not opened", extra = {"fields": {"station": name, "error": str(e)}})
+                self.failures[name] = str(e)
+                continue
+            acquisition = Acquisition(clock = clock, fast = FAST, idle = idle, idleAfter = idleAfter, still = still)
+            self.workers[name] = RigWorker(rig, acquisition = acquisition, name = f"rig-{name}")
+
+    #builds the Rig of a station
+    def openStation(self, station, settingsFile, hardwareFile, clock, timeOut, record):
+        name = station["station"]
+        hardware = loadHardware(station.get("hardware", hardwareFile))
+        if "pins" in station:
+            hardware["relays"]["pins"] = list(station["pins"])
+        if "port" in station:
+            hardware["adc"]["port"] = station["port"]
+
+        #two stations on the same relay pins or serial port would drive each other's rig
+        sim = station.get("sim")
+        resources = set()
+        if sim is None and hardware["adc"]["transport"] != "sim":
+            if hardware["relays"]["backend"] != "fake":
+                pins = hardware["relays"].get("pins")
+                if pins is None:
+                    raise ValueError("stations on the hardware need their own relay pins")
+                resources |= {("pin", hardware["relays"]["backend"], hardware["relays"]["chip"], pin) for pin in pins}
+            if hardware["adc"]["transport"] == "serial":
+                resources.add(("port", hardware["adc"]["port"]))
+            else:
+                resources.add(("tcp", hardware["adc"]["host"], hardware["adc"]["tcpPort"]))
+        shared = resources & self.taken
+        if shared:
+            raise ValueError(f"{', '.join(str(resource[-1]) for resource in sorted(shared))} already used by "
+                             f"another station")
+
+        rig = Rig(settingsFile, station["rig"], station["level"], sim = sim, clock = clock, timeOut = timeOut,
+                  record = None if record is None else os.path.join(record, name),
+                  continuous = station.get("continuous", False), hardware = hardware)
+        self.taken |= resources
+        return rig
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    #stops every worker and closes its rig, a station that fails to close does not keep the others open
+    def stop(self):
+        for name, worker in self.workers.items():
+            try:
+                if worker.running:
+                    worker.stop()
+                worker.rig.close()
+            except Exception:
+                log.exception("Station not closed", extra = {"fields": {"station": name}})
+
+    #starts leveling the given stations (all by default) at once, returns {station: concurrent.futures.Future}
+    def level(self, names=None):
+        names = self.workers if names is None else names
+        return {name: self.workers[name].submit(self.workers[name].level, busy = True) for name in names}
+
+    #{"stations": {station: status}, "states": {state: count}}, stations that could not be opened are in the
+    #error state
+    def getStatus(self):
+        stations = {}
+        for name, worker in self.workers.items():
+            stations[name] = worker.getStatus()
+        for name, error in self.failures.items():
+            stations[name] = {"state": "error", "error": error}
+        states = {}
+        for status in stations.values():
+            states[status["state"]] = states.get(status["state"], 0) + 1
+        return {"stations": stations, "states": states}
+
+
+#simulated station list of count stations with random starting tilts up to tilt minutes
+def simStations(count, rigName, levelName, tilt=BENCH_TILT, seed=0):
+    rng = random.Random(seed)
+    return [{"station": f"sim{i + 1}", "rig": rigName, "level": levelName,
+             "sim": {"pitch": rng.uniform(-tilt, tilt), "roll": rng.uniform(-tilt, tilt), "seed": seed + i}}
+            for i in range(count)]
+
+
+#samples count simulated stations in real time for seconds, then levels all of them at once
+#returns the reading pairs per second of each station while idle and while leveling, and the leveling outcomes
+def simulate(settingsFile, rigName, levelName, count, seconds=BENCH_SECONDS, tilt=BENCH_TILT, seed=0,
+             timeOut=TIME_OUT):
+    multi = MultiRig(simStations(count, rigName, levelName, tilt, seed), settingsFile, hardwareFile = None,
+                     timeOut = timeOut, idleAfter = math.inf)
+    readings = {name: 0 for name in multi.workers}
+    #readings of each station while it levels, counted from its start to its finish event
+    levelReadings = {name: 0 for name in multi.workers}
+    leveling = set()
+    finish = {}
+    lock = threading.Lock()
+
+    def counter(name):
+        def onEvent(event, data):
+            with lock:
+                if event == "reading":
+                    readings[name] += 1
+                    if name in leveling:
+                        levelReadings[name] += 1
+                elif event == "start":
+                    leveling.add(name)
+                elif event == "finish":
+                    leveling.discard(name)
+                    finish[name] = data
+        return onEvent
+
+    for name, worker in multi.workers.items():
+        worker.rig.setZero(0.0, 0.0)
+        worker.rig.leveler.addListener(counter(name))
+    try:
+        cpu = time.process_time()
+        multi.start()
+        time.sleep(seconds)
+        with lock:
+            idle = [count / 2 / seconds for count in readings.values()]
+        idleCpu = time.process_time() - cpu
+
+        start = time.time()
+        for future in multi.level().values():
+            future.result()
+        elapsed = time.time() - start
+        with lock:
+            rates = [levelReadings[name] / 2 / finish[name]["elapsed"] for name in levelReadings]
+    finally:
+        multi.stop()
+    return {"stations": count, "idle": idle, "idleCpu": 100 * idleCpu / seconds, "leveling": rates,
+            "outcomes": [finish[name]["outcome"] for name in sorted(finish)],
+            "times": [finish[name]["elapsed"] for name in sorted(finish)], "wall": elapsed}
+
+
+#compares one simulated station with count stations in one process, returns a report dictionary
+def bench(settingsFile, rigName, levelName, count=8, seconds=BENCH_SECONDS, tilt=BENCH_TILT, seed=0,
+          timeOut=TIME_OUT):
+    report = {"rig": rigName, "level": levelName, "seconds": seconds, "tilt": tilt, "cases": []}
+    for stations in sorted({1, count}):
+        result = simulate(settingsFile, rigName, levelName, stations, seconds, tilt, seed, timeOut)
+        report["cases"].append({"stations": stations,
+                                "idleRate": float(np.mean(result["idle"])),
+                                "idleRateMin": float(np.min(result["idle"])),
+                                "idleCpu": result["idleCpu"],
+                                "levelRate": float(np.mean(result["leveling"])),
+                                "levelRateMin": float(np.min(result["leveling"])),
+                                "done": sum(outcome == DONE for outcome in result["outcomes"]),
+                                "medianTime": float(np.median(result["times"])),
+                                "wall": result["wall"]})
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    lines = [f"{report['rig']} {report['level']}: {report['seconds']:g} s idle sampling, then leveling from tilts up "
+             f"to {report['tilt']:g} min",
+             f"{'stations':>8} {'idle pairs/s':>13} {'min':>6} {'cpu %':>6} {'level pairs/s':>14} {'min':>6} "
+             f"{'done':>5} {'median s':>9} {'all s':>7}"]
+    for case in report["cases"]:
+        lines.append(f"{case['stations']:8} {case['idleRate']:13.2f} {case['idleRateMin']:6.2f} "
+                     f"{case['idleCpu']:6.1f} {case['levelRate']:14.2f} {case['levelRateMin']:6.2f} "
+                     f"{case['done']:5} {case['medianTime']:9.1f} {case['wall']:7.1f}")
+    return "\n".join(lines)
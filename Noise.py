@@ -0,0 +1,194 @@
+# Noise.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Logs.py
+# Noise.py
+# Optimizer.py
+# Recorder.py
+# Replay.py
+# Rig.py
+# Relays.py
+# SessionDB.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# SysId.py
+# settings.csv
+
+
+# Overview:
+# This page characterizes the sensor noise of a rig that is standing still, so sens1 and the settle delays can be set
+# from what the hardware can actually hold instead of by hand. Both channels are read in turn the same way the
+# leveler reads them, either live from the rig or from the samples of a recording (Recorder.py) while nothing moved.
+#
+# For each axis:
+#   std       standard deviation of single readings after removing the mean
+#   allan     overlapping Allan deviation for averaging windows of 1, 2, 4, ... readings. It falls as readings are
+#             averaged until slow drift takes over, the window with the lowest Allan deviation is the most useful
+#             averaging window, up to MAX_WINDOW seconds
+#   spectrum  power spectral density from the NumPy FFT of the Hann windowed readings, the strongest peak above
+#             MIN_VIBRATION is the dominant vibration
+#
+# Recommendations:
+#   window    averaging window in readings and seconds (lowest Allan deviation)
+#   sens1     COVERAGE times the noise left after averaging over the window, the tightest tolerance a level rig stays
+#             inside for nearly every reading. With single readings (no averaging) it is COVERAGE * std
+#   settle    seconds to wait after a pulse before a fresh averaging window is available, at least one period of
+#             the dominant vibration when there is a clear peak
+#
+# Usage:
+#   python -m autoleveler noise --rig Midload --level T-Level --seconds 120
+#   python -m autoleveler noise --recording recordings --since 2023-06-01T08:00 --until 2023-06-01T08:05
+
+
+import numpy as np
+
+from Recorder import SAMPLE, AXES
+
+#readings inside +-COVERAGE standard deviations, 3 keeps 99.7% of readings of a level rig inside sens1
+COVERAGE = 3.0
+
+#a spectrum peak counts as vibration if its power is this many times the median power
+PEAK_FACTOR = 20.0
+
+#slower movement than this is drift rather than vibration
+MIN_VIBRATION = 0.2     #Hz
+
+#longest averaging window recommended, every loop pass would wait this long for a reading
+MAX_WINDOW = 1.0    #seconds
+
+#fewest readings per axis analysed
+MIN_READINGS = 16
+
+CAPTURE_SECONDS = 60
+
+
+#reads both sensors of a Rig for seconds without moving it
+#returns {"pitch": (times, readings), "roll": (times, readings)}
+def capture(rig, seconds=CAPTURE_SECONDS, clock=None):
+    clock = clock or rig.leveler.clock
+    data = {"pitch": ([], []), "roll": ([], [])}
+    end = clock.time() + seconds
+    while clock.time() < end:
+        for sensor in (rig.pitch, rig.roll):
+            #the unfiltered reading is kept, the noise of the sensor itself is wanted
+            if rig.leveler.getReading(sensor) is not None:
+                times, values = data[sensor.getName()]
+                times.append(clock.time())
+                values.append(sensor.reading)
+    return {axis: (np.array(times), np.array(values)) for axis, (times, values) in data.items()}
+
+
+#returns readings of a recording in the same form as capture(), since and until limit the time range
+def fromRecording(records, since=None, until=None):
+    if since is not None:
+        records = records[records["t"] >= since]
+    if until is not None:
+        records = records[records["t"] < until]
+    data = {}
+    for axis, code in AXES.items():
+        samples = records[(records["kind"] == SAMPLE) & (records["axis"] == code)]
+        data[axis] = (np.asarray(samples["t"], dtype = float), np.asarray(samples["minutes"], dtype = float))
+    return data
+
+
+#overlapping Allan deviation for averaging windows of m readings
+def allanDeviation(values, windows):
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    deviations = []
+    for m in windows:
+        means = (cumulative[m:] - cumulative[:-m]) / m
+        differences = means[m:] - means[:-m]
+        deviations.append(np.sqrt(0.5 * np.mean(differences ** 2)))
+    return np.array(deviations)
+
+
+#one sided power spectral density of the readings with the linear trend removed, returns (frequencies, power)
+def spectrum(values, period):
+    steps = np.arange(len(values))
+    values = values - np.polyval(np.polyfit(steps, values, 1), steps)
+    window = np.hanning(len(values))
+    transform = np.fft.rfft(values * window)
+    power = 2 * np.abs(transform) ** 2 * period / (window ** 2).sum()
+    return np.fft.rfftfreq(len(values), period), power
+
+
+#analyses readings of one axis, times in seconds and readings in minutes
+def analyse(times, values, coverage=COVERAGE):
+    if len(values) < MIN_READINGS:
+        raise ValueError(f"Need at least {MIN_READINGS} readings, got {len(values)}")
+    period = float(np.median(np.diff(times)))
+
+    windows = 2 ** np.arange(int(np.log2(len(values) // 4)) + 1)
+    allan = allanDeviation(values, windows)
+    usable = windows * period <= MAX_WINDOW
+    usable[0] = True
+    best = int(np.argmin(np.where(usable, allan, np.inf)))
+
+    frequencies, power = spectrum(values, period)
+    peak = None
+    vibration = np.flatnonzero(frequencies >= MIN_VIBRATION)
+    if len(vibration) > 2:
+        index = vibration[int(np.argmax(power[vibration]))]
+        if power[index] > PEAK_FACTOR * np.median(power[vibration]):
+            peak = {"frequency": float(frequencies[index]), "power": float(power[index])}
+
+    window = int(windows[best])
+    settle = window * period
+    if peak is not None:
+        settle = max(settle, 1 / peak["frequency"])
+
+    std = float(values.std())
+    return {"readings": len(values),
+            "period": period,
+            "std": std,
+            "allan": {"windows": windows.tolist(), "seconds": (windows * period).tolist(), "deviation": allan.tolist()},
+            "spectrum": {"frequencies": frequencies.tolist(), "power": power.tolist()},
+            "peak": peak,
+            "window": window,
+            "windowSeconds": window * period,
+            "sens1": coverage * float(allan[best]),
+            "sens1Single": coverage * std,
+            "settle": settle}
+
+
+#analyses both axes of capture() or fromRecording() data, the recommendation for the preset is the looser axis
+def characterize(data, coverage=COVERAGE):
+    report = {axis: analyse(times, values, coverage) for axis, (times, values) in data.items()}
+    report["sens1"] = max(report["pitch"]["sens1"], report["roll"]["sens1"])
+    report["sens1Single"] = max(report["pitch"]["sens1Single"], report["roll"]["sens1Single"])
+    report["window"] = max(report["pitch"]["window"], report["roll"]["window"])
+    report["settle"] = max(report["pitch"]["settle"], report["roll"]["settle"])
+    return report
+
+
+#returns characterize() report as printable text, preset is compared if given (Settings.getPreset())
+def formatReport(report, preset=None):
+    lines = []
+    for axis in ("pitch", "roll"):
+        result = report[axis]
+        lines.append(f"{axis}: {result['readings']} readings every {result['period']:.3f} s, "
+                     f"std {result['std']:.5f} min")
+        lines.append("  window  seconds  allan dev")
+        for window, seconds, deviation in zip(result["allan"]["windows"], result["allan"]["seconds"],
+                                              result["allan"]["deviation"]):
+            marker = "  <" if window == result["window"] else ""
+            lines.append(f"  {window:6} {seconds:8.2f}  {deviation:.6f}{marker}")
+        if result["peak"] is not None:
+            lines.append(f"  vibration peak at {result['peak']['frequency']:.2f} Hz")
+    lines.append(f"recommended averaging window: {report['window']} readings")
+    lines.append(f"recommended sens1:            {report['sens1']:.4f} min averaged, "
+                 f"{report['sens1Single']:.4f} min single readings")
+    lines.append(f"recommended settle time:      {report['settle']:.2f} s")
+    if preset is not None:
+        lines.append(f"current sens1:                {preset['sens1']:.4f} min")
+        if preset["sens1"] < report["sens1Single"]:
+            lines.append("  sens1 is inside the noise of single readings, leveling will chase noise")
+    return "\n".join(lines)
@@ -0,0 +1,353 @@
+# Optimizer.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Logs.py
+# Optimizer.py
+# Recorder.py
+# Replay.py
+# Rig.py
+# Relays.py
+# SessionDB.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page searches for better pulse, delay and threshold values for one rig and level preset by leveling the
+# simulated rig (Simulator.py) on a virtual SimClock, so thousands of runs take seconds instead of days on the rig.
+#
+# A candidate preset is scored over the same set of scenarios, random starting tilts drawn from one seed, so every
+# candidate sees the same starts. The score is the median plus the 95th percentile time to level, timed out runs
+# count as the time out. A candidate is only feasible if no run timed out and the 95th percentile of overshoots per
+# run (pulses that reversed the previous pulse direction on an axis, same as SessionDB.py) stays within the limit.
+#
+# Search methods:
+#   grid    - every combination of GRID_POINTS values for each searched setting, refused when that is more than
+#             budget candidates (3 values of all 15 settings would be 14.3 million), so search a few --params
+#   random  - budget candidates drawn uniformly
+#   bayes   - a few random candidates, then Gaussian process regression with expected improvement picks each batch
+# Settings are searched in a unit cube mapped onto SEARCH_RANGE times the current value on a log scale. The diff
+# thresholds are kept in order (xLDiff > lDiff > mDiff > sDiff) and sens2 above sens1. sens1 is the leveling
+# tolerance and is never searched.
+#
+# Evaluations are fanned out over a process pool. The result is a report comparing the current preset with the best
+# candidate and the candidate's settings.csv row; settings.csv is never changed. --write saves a copy of the
+# settings file with the candidate row, which can be checked against field data with the replay command.
+#
+# Usage:
+#   python -m autoleveler optimize --rig Midload --level T-Level --method bayes --budget 200
+#   python -m autoleveler optimize --rig Midload --level T-Level --method grid --params xLPulse,lPulse --write new.csv
+
+
+import concurrent.futures
+import csv
+import math
+import os
+
+import numpy as np
+
+from Leveler import DONE, TIME_OUT
+from Rig import Rig
+from Settings import Settings, PRESET_COLUMNS, RIG, LEVEL
+from Simulator import SimClock
+
+#settings that can be searched
+PARAMETERS = ["sens2", "xLDiff", "lDiff", "mDiff", "sDiff",
+              "xLPulse", "lPulse", "mPulse", "sPulse", "xSPulse",
+              "xLDelay", "lDelay", "mDelay", "sDelay", "xSDelay"]
+DIFFS = ["xLDiff", "lDiff", "mDiff", "sDiff"]
+
+#searched values range from value / SEARCH_RANGE to value * SEARCH_RANGE
+SEARCH_RANGE = 4.0
+#smallest values searched, also used when the current value is 0
+MINIMUM = {"sens2": 0.001, "xLDiff": 0.001, "lDiff": 0.001, "mDiff": 0.001, "sDiff": 0.001,
+           "xLPulse": 0.02, "lPulse": 0.02, "mPulse": 0.02, "sPulse": 0.02, "xSPulse": 0.02,
+           "xLDelay": 0.01, "lDelay": 0.01, "mDelay": 0.01, "sDelay": 0.01, "xSDelay": 0.01}
+
+METHODS = ["grid", "random", "bayes"]
+BUDGET = 100
+GRID_POINTS = 3
+
+#scenarios per candidate and largest starting tilt in minutes
+RUNS = 20
+TILT = 1.0
+#95th percentile of overshoots per run allowed
+MAX_OVERSHOOTS = 2
+
+#added to the score of infeasible candidates
+INFEASIBLE = 1000.0
+
+#random candidates before the Gaussian process is used, and candidates scored by expected improvement per pick
+BAYES_START = 10
+BAYES_CANDIDATES = 2000
+
+
+#random starting tilts (pitch, roll) and simulator seeds shared by all candidates
+def scenarios(runs=RUNS, tilt=TILT, seed=0):
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform(-tilt, tilt, (runs, 2))
+    return [(float(pitch), float(roll), seed * runs + i) for i, (pitch, roll) in enumerate(starts)]
+
+
+#levels the simulated rig once from every scenario with the given preset values
+#returns a list of (outcome, seconds, overshoots), run in the worker processes
+def evaluate(settingsFile, rigName, levelName, values, model, runs, timeOut=TIME_OUT):
+    results = []
+    for pitch, roll, seed in runs:
+        clock = SimClock()
+        rig = Rig(settingsFile, rigName, levelName, sim = dict(model, pitch = pitch, roll = roll, seed = seed),
+                  clock = clock, timeOut = timeOut)
+        rig.settings.setPresetValues(values)
+        rig.setZero(0.0, 0.0)
+
+        lastDirection = {}
+        overshoots = 0
+        finish = {}
+
+        def onEvent(event, data):
+            nonlocal overshoots
+            if event == "pulse":
+                previous = lastDirection.get(data["axis"])
+                if previous is not None and previous != data["direction"]:
+                    overshoots += 1
+                lastDirection[data["axis"]] = data["direction"]
+            elif event == "finish":
+                finish.update(data)
+
+        rig.leveler.addListener(onEvent)
+        rig.leveler.autoLevel()
+        rig.close()
+        results.append((finish["outcome"], finish["elapsed"], overshoots))
+    return results
+
+
+#returns summary dictionary of evaluate() results, lower score is better
+def score(results, timeOut=TIME_OUT, maxOvershoots=MAX_OVERSHOOTS):
+    seconds = np.array([elapsed if outcome == DONE else max(elapsed, timeOut) for outcome, elapsed, _ in results])
+    overshoots = np.array([count for _, _, count in results])
+    timeouts = sum(outcome != DONE for outcome, _, _ in results)
+    median = float(np.median(seconds))
+    p95 = float(np.percentile(seconds, 95))
+    feasible = timeouts == 0 and np.percentile(overshoots, 95) <= maxOvershoots
+    return {"score": median + p95 + (0.0 if feasible else INFEASIBLE),
+            "median": median,
+            "p95": p95,
+            "timeouts": int(timeouts),
+            "overshoots": float(np.percentile(overshoots, 95)),
+            "feasible": bool(feasible)}
+
+
+class Space:
+    #maps points in the unit cube onto preset values for the searched settings
+    #baseline is a preset dictionary from Settings.getPreset()
+    def __init__(self, baseline, names=PARAMETERS, span=SEARCH_RANGE):
+        for name in names:
+            if name not in PARAMETERS:
+                raise ValueError(f"Cannot search {name}, choose from {', '.join(PARAMETERS)}")
+        self.baseline = baseline
+        self.names = list(names)
+        self.bounds = []
+        for name in self.names:
+            value = max(baseline[name], MINIMUM[name])
+            self.bounds.append((math.log(max(value / span, MINIMUM[name])), math.log(value * span)))
+
+    #returns preset values for a point, thresholds are put back in order
+    def values(self, point):
+        values = {name: baseline for name, baseline in self.baseline.items()}
+        for name, x, (low, high) in zip(self.names, point, self.bounds):
+            values[name] = round(math.exp(low + float(x) * (high - low)), 4)
+
+        diffs = sorted((values[name] for name in DIFFS), reverse = True)
+        values.update(zip(DIFFS, diffs))
+        values["sens2"] = max(values["sens2"], values["sens1"] * 1.5)
+        return values
+
+    #point of the current preset
+    def origin(self):
+        point = []
+        for name, (low, high) in zip(self.names, self.bounds):
+            value = max(self.baseline[name], MINIMUM[name])
+            point.append(min(1.0, max(0.0, (math.log(value) - low) / (high - low))))
+        return np.array(point)
+
+    #every combination of points values of each setting, raises ValueError if there are more than budget
+    def grid(self, points=GRID_POINTS, budget=None):
+        count = points ** len(self.names)
+        if budget is not None and count > budget:
+            raise ValueError(f"grid of {points} values for {len(self.names)} settings is {count} candidates, more than "
+                             f"the budget of {budget}, search fewer settings with --params or raise --budget")
+        axes = np.meshgrid(*([np.linspace(0, 1, points)] * len(self.names)), indexing = "ij")
+        return np.stack([axis.ravel() for axis in axes], axis = 1)
+
+
+#Gaussian process posterior mean and standard deviation at points, RBF kernel on the unit cube
+def predict(x, y, points, length=0.3, noise=1e-4):
+    def kernel(a, b):
+        d = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis = 2)
+        return np.exp(-0.5 * d / length ** 2)
+
+    scale = y.std() or 1.0
+    normal = (y - y.mean()) / scale
+    k = kernel(x, x) + noise * np.eye(len(x))
+    chol = np.linalg.cholesky(k)
+    alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, normal))
+    ks = kernel(points, x)
+    mean = ks @ alpha
+    v = np.linalg.solve(chol, ks.T)
+    std = np.sqrt(np.maximum(1.0 - (v ** 2).sum(axis = 0), 1e-12))
+    return mean * scale + y.mean(), std * scale
+
+
+#expected improvement below best
+def expectedImprovement(mean, std, best):
+    z = (best - mean) / std
+    cdf = 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+    pdf = np.exp(-0.5 * z ** 2) / math.sqrt(2 * math.pi)
+    return (best - mean) * cdf + std * pdf
+
+
+class Optimizer:
+    #initializes search for the rig and level preset in settingsFile
+    #model is a dictionary of Simulator.SimRig actuator keyword arguments (rate, deadTime, coast, backlash, noise)
+    def __init__(self, settingsFile, rigName, levelName, model=None, names=PARAMETERS, runs=RUNS, tilt=TILT, seed=0,
+                 timeOut=TIME_OUT, maxOvershoots=MAX_OVERSHOOTS, workers=None):
+        self.settingsFile = settingsFile
+        self.rigName = rigName
+        self.levelName = levelName
+        self.model = model or {}
+        self.runs = scenarios(runs, tilt, seed)
+        self.timeOut = timeOut
+        self.maxOvershoots = maxOvershoots
+        self.workers = workers or os.cpu_count()
+        self.rng = np.random.default_rng(seed)
+
+        settings = Settings(settingsFile)
+        settings.setSettings()
+        self.baseline = settings.getPreset(rigName, levelName)
+        self.space = Space(self.baseline, names or PARAMETERS)
+
+        #(point, values, summary) of every evaluated candidate
+        self.history = []
+
+    #scores points in the process pool, returns their summaries
+    #candidates are the preset values of the points, found with Space.values() if None
+    def evaluatePoints(self, pool, points, candidates=None):
+        if candidates is None:
+            candidates = [self.space.values(point) for point in points]
+        futures = [pool.submit(evaluate, self.settingsFile, self.rigName, self.levelName, values, self.model,
+                               self.runs, self.timeOut) for values in candidates]
+        summaries = []
+        for point, values, future in zip(points, candidates, futures):
+            summary = score(future.result(), self.timeOut, self.maxOvershoots)
+            self.history.append((np.array(point), values, summary))
+            summaries.append(summary)
+        return summaries
+
+    #runs the search, returns report()
+    def run(self, method="bayes", budget=BUDGET, gridPoints=GRID_POINTS):
+        if method not in METHODS:
+            raise ValueError(f"Unknown method {method}, choose from {', '.join(METHODS)}")
+
+        #checked before any worker starts, a full grid may not even fit in memory
+        grid = self.space.grid(gridPoints, budget) if method == "grid" else None
+
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+            #current preset first so it is always compared on the same scenarios
+            self.evaluatePoints(pool, [self.space.origin()], [dict(self.baseline)])
+
+            if method == "grid":
+                self.evaluatePoints(pool, grid)
+            elif method == "random":
+                self.evaluatePoints(pool, self.rng.random((budget, len(self.space.names))))
+            else:
+                start = min(BAYES_START, budget)
+                self.evaluatePoints(pool, self.rng.random((start, len(self.space.names))))
+                remaining = budget - start
+                while remaining > 0:
+                    batch = min(self.workers, remaining)
+                    self.evaluatePoints(pool, self.nextPoints(batch))
+                    remaining -= batch
+        return self.report()
+
+    #picks batch points by expected improvement, each pick is added to the model at its predicted score
+    def nextPoints(self, batch):
+        x = np.array([point for point, _, _ in self.history])
+        y = np.array([summary["score"] for _, _, summary in self.history])
+        picks = []
+        for _ in range(batch):
+            candidates = self.rng.random((BAYES_CANDIDATES, len(self.space.names)))
+            mean, std = predict(x, y, candidates)
+            best = int(np.argmax(expectedImprovement(mean, std, y.min())))
+            picks.append(candidates[best])
+            x = np.vstack([x, candidates[best]])
+            y = np.append(y, mean[best])
+        return picks
+
+    #best candidate compared with the current preset
+    def report(self):
+        baseline = self.history[0]
+        best = min(self.history, key = lambda entry: entry[2]["score"])
+        changes = {name: (self.baseline[name], best[1][name]) for name in PRESET_COLUMNS
+                   if self.baseline[name] != best[1][name]}
+        return {"rig": self.rigName,
+                "level": self.levelName,
+                "evaluations": len(self.history),
+                "runs": len(self.runs),
+                "baseline": baseline[2],
+                "candidate": best[2],
+                "values": best[1],
+                "changes": changes,
+                "row": presetRow(self.rigName, self.levelName, best[1])}
+
+
+#settings.csv row for a preset
+def presetRow(rigName, levelName, values):
+    row = [""] * (max(PRESET_COLUMNS.values()) + 1)
+    row[RIG] = rigName
+    row[LEVEL] = levelName
+    for name, column in PRESET_COLUMNS.items():
+        value = values[name]
+        row[column] = str(int(value)) if name in ("rollInvert", "pitchInvert") else f"{value:g}"
+    return row
+
+
+#writes a copy of settingsFile to path with the preset row replaced
+def writeSettings(settingsFile, path, row):
+    with open(settingsFile) as f:
+        rows = list(csv.reader(f))
+    for r in range(2, len(rows)):
+        if rows[r][RIG] == row[RIG] and rows[r][LEVEL] == row[LEVEL]:
+            rows[r][:len(row)] = row
+            break
+    else:
+        raise ValueError(f"No preset for {row[RIG]}, {row[LEVEL]} in {settingsFile}")
+    with open(path, "w", newline = "") as f:
+        csv.writer(f).writerows(rows)
+
+
+#returns report() as printable text
+def formatReport(report):
+    def cell(value):
+        return str(value) if isinstance(value, (bool, int)) else f"{value:.2f}"
+
+    lines = [f"{report['rig']}, {report['level']}: {report['evaluations']} candidates x {report['runs']} runs",
+             f"{'':14} {'current':>9} {'candidate':>9}"]
+    for key, label in (("median", "median s"), ("p95", "p95 s"), ("timeouts", "timeouts"),
+                       ("overshoots", "p95 overshoot"), ("feasible", "feasible")):
+        lines.append(f"{label:14} {cell(report['baseline'][key]):>9} {cell(report['candidate'][key]):>9}")
+    if report["changes"]:
+        lines.append("changes:")
+    for name, (before, after) in report["changes"].items():
+        lines.append(f"  {name:9} {before:>8g} -> {after:g}")
+    lines.append("settings.csv row:")
+    lines.append("  " + ",".join(report["row"]))
+    return "\n".join(lines)
@@ -0,0 +1,139 @@
+# Oscillation.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# Oscillation.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# A preset whose pulses move the rig further than the band it is aiming for hunts around zero: right, left, right,
+# left with errors of about the same size until autoLevel() times out. This page watches the error adapt() acted on
+# for each pulse and detects that limit cycle, and the Leveler responds for the rest of the run.
+#
+# An axis is hunting when its last WINDOW pulses all reversed direction and the error on each side of zero did not
+# shrink below SHRINK times the error on the same side one cycle earlier (a run that is converging has shrinking
+# errors, a limit cycle can be lopsided but repeats itself). Each detection takes the next step of
+# INTERVENTIONS for that axis and clears the window, so the next step needs a fresh cycle:
+#   halve   pulses of the axis are half as long
+#   settle  settle delays after pulses of the axis are twice as long
+#   widen   the sens1 band of the axis is BAND_STEP times wider
+# Halved pulses can end up shorter than the dead time of the actuator and no longer move the rig. When the last STALL
+# pulses of an axis with halved pulses went the same way and the error shrank by less than STALL_PROGRESS, the last
+# halving is undone ("grow") and the window is cleared, so hunting again goes on to the next step.
+# Every intervention is logged and reported to listeners as an "intervention" event, and all of them are undone at
+# the start of the next run.
+
+
+import logging
+
+log = logging.getLogger("autoleveler.oscillation")
+
+#pulses looked at
+WINDOW = 4
+
+#errors shrinking faster than this from one cycle to the next are converging
+SHRINK = 0.7
+
+#same direction pulses looked at for a stall, and the part of the error they must take out
+STALL = 3
+STALL_PROGRESS = 0.1
+
+#steps taken on each detection, the last one is repeated
+INTERVENTIONS = ("halve", "halve", "settle", "halve", "widen")
+
+#factor each widen step multiplies sens1 by, and the widest band allowed
+BAND_STEP = 1.5
+MAX_BAND = 3.0
+
+
+class AxisMonitor:
+    def __init__(self):
+        #(sign, absolute error) of recent pulses
+        self.window = []
+        self.detections = 0
+        self.pulseScale = 1.0
+        self.delayScale = 1.0
+        self.bandScale = 1.0
+
+    #adds the signed error of a pulse, returns "hunting", "stalled" or None
+    def observe(self, difference):
+        self.window = (self.window + [(1 if difference > 0 else -1, abs(difference))])[-max(WINDOW, STALL):]
+        signs = [sign for sign, size in self.window]
+        sizes = [size for sign, size in self.window]
+
+        if self.pulseScale < 1 and len(self.window) >= STALL:
+            if len(set(signs[-STALL:])) == 1 and sizes[-1] > (1 - STALL_PROGRESS) * sizes[-STALL]:
+                return "stalled"
+
+        if len(self.window) < WINDOW:
+            return None
+        signs = signs[-WINDOW:]
+        sizes = sizes[-WINDOW:]
+        alternating = all(a == -b for a, b in zip(signs, signs[1:]))
+        if alternating and all(size > SHRINK * before for before, size in zip(sizes, sizes[2:])):
+            return "hunting"
+        return None
+
+    #undoes the last halving, returns "grow"
+    def grow(self):
+        self.window = []
+        self.pulseScale *= 2
+        return "grow"
+
+    #takes the next intervention step, returns its name
+    def intervene(self):
+        action = INTERVENTIONS[min(self.detections, len(INTERVENTIONS) - 1)]
+        self.detections += 1
+        self.window = []
+        if action == "halve":
+            self.pulseScale /= 2
+        elif action == "settle":
+            self.delayScale *= 2
+        elif action == "widen":
+            if self.bandScale * BAND_STEP > MAX_BAND:
+                #nothing left to widen, slow down instead
+                action = "settle"
+                self.delayScale *= 2
+            else:
+                self.bandScale *= BAND_STEP
+        return action
+
+
+class OscillationMonitor:
+    def __init__(self):
+        self.reset()
+
+    #undoes every intervention, called when a run starts
+    def reset(self):
+        self.axes = {"pitch": AxisMonitor(), "roll": AxisMonitor()}
+
+    #adds the signed error adapt() is about to pulse for, returns the intervention taken or None
+    def observe(self, axis, difference):
+        monitor = self.axes[axis]
+        state = monitor.observe(difference)
+        if state is None:
+            return None
+        action = monitor.intervene() if state == "hunting" else monitor.grow()
+        log.warning("Oscillation on %s: %s", axis, action,
+                    extra = {"fields": {"pulseScale": monitor.pulseScale, "delayScale": monitor.delayScale,
+                                        "bandScale": monitor.bandScale}})
+        return action
+
+    def pulseScale(self, axis):
+        return self.axes[axis].pulseScale
+
+    def delayScale(self, axis):
+        return self.axes[axis].delayScale
+
+    def bandScale(self, axis):
+        return self.axes[axis].bandScale
@@ -0,0 +1,201 @@
+# Recorder.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Recorder.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines the telemetry recorder. Every sensor reading and relay pulse reported by the Leveler is written
+# as a fixed width binary record into a memory mapped ring of preallocated segment files:
+#
+#   recordings/segment-00.bin ... segment-15.bin
+#
+# Each segment holds a 64 byte header followed by SEGMENT_RECORDS records. When a segment is full the recorder
+# moves on to the next file, and after the last one it starts overwriting the oldest. Files are created once at full
+# size so the recorder never allocates or grows while running, and a write is a single struct.pack_into() into the
+# mapped page cache. Nothing is lost if the program exits without closing the recorder.
+#
+# Records (RECORD, 40 bytes little endian):
+#   t         time.time() of the reading, or of the relay turning on for pulses
+#   kind      SAMPLE or PULSE
+#   axis      PITCH or ROLL
+#   direction relay direction code for pulses (DIRECTIONS)
+#   bucket    pulse size code for pulses (BUCKETS)
+#   raw       ADC code for samples
+#   minutes   converted reading for samples, before the reading filters (Filters.py)
+#   zero      zero point at the time of the record
+#   duration  pulse on time in seconds
+#   delay     settle delay after the pulse in seconds
+#
+# load(directory) returns all records in time order as a NumPy structured array read through np.memmap.
+
+
+import mmap
+import os
+import struct
+
+import numpy as np
+
+SEGMENTS = 16
+SEGMENT_RECORDS = 1 << 20
+
+MAGIC = b'ALREC001'
+#magic, record size, capacity, sequence number, record count
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_SIZE = 64
+COUNT_OFFSET = 24
+
+RECORD = np.dtype([("t", "<f8"),
+                   ("kind", "u1"),
+                   ("axis", "u1"),
+                   ("direction", "u1"),
+                   ("bucket", "u1"),
+                   ("raw", "<u4"),
+                   ("minutes", "<f8"),
+                   ("zero", "<f8"),
+                   ("duration", "<f4"),
+                   ("delay", "<f4")])
+RECORD_STRUCT = struct.Struct('<dBBBBIddff')
+
+#record codes
+SAMPLE = 0
+PULSE = 1
+
+PITCH = 0
+ROLL = 1
+AXES = {"pitch": PITCH, "roll": ROLL}
+
+DIRECTIONS = {None: 0, "left": 1, "right": 2, "up": 3, "down": 4}
+BUCKETS = {None: 0, "XL": 1, "L": 2, "M": 3, "S": 4, "XS": 5}
+
+AXIS_NAMES = {code: name for name, code in AXES.items()}
+DIRECTION_NAMES = {code: name for name, code in DIRECTIONS.items()}
+BUCKET_NAMES = {code: name for name, code in BUCKETS.items()}
+
+
+def segmentPath(directory, index):
+    return os.path.join(directory, f"segment-{index:02d}.bin")
+
+
+class Recorder:
+    #initializes recorder writing to directory, segment files are created if needed
+    def __init__(self, directory, segments=SEGMENTS, capacity=SEGMENT_RECORDS):
+        self.directory = directory
+        self.segments = segments
+        self.capacity = capacity
+        os.makedirs(directory, exist_ok = True)
+
+        self.file = None
+        self.map = None
+        self.index = 0
+        self.sequence = 0
+        self.count = 0
+
+        #continue after the newest existing segment
+        newest = None
+        for index in range(segments):
+            header = readHeader(segmentPath(directory, index))
+            if header is not None and header[1] == RECORD.itemsize and header[2] == capacity:
+                if newest is None or header[3] > newest[1]:
+                    newest = (index, header[3], header[4])
+        if newest is None:
+            self.open(0, 0)
+        else:
+            self.open(newest[0], newest[1], newest[2])
+
+    #maps segment index, a fresh segment is started unless count is given
+    def open(self, index, sequence, count=0):
+        self.close()
+        path = segmentPath(self.directory, index)
+        size = HEADER_SIZE + self.capacity * RECORD.itemsize
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.fstat(self.file.fileno()).st_size != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.index = index
+        self.sequence = sequence
+        self.count = count
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.itemsize, self.capacity, sequence, count)
+
+    def rotate(self):
+        self.open((self.index + 1) % self.segments, self.sequence + 1)
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+
+    def write(self, t, kind, axis, direction, bucket, raw, minutes, zero, duration, delay):
+        if self.count == self.capacity:
+            self.rotate()
+        RECORD_STRUCT.pack_into(self.map, HEADER_SIZE + self.count * RECORD_STRUCT.size,
+                                t, kind, axis, direction, bucket, raw, minutes, zero, duration, delay)
+        self.count += 1
+        struct.pack_into('<Q', self.map, COUNT_OFFSET, self.count)
+
+    def sample(self, t, axis, raw, minutes, zero):
+        self.write(t, SAMPLE, AXES[axis], 0, 0, raw, minutes, zero, 0.0, 0.0)
+
+    def pulse(self, t, axis, direction, bucket, zero, duration, delay):
+        self.write(t, PULSE, AXES[axis], DIRECTIONS[direction], BUCKETS[bucket], 0, 0.0, zero, duration, delay)
+
+    #Leveler listener
+    #clock provides the sample time stamps, the time module is used on the rig
+    def listener(self, clock):
+        def onEvent(event, data):
+            if event == "reading":
+                if data["measured"] is not None:
+                    self.sample(clock.time(), data["axis"], data["raw"], data["measured"], data["zero"])
+            elif event == "pulse":
+                self.pulse(data["start"], data["axis"], data["direction"], data["bucket"], data["zero"],
+                           data["pulse"], data["delay"])
+        return onEvent
+
+
+#returns (magic, record size, capacity, sequence, count) or None if path is not a segment file
+def readHeader(path):
+    try:
+        with open(path, "rb") as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if header[0] != MAGIC:
+        return None
+    return header
+
+
+#yields (sequence, records) for each segment in directory, oldest first
+#records is a read only np.memmap view of the filled part of the segment
+def segments(directory):
+    found = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        header = readHeader(path)
+        if header is not None and header[1] == RECORD.itemsize and header[4] > 0:
+            found.append((header[3], path, header[4]))
+    for sequence, path, count in sorted(found):
+        yield sequence, np.memmap(path, dtype = RECORD, mode = 'r', offset = HEADER_SIZE, shape = (count,))
+
+
+#returns all records in directory in time order
+def load(directory):
+    parts = [records for sequence, records in segments(directory)]
+    if not parts:
+        return np.zeros(0, dtype = RECORD)
+    return np.concatenate(parts)
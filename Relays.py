@@ -6,6 +6,8 @@
 # run_auto_leveler.py
 # Relays.py
 # Sensor.py
+# Timing.py
+# Buttons.py
 # Settings.py
 # settings.csv
 
@@ -15,9 +17,20 @@
 # control rig actuators.
 
 
-import RPi.GPIO as GPIO
+import logging
+import threading
 import time
 
+from Timing import PulseTimer
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    #not running on a Pi, a GPIO stand-in has to be passed to Relays (see Simulator.py)
+    GPIO = None
+
+log = logging.getLogger("autoleveler.relays")
+
 #default pulse used by control act function
 CONTROL_PULSE = 0.2
 
@@ -25,8 +38,19 @@ class Relays:
     #initializes relay object
     #parameters are pin numbers for actuator controls in the given order
     #instantiated as relays = Relays(LEFT_PIN, RIGHT_PIN, UP_PIN, DOWN_PIN) in run_auto_leveler.py
-    def __init__(self, left, right, up, down):
-        GPIO.setmode(GPIO.BCM)
+    #gpio replaces the RPi.GPIO module, it is used to drive a simulated rig
+    #clock must provide sleep(), the time module is used on the rig
+    #precise finishes every pulse with a short spin instead of relying on sleep() alone, see Timing.py
+    def __init__(self, left, right, up, down, gpio=None, clock=time, precise=False):
+        if gpio is None:
+            gpio = GPIO
+        if gpio is None:
+            raise RuntimeError("RPi.GPIO is not available")
+        self.GPIO = gpio
+        self.clock = clock
+        #times pulses and records the on time achieved
+        self.timer = PulseTimer(clock, precise)
+        self.GPIO.setmode(self.GPIO.BCM)
 
         #set pin variables
         self.left = left
@@ -36,8 +60,8 @@ class Relays:
         
         #TODO: not needed since invertRigSignal has been removed
         #self.outputInverted = False
-        self.on = GPIO.LOW
-        self.off = GPIO.HIGH
+        self.on = self.GPIO.LOW
+        self.off = self.GPIO.HIGH
         
         #set inverted indicators
         self.rollInverted = 0
@@ -48,35 +72,39 @@ class Relays:
         
         #set pause indicator
         self.pause = False
+        #set by stop() (the E-stop button, see Buttons.py), no relay is energized until the pause is removed
+        self.halted = False
+        #stop() may run on an interrupt thread while a pulse is under way
+        self.lock = threading.Lock()
         
         self.stayOn = False
 
         #set up pin outputs with provided direction values
-        GPIO.setup(left,GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(right,GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(up,GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(down,GPIO.OUT, initial=GPIO.HIGH)
+        self.GPIO.setup(left,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.GPIO.setup(right,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.GPIO.setup(up,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.GPIO.setup(down,self.GPIO.OUT, initial=self.GPIO.HIGH)
 
     #TODO: not needed since invertRigSignal has been removed
     def setLowOut(self):
-        print("switch")
-        GPIO.setup(self.left,GPIO.OUT, initial=GPIO.LOW)
-        GPIO.setup(self.right,GPIO.OUT, initial=GPIO.LOW)
-        GPIO.setup(self.up,GPIO.OUT, initial=GPIO.LOW)
-        GPIO.setup(self.down,GPIO.OUT, initial=GPIO.LOW)
+        log.debug("switch")
+        self.GPIO.setup(self.left,self.GPIO.OUT, initial=self.GPIO.LOW)
+        self.GPIO.setup(self.right,self.GPIO.OUT, initial=self.GPIO.LOW)
+        self.GPIO.setup(self.up,self.GPIO.OUT, initial=self.GPIO.LOW)
+        self.GPIO.setup(self.down,self.GPIO.OUT, initial=self.GPIO.LOW)
         self.outPutInverted = True
-        self.on = GPIO.HIGH
-        self.off = GPIO.LOW
+        self.on = self.GPIO.HIGH
+        self.off = self.GPIO.LOW
     
     #TODO: not needed since invertRigSignal has been removed
     def setHighOut(self):
-        print("switch")
-        GPIO.setup(self.left,GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(self.right,GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(self.up,GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(self.down,GPIO.OUT, initial=GPIO.HIGH)
-        self.on = GPIO.LOW
-        self.off = GPIO.HIGH
+        log.debug("switch")
+        self.GPIO.setup(self.left,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.GPIO.setup(self.right,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.GPIO.setup(self.up,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.GPIO.setup(self.down,self.GPIO.OUT, initial=self.GPIO.HIGH)
+        self.on = self.GPIO.LOW
+        self.off = self.GPIO.HIGH
         self.outPutInverted = False
 
     #switches up and down pins and sets or resets pitchInverted indicator
@@ -111,7 +139,22 @@ class Relays:
         return self.pause
     
     def setPause(self, boolVar):
-        self.pause = boolVar
+        with self.lock:
+            self.pause = boolVar
+            if not boolVar:
+                self.halted = False
+
+    #pauses and turns every relay off at once, from any thread. Pulses under way are cut short and no relay turns
+    #on again until the pause is removed
+    def stop(self):
+        with self.lock:
+            self.pause = True
+            self.halted = True
+            for pin in (self.left, self.right, self.up, self.down):
+                self.GPIO.output(pin, self.off)
+
+    def isHalted(self):
+        return self.halted
         
     def getStayOn(self):
         return self.stayOn
@@ -121,9 +164,26 @@ class Relays:
 
     #Triggers actuators by activating relays for given pulse time
     def moveAct(self,act,pulseSpeed):
-        GPIO.output(act, self.on)
-        time.sleep(pulseSpeed)
-        GPIO.output(act, self.off)
+        if not self.energize(act):
+            return
+        start = self.timer.now()
+        self.timer.sleep(pulseSpeed)
+        self.release(act)
+        #a pulse cut short by stop() is not a timing error
+        if not self.halted:
+            self.timer.add(pulseSpeed, self.timer.now() - start)
+
+    #turns relay on and leaves it on until release() is called, used by continuous drive (see Drive.py)
+    #returns False and leaves the relay off after stop()
+    def energize(self, act):
+        with self.lock:
+            if self.halted:
+                return False
+            self.GPIO.output(act, self.on)
+            return True
+
+    def release(self, act):
+        self.GPIO.output(act, self.off)
         
     def moveLeft(self, pulse):
         self.moveAct(self.left, pulse)
@@ -137,4 +197,8 @@ class Relays:
     def moveDown(self, pulse):
         self.moveAct(self.down, pulse)
 
+    #releases GPIO pins on exit
+    def cleanup(self):
+        self.GPIO.cleanup()
+
 
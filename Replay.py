@@ -0,0 +1,179 @@
+# Replay.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Recorder.py
+# Replay.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page replays recorded sessions (see Recorder.py) through the adapt() pulse selection offline, so settings.csv
+# changes can be checked against field data instead of on a live rig.
+#
+# Every recorded pulse is a decision point: the reading adapt() acted on is the last sample of the same axis before
+# the relay turned on. Recordings hold readings from before the reading filters (Filters.py), so with a filtered preset
+# the error is the last measured reading rather than the filtered one. At each decision point the candidate preset
+# decides what it would have done with the same error, using the same thresholds as Leveler.selectBucket():
+#   - no pulse if the error is already inside the candidate's sens1
+#   - otherwise the bucket from the xL/l/m/sDiff thresholds and that bucket's pulse and delay
+# The candidate is compared against the pulses that were actually recorded, or against a second preset when a
+# baseline is given. Everything is done with NumPy on whole arrays so months of data replay in seconds, and the
+# result only depends on the recording and the presets.
+#
+# Usage:
+#   python -m autoleveler replay recordings --rig Midload --level T-Level
+#   python -m autoleveler replay recordings --rig Midload --level T-Level --settings new.csv --since 2023-06-01
+
+
+import numpy as np
+
+import Recorder
+from Recorder import PULSE, SAMPLE, PITCH, ROLL, BUCKETS, BUCKET_NAMES, DIRECTIONS, AXIS_NAMES
+from Leveler import BUCKET_PULSE, BUCKET_DELAY
+
+#code used when a preset would not pulse
+NO_PULSE = 0
+
+#bucket order used by selectBuckets(), largest first
+BUCKET_ORDER = ["XL", "L", "M", "S", "XS"]
+
+
+#vectorized Leveler.selectBucket() plus the sens1 check, returns bucket codes (NO_PULSE inside sens1)
+#differences are absolute errors, preset is a dictionary from Settings.getPreset()
+def selectBuckets(differences, preset):
+    xL, l, m, s = preset["xLDiff"], preset["lDiff"], preset["mDiff"], preset["sDiff"]
+    codes = np.select([differences > xL,
+                       (differences <= xL) & (differences > l),
+                       (differences <= l) & (differences > m),
+                       (differences <= m) & (differences > s),
+                       differences <= s],
+                      [BUCKETS[name] for name in BUCKET_ORDER],
+                      NO_PULSE)
+    codes[differences < preset["sens1"]] = NO_PULSE
+    return codes.astype(np.uint8)
+
+
+#returns pulse and delay seconds for bucket codes under preset
+def bucketTimes(codes, preset):
+    pulses = np.zeros(len(codes))
+    delays = np.zeros(len(codes))
+    for name in BUCKET_ORDER:
+        mask = codes == BUCKETS[name]
+        pulses[mask] = preset[BUCKET_PULSE[name]]
+        delays[mask] = preset[BUCKET_DELAY[name]]
+    return pulses, delays
+
+
+#finds decision points in records, returns dictionary of arrays
+#keys: t, axis, error, bucket, duration, delay, direction (the recorded pulse)
+def decisions(records):
+    pulses = records[records["kind"] == PULSE]
+    error = np.full(len(pulses), np.nan)
+    for axis in (PITCH, ROLL):
+        samples = records[(records["kind"] == SAMPLE) & (records["axis"] == axis)]
+        mask = pulses["axis"] == axis
+        if not len(samples) or not mask.any():
+            continue
+        #last sample of this axis before each pulse started
+        index = np.searchsorted(samples["t"], pulses["t"][mask], side = "right") - 1
+        found = index >= 0
+        values = np.full(mask.sum(), np.nan)
+        values[found] = samples["minutes"][index[found]] - samples["zero"][index[found]]
+        error[mask] = values
+
+    keep = ~np.isnan(error)
+    return {"t": pulses["t"][keep],
+            "axis": pulses["axis"][keep],
+            "error": error[keep],
+            "bucket": pulses["bucket"][keep],
+            "duration": pulses["duration"][keep].astype(float),
+            "delay": pulses["delay"][keep].astype(float),
+            "direction": pulses["direction"][keep]}
+
+
+#direction codes adapt() would use for signed errors
+def directionsFor(axis, error):
+    positive = np.where(axis == ROLL, DIRECTIONS["right"], DIRECTIONS["up"])
+    negative = np.where(axis == ROLL, DIRECTIONS["left"], DIRECTIONS["down"])
+    return np.where(error > 0, positive, negative).astype(np.uint8)
+
+
+#decisions a preset would make at the decision points, same keys as decisions()
+def decide(points, preset):
+    codes = selectBuckets(np.abs(points["error"]), preset)
+    duration, delay = bucketTimes(codes, preset)
+    direction = np.where(codes == NO_PULSE, 0, directionsFor(points["axis"], points["error"])).astype(np.uint8)
+    return dict(points, bucket = codes, duration = duration, delay = delay, direction = direction)
+
+
+#replays records through candidate preset, compared against baseline preset or the recorded pulses if baseline is None
+#since and until limit the replay to a time range (time.time() values)
+def replay(records, candidate, baseline=None, since=None, until=None):
+    if since is not None:
+        records = records[records["t"] >= since]
+    if until is not None:
+        records = records[records["t"] < until]
+
+    points = decisions(records)
+    before = points if baseline is None else decide(points, baseline)
+    after = decide(points, candidate)
+
+    differs = (before["bucket"] != after["bucket"]) | (before["direction"] != after["direction"])
+    report = {"decisions": len(points["t"]),
+              "differences": int(differs.sum()),
+              "skipped": int(((after["bucket"] == NO_PULSE) & (before["bucket"] != NO_PULSE)).sum()),
+              "added": int(((after["bucket"] != NO_PULSE) & (before["bucket"] == NO_PULSE)).sum()),
+              "relaySeconds": (float(before["duration"].sum()), float(after["duration"].sum())),
+              "settleSeconds": (float(before["delay"].sum()), float(after["delay"].sum())),
+              "buckets": {},
+              "changes": []}
+
+    for name in BUCKET_ORDER + [None]:
+        code = BUCKETS[name] if name is not None else NO_PULSE
+        report["buckets"][name or "none"] = (int((before["bucket"] == code).sum()), int((after["bucket"] == code).sum()))
+
+    for i in np.flatnonzero(differs):
+        report["changes"].append({"t": float(points["t"][i]),
+                                  "axis": AXIS_NAMES[int(points["axis"][i])],
+                                  "error": float(points["error"][i]),
+                                  "before": (BUCKET_NAMES.get(int(before["bucket"][i])), float(before["duration"][i])),
+                                  "after": (BUCKET_NAMES.get(int(after["bucket"][i])), float(after["duration"][i]))})
+    return report
+
+
+#replays a recording directory, see replay()
+def replayDirectory(directory, candidate, baseline=None, since=None, until=None):
+    return replay(Recorder.load(directory), candidate, baseline, since, until)
+
+
+#returns report as printable text, at most show individual changes are listed
+def formatReport(report, show=20):
+    lines = [f"decision points: {report['decisions']}",
+             f"differ:          {report['differences']}",
+             f"  not pulsed:    {report['skipped']}",
+             f"  newly pulsed:  {report['added']}",
+             "relay on time:   {:.2f} s -> {:.2f} s".format(*report["relaySeconds"]),
+             "settle time:     {:.2f} s -> {:.2f} s".format(*report["settleSeconds"]),
+             "pulses by size:"]
+    for name, (before, after) in report["buckets"].items():
+        lines.append(f"  {name:5} {before:8} -> {after}")
+    if report["changes"]:
+        lines.append("changes:")
+    for change in report["changes"][:show]:
+        lines.append("  t={t:.3f} {axis:5} error={error:+.4f}  {b[0]} {b[1]:.3f}s -> {a[0]} {a[1]:.3f}s".format(
+            b = change["before"], a = change["after"], **change))
+    if len(report["changes"]) > show:
+        lines.append(f"  ... {len(report['changes']) - show} more")
+    return "\n".join(lines)
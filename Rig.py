@@ -0,0 +1,182 @@
+# Rig.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# Backends.py
+# Backlash.py
+# Buttons.py
+# Coupling.py
+# Drive.py
+# Recorder.py
+# Rig.py
+# Relays.py
+# SessionDB.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines the hardware settings shared by the GUI and the headless entry point, and the Rig class which
+# builds the ADC, Sensor, Relays, Settings and Leveler objects for one rig without any GUI packages.
+
+
+import time
+
+from Backends import loadHardware, openADC, openRelayOutput
+from Sensor import Sensor, withRedundant
+from Relays import Relays
+from Settings import Settings
+from Leveler import Leveler, TIME_OUT, MAX_AGE
+from Estimator import Estimator
+from Backlash import BacklashLearner
+from Recorder import Recorder
+from SessionDB import SessionDB
+from Coupling import CouplingLearner
+from Drive import ContinuousDrive
+from Buttons import Buttons, BUTTONS
+
+SETTINGS_FILE = "settings.csv"
+
+#GPIO PINS - BCM
+LEFT_PIN = 16
+RIGHT_PIN = 12
+UP_PIN = 20
+DOWN_PIN = 21
+
+
+class Rig:
+    #initializes rig objects
+    #rigName and levelName select a preset from settings.csv, the last used preset is kept if they are None
+    #sim is a dictionary of Simulator.SimRig keyword arguments, the hardware is used if it is None
+    #hardware is a Backends.loadHardware() configuration selecting the relay and ADC backends, port replaces its
+    #serial port if given. Without it the Pi defaults are used (RPi.GPIO, serial ADC on port)
+    #record is a directory for Recorder.py telemetry, nothing is recorded if it is None
+    #history is a SessionDB.py database path for run summaries by operator, no history is kept if it is None
+    #estimate turns on the Estimator.py Kalman filters, model is the SysId.py actuator model they and the backlash
+    #take-up times (see Backlash.py) start from
+    #learnCoupling updates the preset's cross axis coupling in settings.csv after every run (see Coupling.py)
+    #continuous replaces XL pulses with continuous drive, its coast starts from model too (see Drive.py)
+    #maxAge is the age in seconds up to which the Leveler reuses a reading between pulses, 0 turns reuse off
+    #precise finishes relay pulses with a short spin for accurate on times (see Timing.py)
+    #E-stop and jog buttons are read when the buttons section of hardware gives them pins (see Buttons.py)
+    def __init__(self, settingsFile=SETTINGS_FILE, rigName=None, levelName=None, port=None,
+                 pins=(LEFT_PIN, RIGHT_PIN, UP_PIN, DOWN_PIN), sim=None, clock=time, timeOut=TIME_OUT, record=None,
+                 history=None, operator=None, estimate=False, model=None, learnCoupling=False,
+                 continuous=False, maxAge=MAX_AGE, hardware=None,
+                 precise=False):
+        #initialze settings
+        self.settings = Settings(settingsFile)
+        self.settings.setSettings()
+        if rigName is not None or levelName is not None:
+            self.settings.usePreset(rigName, levelName)
+
+        pitchCal = (self.settings.getSetting("pitchRaw"), self.settings.getSetting("pitchCalc"))
+        rollCal = (self.settings.getSetting("rollRaw"), self.settings.getSetting("rollCalc"))
+        order = self.settings.getSetting("order")
+
+        #initialize ADC and relays
+        if hardware is None:
+            hardware = loadHardware(None)
+        if port is not None:
+            hardware["adc"] = dict(hardware["adc"], port = port)
+        if "pins" in hardware["relays"]:
+            pins = tuple(hardware["relays"]["pins"])
+        if sim is None and hardware["adc"]["transport"] == "sim":
+            sim = {}
+
+        #calibration tables of the redundant sensors the simulator answers for (see Sensor.withRedundant())
+        sensors = hardware.get("sensors", {})
+        calibration = {"pitch": pitchCal, "roll": rollCal}
+        channels = {entry["channel"].encode(): (axis, (entry.get("raw", calibration[axis][0]),
+                                                       entry.get("minutes", calibration[axis][1])))
+                    for axis in calibration for entry in sensors.get(axis, [])}
+
+        if sim is None:
+            self.ADC = openADC(hardware["adc"])
+            self.sim = None
+            self.relays = Relays(*pins, gpio = openRelayOutput(hardware["relays"], clock = clock),
+                                 clock = clock, precise = precise)
+        else:
+            from Simulator import SimRig
+            #wire the simulated actuators the way the preset's invert settings expect
+            left, right, up, down = pins
+            if self.settings.getSetting("rollInvert"):
+                left, right = right, left
+            if self.settings.getSetting("pitchInvert"):
+                up, down = down, up
+            self.sim = SimRig(pitchCal, rollCal, order, pins = (left, right, up, down), clock = clock,
+                              channels = channels, **sim)
+            self.ADC = self.sim
+            self.relays = Relays(*pins, gpio = openRelayOutput(hardware["relays"], self.sim, clock),
+                                 clock = clock, precise = precise)
+
+        self.syncInvert()
+
+        #initalize sensors, an axis with redundant sensors is read through a SensorArray (see Sensor.py)
+        self.pitch = withRedundant(Sensor("pitch", self.ADC, *pitchCal, self.settings.getSetting("data"), order,
+                                          clock = clock), sensors, clock)
+        self.roll = withRedundant(Sensor("roll", self.ADC, *rollCal, self.settings.getSetting("data"), order,
+                                         clock = clock), sensors, clock)
+
+        self.model = model
+        self.estimator = Estimator(clock, model) if estimate else None
+        self.backlash = BacklashLearner(model)
+        self.drive = ContinuousDrive(model) if continuous else None
+        self.leveler = Leveler(self.pitch, self.roll, self.relays, self.settings, clock = clock, timeOut = timeOut,
+                               estimator = self.estimator, backlash = self.backlash, drive = self.drive,
+                               maxAge = maxAge)
+
+        self.recorder = None
+        if record is not None:
+            self.recorder = Recorder(record)
+            self.leveler.addListener(self.recorder.listener(clock))
+
+        self.history = None
+        if history is not None:
+            self.history = SessionDB(history)
+            self.leveler.addListener(self.history.listener(self.settings, clock, operator))
+
+        if learnCoupling:
+            self.leveler.addListener(CouplingLearner(self.settings).listener)
+
+        self.buttons = None
+        buttons = hardware.get("buttons", {})
+        if any(buttons.get(name) is not None for name in BUTTONS):
+            self.buttons = Buttons(self.relays, buttons, self.settings, self.leveler)
+
+    #matches relay inversion to the current preset, same as updateSettingsDisplay() in the GUI
+    def syncInvert(self):
+        if self.settings.getSetting("rollInvert") != self.relays.isRollInverted():
+            self.relays.invertRoll()
+        if self.settings.getSetting("pitchInvert") != self.relays.isPitchInverted():
+            self.relays.invertPitch()
+
+    #switches rig and level preset without changing the last used preset in settings.csv
+    def usePreset(self, rigName, levelName):
+        self.settings.usePreset(rigName, levelName)
+        self.syncInvert()
+
+    #sets zero point in minutes, same as Set 0 in the GUI when both are 0
+    def setZero(self, pitchZero, rollZero):
+        self.pitch.zero = pitchZero
+        self.roll.zero = rollZero
+
+    #sets current position as zero, same as Save Zero in the GUI
+    def saveZero(self):
+        return self.pitch.saveZero(), self.roll.saveZero()
+
+    def close(self):
+        if self.buttons is not None:
+            self.buttons.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.history is not None:
+            self.history.close()
+        self.ADC.close()
+        self.relays.cleanup()
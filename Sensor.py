@@ -12,9 +12,21 @@
 
 # Overview:
 # This page defines helper functions for the sensor operations
+#
+# A Sensor reads one channel of the ADC. Larger rigs can carry redundant sensors on each axis (the "sensors" section
+# of hardware.json, see Backends.py): a SensorArray then stands in for the Sensor of the axis. It writes every channel
+# of the axis to the ADC in one query and waits READ_DELAY once for all the replies, so a sweep of N sensors takes
+# about as long as reading one. The replies carry no channel, so they can only be matched to the sensors by their
+# order when every sensor answered. A sweep with fewer replies than sensors is thrown away: the late replies are left
+# to arrive for READ_DELAY and discarded, and the channels are read one at a time, so the reply of each sensor is known
+# and only the sensors that really did not answer count as silent. That costs one READ_DELAY per sensor, only on
+# sweeps that came back short. The readings, less the mounting offset of each sensor measured by saveZero(), are
+# fused by fuse(): readings that disagree with the median of the others are outvoted and the rest are averaged with
+# the weight of each sensor. A sensor that is outvoted or silent for FAULT_AFTER sweeps in a row is logged and
+# getHealth() reports it.
 
+import logging
 import time
-from time import sleep
 import serial
 import numpy.polynomial.polynomial
 
@@ -32,37 +44,54 @@ PITCH = "pitch"
 ROLL_CHANNEL = b'x'
 PITCH_CHANNEL = b'y'
 
+#channel of the sensor of each axis
+CHANNELS = {ROLL: ROLL_CHANNEL, PITCH: PITCH_CHANNEL}
+
 READ_DELAY = 0.1
 
+#redundant sensors (SensorArray): a reading further from the median of its axis than the larger of TOLERANCE minutes
+#and OUTLIER_K scaled median absolute deviations is outvoted, a sensor outvoted or silent FAULT_AFTER sweeps in a row
+#is reported
+TOLERANCE = 0.01
+OUTLIER_K = 5.0
+FAULT_AFTER = 10
+
 e = "I\O Error"
 
+log = logging.getLogger("autoleveler.sensor")
+
 class Sensor:
     #initializes sensor objects
     #instatntiated as pitch = Sensor("pitch", 1, ADC)   roll = Sensor("roll", 0, ADC) in run_auto_leveler.py
     #parameters are sensor name, channel on ADC, and ADC object initialized in run_auto_leveler.py
-    def __init__(self, name, ADCinit, sensorVals, minutes, raw, order):
+    #clock must provide sleep(), the time module is used on the rig
+    #channel is the ADC channel character, the one of the axis (CHANNELS) unless given
+    def __init__(self, name, ADCinit, sensorVals, minutes, raw, order, clock=time, channel=None):
         #initalize sensor variables
         self.reading = 0
+        #last ADC code before calibration
+        self.rawReading = 0
         self.name = name
         self.zero = 0
         self.ADC = ADCinit
         self.raw = raw
+        self.clock = clock
         
-        if (name == ROLL):
-            self.channel = ROLL_CHANNEL
-        elif (name == PITCH):
-            self.channel = PITCH_CHANNEL
-        else:
-            print("Invalid Sensor Name")
+        if (name not in CHANNELS):
+            log.error("Invalid Sensor Name: %s", name)
             exit()
+        self.channel = channel if channel is not None else CHANNELS[name]
         
         self.sensorVals = sensorVals
         self.minutes = minutes
+        self.order = order
             
         self.coefficients = numpy.polynomial.polynomial.Polynomial.fit(
                 sensorVals, # raw values
                 minutes, # corresponding angle values to the raw values
                 order) # order of polynomial
+        #power series of the fit in raw ADC codes, converted once instead of on every reading
+        self.powerSeries = self.coefficients.convert().coef
         
         
     #returns string if print(sensor) is called
@@ -78,27 +107,32 @@ class Sensor:
             #receive value
             val = self.ADC.read()
             #wait for missed characters
-            sleep(READ_DELAY)
+            self.clock.sleep(READ_DELAY)
             #pick up remainders
             val_rem = self.ADC.inWaiting()
             val +=self.ADC.read(val_rem)
-            #decode value
-            val = int(val.decode())
-            #if valid
-            if (val>=MIN_ADC_VAL and val<=MAX_ADC_VAL):
-                
-                if(not self.raw):
-                    val = numpy.polynomial.polynomial.polyval(val, self.coefficients.convert().coef)
-
-                #store reading
-                self.reading = val
-                return self.reading
-            else:
-                print("Sensor read error")
-                exit()
+            return self.decode(val)
         except:
-            print("ERROR: No signal from sensor")
-    
+            log.warning("ERROR: No signal from sensor %s", self.name)
+
+    #saves and returns the reading in an ADC reply, used by read() and by SensorArray for batched replies
+    def decode(self, val):
+        #decode value
+        val = int(val.decode())
+        #if valid
+        if (val>=MIN_ADC_VAL and val<=MAX_ADC_VAL):
+            self.rawReading = val
+
+            if(not self.raw):
+                val = numpy.polynomial.polynomial.polyval(val, self.powerSeries)
+
+            #store reading
+            self.reading = val
+            return self.reading
+        else:
+            log.error("Sensor read error: %s out of range", val)
+            exit()
+
     def saveZero(self):
         #initialize sum variables
         sum = 0
@@ -106,7 +140,7 @@ class Sensor:
         for i in range(0,AVG_SAMPLES):
             self.read()
             sum = sum + self.reading
-            time.sleep(AVG_DELAY)
+            self.clock.sleep(AVG_DELAY)
         #set zero
         self.zero = sum /AVG_SAMPLES
         
@@ -131,3 +165,257 @@ class Sensor:
 
     
     
+
+
+class SensorArray:
+    #redundant sensors of one axis read together and fused into one reading, used by the Leveler like a Sensor
+    #sensors are Sensor objects of the same axis on the same ADC, the first is the primary: readings are given on its
+    #calibration scale and the GUI plots its calibration. weights weigh each sensor in the fused average and offsets
+    #(minutes) are the mounting offset of each sensor from the primary, saveZero() measures them again
+    #batch queries every channel in one sweep, otherwise the channels are read one after another
+    def __init__(self, sensors, weights=None, offsets=None, batch=True, clock=time):
+        self.sensors = sensors
+        primary = sensors[0]
+        self.name = primary.name
+        self.ADC = primary.ADC
+        self.raw = primary.raw
+        self.clock = clock
+        self.batch = batch
+        self.weights = list(weights) if weights is not None else [1.0] * len(sensors)
+        self.offsets = list(offsets) if offsets is not None else [0.0] * len(sensors)
+        self.reading = 0
+        self.rawReading = 0
+        self.zero = 0
+        #last reading of each sensor after its offset, None if it did not answer
+        self.readings = [None] * len(sensors)
+        #sweeps in a row each sensor was outvoted or silent, and the totals
+        self.faults = [0] * len(sensors)
+        self.outvoted = [0] * len(sensors)
+        self.silent = [0] * len(sensors)
+        self.sweeps = 0
+
+    #returns the reading of every sensor in one query of all channels, None for a sensor that did not answer
+    #a short sweep is read again channel by channel, see the overview
+    def sweep(self):
+        if not self.batch:
+            return self.readEach()
+        count = len(self.sensors)
+        try:
+            self.ADC.write(b"".join(sensor.channel for sensor in self.sensors))
+            val = self.ADC.read()
+            #one wait for every reply instead of one per channel
+            self.clock.sleep(READ_DELAY)
+            val += self.ADC.read(self.ADC.inWaiting())
+            waited = 0.0
+            while completeReplies(val) < count and waited < READ_DELAY:
+                self.clock.sleep(READ_DELAY / 10)
+                waited += READ_DELAY / 10
+                val += self.ADC.read(self.ADC.inWaiting())
+        except:
+            log.warning("ERROR: No signal from sensors %s", self.name)
+            return [None] * count
+
+        replies = val.split()[:completeReplies(val)]
+        if len(replies) < count:
+            log.info("Short sweep of %s, %d of %d replies, reading each channel", self.name, len(replies), count)
+            self.clock.sleep(READ_DELAY)
+            self.ADC.read(self.ADC.inWaiting())
+            return self.readEach()
+        values = []
+        for sensor, reply in zip(self.sensors, replies):
+            try:
+                values.append(sensor.decode(reply))
+            except:
+                values.append(None)
+        return values
+
+    #reads the sensors one channel at a time
+    def readEach(self):
+        return [sensor.read() for sensor in self.sensors]
+
+    #Saves the fused reading of one sweep
+    def read(self):
+        values = self.sweep()
+        self.sweeps += 1
+        self.readings = [None if value is None else value - offset for value, offset in zip(values, self.offsets)]
+        fused, outvoted = fuse(self.readings, self.weights)
+
+        for i, sensor in enumerate(self.sensors):
+            bad = self.readings[i] is None or i in outvoted
+            if self.readings[i] is None:
+                self.silent[i] += 1
+            elif i in outvoted:
+                self.outvoted[i] += 1
+            self.faults[i] = self.faults[i] + 1 if bad else 0
+            if self.faults[i] == FAULT_AFTER:
+                log.warning("Sensor %s on channel %s disagrees or is silent, left out of the %s reading",
+                            i, sensor.channel.decode(), self.name)
+
+        if fused is None:
+            log.warning("ERROR: No signal from sensor %s", self.name)
+            return None
+        self.rawReading = self.sensors[0].rawReading
+        self.reading = fused
+        return self.reading
+
+    #averages AVG_SAMPLES sweeps, measures the offset of every sensor from the primary and sets the fused zero
+    def saveZero(self):
+        sums = [0.0] * len(self.sensors)
+        counts = [0] * len(self.sensors)
+        sweeps = []
+        for i in range(0,AVG_SAMPLES):
+            values = self.sweep()
+            sweeps.append(values)
+            for j, value in enumerate(values):
+                if value is not None:
+                    sums[j] += value
+                    counts[j] += 1
+            self.clock.sleep(AVG_DELAY)
+        if counts[0]:
+            primary = sums[0] / counts[0]
+            self.offsets = [sums[j] / counts[j] - primary if counts[j] else self.offsets[j]
+                            for j in range(len(self.sensors))]
+
+        fused = [fuse([None if value is None else value - offset for value, offset in zip(values, self.offsets)],
+                      self.weights)[0] for values in sweeps]
+        fused = [value for value in fused if value is not None]
+        if fused:
+            self.reading = sum(fused) / len(fused)
+        self.zero = self.reading
+        return self.zero
+
+    def saveZero2(self):
+        self.zero = 0
+
+        return self.zero
+
+    def getZero(self):
+        return self.zero
+
+    def getDifference(self):
+        return self.zero - self.reading
+
+    def getName(self):
+        return self.name
+
+    def getCoefficients(self):
+        return self.sensors[0].getCoefficients()
+
+    #channel, weight, offset, last reading and fault counts of every sensor
+    def getHealth(self):
+        return [{"channel": sensor.channel.decode(), "weight": self.weights[i], "offset": self.offsets[i],
+                 "reading": self.readings[i], "outvoted": self.outvoted[i], "silent": self.silent[i],
+                 "faulty": self.faults[i] >= FAULT_AFTER}
+                for i, sensor in enumerate(self.sensors)]
+
+
+#returns sensor, or a SensorArray of it and the redundant sensors of its axis when config (the sensors section of a
+#hardware configuration) lists any. A redundant sensor without its own calibration table uses the one of sensor
+def withRedundant(sensor, config, clock=time):
+    extra = config.get(sensor.getName(), [])
+    if not extra:
+        return sensor
+    sensors = [sensor] + [Sensor(sensor.name, sensor.ADC, entry.get("raw", sensor.sensorVals),
+                                 entry.get("minutes", sensor.minutes), sensor.raw, sensor.order, clock = clock,
+                                 channel = entry["channel"].encode())
+                          for entry in extra]
+    return SensorArray(sensors, weights = [1.0] + [entry.get("weight", 1.0) for entry in extra],
+                       offsets = [0.0] + [entry.get("offset", 0.0) for entry in extra],
+                       batch = config.get("batch", True), clock = clock)
+
+
+#number of replies in val that are followed by a terminator
+def completeReplies(val):
+    replies = len(val.split())
+    if replies and not val[-1:].isspace():
+        replies -= 1
+    return replies
+
+
+#returns the weighted average of the readings that agree and the indexes of the ones outvoted
+#readings that are None are left out. With three or more readings a reading further from their median than the larger
+#of TOLERANCE and OUTLIER_K scaled median absolute deviations is outvoted, two readings that disagree cannot be told
+#apart and are both kept
+def fuse(readings, weights):
+    valid = [(value, weight, i) for i, (value, weight) in enumerate(zip(readings, weights)) if value is not None]
+    if not valid:
+        return None, []
+    outvoted = []
+    if len(valid) >= 3:
+        values = numpy.array([value for value, weight, i in valid])
+        median = float(numpy.median(values))
+        spread = 1.4826 * float(numpy.median(numpy.abs(values - median)))
+        limit = max(TOLERANCE, OUTLIER_K * spread)
+        outvoted = [i for value, weight, i in valid if abs(value - median) > limit]
+        valid = [(value, weight, i) for value, weight, i in valid if i not in outvoted]
+    total = sum(weight for value, weight, i in valid)
+    if total <= 0:
+        return sum(value for value, weight, i in valid) / len(valid), outvoted
+    return sum(value * weight for value, weight, i in valid) / total, outvoted
+
+
+#channels of the redundant sensors added by the benchmark
+BENCH_CHANNELS = {PITCH: b"abc", ROLL: b"def"}
+
+
+#reads a standing simulated rig with 1 to `most` sensors per axis, batched and one channel at a time, and with one
+#sensor of each axis going bad by `fault` minutes after the zero is taken, returns a report dictionary
+def bench(settingsFile, rigName, levelName, most=4, cycles=200, fault=0.05, seed=0):
+    from Rig import Rig
+    from Simulator import SimClock
+    from Backends import loadHardware
+
+    report = {"rig": rigName, "level": levelName, "cycles": cycles, "fault": fault, "cases": []}
+    for count in range(1, most + 1):
+        case = {"sensors": count}
+        for batch in (True, False):
+            hardware = loadHardware(None)
+            hardware["sensors"] = {axis: [{"channel": chr(channel)} for channel in BENCH_CHANNELS[axis][:count - 1]]
+                                   for axis in (PITCH, ROLL)}
+            hardware["sensors"]["batch"] = batch
+            clock = SimClock()
+            rig = Rig(settingsFile, rigName, levelName, clock = clock, hardware = hardware, sim = {"seed": seed})
+            rig.saveZero()
+            start = clock.time()
+            cpu = time.process_time()
+            errors = []
+            for _ in range(cycles):
+                errors.append(rig.pitch.read() - rig.pitch.getZero())
+                rig.roll.read()
+            case["batched" if batch else "sequential"] = (clock.time() - start) / cycles
+            case["cpu" if batch else "sequentialCpu"] = 1e6 * (time.process_time() - cpu) / cycles
+            if not batch:
+                rig.close()
+                continue
+            case["noise"] = float(numpy.std(errors))
+
+            #the last sensor of each axis starts reading fault minutes high
+            if count > 1:
+                rig.sim.bias[BENCH_CHANNELS[PITCH][count - 2:count - 1]] = fault
+                voted = []
+                averaged = []
+                for _ in range(cycles):
+                    voted.append(rig.pitch.read() - rig.pitch.getZero())
+                    readings = [reading for reading in rig.pitch.readings if reading is not None]
+                    averaged.append(sum(readings) / len(readings) - rig.pitch.getZero())
+                case["voted"] = float(numpy.mean(numpy.abs(voted)))
+                case["averaged"] = float(numpy.mean(numpy.abs(averaged)))
+                case["faulty"] = [health["faulty"] for health in rig.pitch.getHealth()]
+            rig.close()
+        report["cases"].append(case)
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    def cell(value, digits):
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    lines = [f"{report['rig']} {report['level']}: {report['cycles']} reading pairs of a standing simulated rig, "
+             f"one pitch sensor {report['fault']:g} min off after the zero",
+             f"{'sensors':>7} {'batched s':>10} {'one by one s':>13} {'cpu us':>7} {'noise min':>10} "
+             f"{'fault voted':>12} {'fault averaged':>15}"]
+    for case in report["cases"]:
+        lines.append(f"{case['sensors']:7} {case['batched']:10.3f} {case['sequential']:13.3f} {case['cpu']:7.0f} "
+                     f"{case['noise']:10.5f} {cell(case.get('voted'), 5):>12} {cell(case.get('averaged'), 5):>15}")
+    return "\n".join(lines)
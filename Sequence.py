@@ -0,0 +1,369 @@
+# Sequence.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Backlash.py
+# Control.py
+# Leveler.py
+# Rig.py
+# Sensor.py
+# Sequence.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# autoLevel() only levels to the zero point of the sensors, and Set 0 only sets 0, 0, so a tilt test profile used to
+# mean typing a new zero and leveling again by hand for every tilt, often as a new `autoleveler level` run that
+# started from no learned backlash. A Sequence runs a list of setpoints back to back on one Leveler. Each step is
+#   pitch, roll   setpoint in minutes, the zero point the step levels to
+#   dwell         seconds the rig is held at the setpoint once leveled (default 0)
+#   tolerance     minutes either side of the setpoint the rig is held within during the dwell (default the preset's
+#                 sens2, never less than sens1). An axis read outside it is leveled again
+#   slew          minutes per second the setpoint ramps at from the previous one, none jumps straight to it
+# The same Leveler levels every step, so the backlash take-up times (see Backlash.py), the last direction of each
+# axis, the Estimator.py state and the continuous drive coast (see Drive.py) learned on one step are used from the
+# first pulse of the next.
+#
+# With a slew the zero point moves along a straight line from the previous setpoint to the new one, with both axes
+# arriving together and neither moving faster than slew. The rig is read continuously and an axis more than the
+# tolerance from the point LEAD seconds further along the ramp gets one adapt() pulse towards it, so the rig tracks
+# the ramp rather than waiting at the start. The error from the ramp at every reading is kept. autoLevel() then
+# levels to the setpoint as usual before the dwell starts. A slew faster than the actuators can move the rig only
+# makes the rig fall behind and catch up in the final autoLevel().
+#
+# The sequence sets the zero point of the sensors to each setpoint and ramp point, and puts back the zero point it
+# started with when it ends, however it ends, so a later autoLevel() levels to the operator's zero again.
+#
+# The sequence stops at the first step that times out or is paused. Progress goes to the Leveler listeners:
+#   "step"     - index, pitch, roll, dwell, tolerance, slew     a step started
+#   "stepDone" - index, outcome, elapsed, rampRms, rampMax,     a step finished, rampRms and rampMax are the error from
+#                holdRms, holdMax, inside, relevels             the ramp (None without a slew), holdRms, holdMax and
+#                                                               inside (part of the readings within the tolerance) are
+#                                                               for the dwell and relevels counts the autoLevel() runs
+#                                                               the dwell needed
+#
+# Steps are read from a JSON file, {"steps": [{"pitch": 0.5, "roll": -0.2, "dwell": 60, "tolerance": 0.02}, ...]},
+# or a CSV file with the columns pitch, roll, dwell, tolerance and slew (only pitch and roll are required, blank cells
+# use the defaults).
+#
+# Usage:
+#   python -m autoleveler sequence profile.csv --rig Midload --level T-Level --slew 0.01
+#   python -m autoleveler sequence --bench --rig Midload --level T-Level
+
+
+import csv
+import json
+import logging
+import math
+
+from Backlash import BacklashLearner
+from Estimator import Estimator
+from Drive import ContinuousDrive
+from Leveler import Leveler, DONE, PAUSED, TIME_OUT
+
+log = logging.getLogger("autoleveler.sequence")
+
+#step keys
+STEP_KEYS = ("pitch", "roll", "dwell", "tolerance", "slew")
+
+#seconds between reading pairs while dwelling, same as READING_REFRESH in run_auto_leveler.py
+READING_REFRESH = 0.06
+
+#seconds ahead on the ramp the rig is steered to, about one read, pulse and settle cycle of the S and XS pulses
+LEAD = 1.0
+
+#benchmark profile (pitch, roll) in minutes, each step reverses at least one axis. Pitch stays above the saturation
+#of the Midload pitch sensor at about -0.38
+BENCH_STEPS = ((0.6, -0.4), (0.1, 0.3), (0.7, 0.0), (-0.2, -0.5), (0.4, 0.5), (0.0, 0.0))
+BENCH_DWELL = 30.0      #seconds
+BENCH_BACKLASH = 0.15   #seconds, under the xSPulse of settings.csv
+BENCH_SLEW = 0.01       #minutes/second
+
+
+#checks a list of step dictionaries and fills in the defaults, tolerance None is the preset's sens2
+def parseSteps(steps):
+    parsed = []
+    for index, step in enumerate(steps):
+        unknown = set(step) - set(STEP_KEYS)
+        if unknown:
+            raise ValueError(f"step {index + 1} has unknown keys {sorted(unknown)}")
+        for key in ("pitch", "roll"):
+            if step.get(key) is None:
+                raise ValueError(f"step {index + 1} has no {key!r}")
+        parsed.append({"pitch": float(step["pitch"]), "roll": float(step["roll"]),
+                       "dwell": float(step.get("dwell") or 0.0),
+                       "tolerance": None if step.get("tolerance") is None else float(step["tolerance"]),
+                       "slew": None if step.get("slew") is None else float(step["slew"])})
+        for key in ("dwell", "tolerance", "slew"):
+            if parsed[-1][key] is not None and parsed[-1][key] < 0:
+                raise ValueError(f"step {index + 1} has a negative {key}")
+    if not parsed:
+        raise ValueError("the sequence has no steps")
+    return parsed
+
+
+#returns the steps of a JSON or CSV sequence file
+def loadSequence(path):
+    with open(path, newline = "") as file:
+        if path.lower().endswith(".csv"):
+            steps = [{key.strip(): value.strip() or None for key, value in row.items() if key is not None}
+                     for row in csv.DictReader(file)]
+        else:
+            steps = json.load(file)["steps"]
+    return parseSteps(steps)
+
+
+#point part of the way from start to end, both (pitch, roll)
+def along(start, end, part):
+    return tuple(a + (b - a) * part for a, b in zip(start, end))
+
+
+class Sequence:
+    #leveler is the Leveler of the rig, its learned state is kept from step to step
+    #steps is a list of step dictionaries (see parseSteps()), slew is used by steps without their own
+    #start is the (pitch, roll) the first ramp starts from, the zero point of the sensors if it is None
+    #refresh is the seconds between reading pairs while dwelling, lead the seconds ahead on a ramp the rig is steered to
+    def __init__(self, leveler, steps, slew=None, start=None, refresh=READING_REFRESH, lead=LEAD):
+        self.leveler = leveler
+        self.steps = parseSteps(steps)
+        self.slew = slew
+        self.start = start
+        self.refresh = refresh
+        self.lead = lead
+        #stepDone data of every step run so far
+        self.results = []
+
+    #sets the zero point of both sensors, same as Rig.setZero()
+    def setZero(self, pitchZero, rollZero):
+        self.leveler.pitch.zero = pitchZero
+        self.leveler.roll.zero = rollZero
+
+    #runs every step in order, returns DONE or the outcome of the step that stopped the sequence
+    #the zero point of the sensors is put back afterwards
+    def run(self):
+        leveler = self.leveler
+        saved = (leveler.pitch.getZero(), leveler.roll.getZero())
+        previous = self.start if self.start is not None else saved
+        self.results = []
+        outcome = DONE
+        try:
+            for index, step in enumerate(self.steps):
+                outcome = self.runStep(index, step, previous)
+                previous = (step["pitch"], step["roll"])
+                if outcome != DONE:
+                    break
+        finally:
+            self.setZero(*saved)
+        log.info("Sequence %s", outcome, extra = {"fields": {"steps": len(self.results)}})
+        return outcome
+
+    #ramps to, levels at and holds one step, returns DONE, TIMEOUT or PAUSED, the ramp itself ends after its duration
+    #and the autoLevel() after it times out
+    def runStep(self, index, step, previous):
+        leveler = self.leveler
+        settings = leveler.settings
+        tolerance = step["tolerance"] if step["tolerance"] is not None else settings.getSetting("sens2")
+        tolerance = max(tolerance, settings.getSetting("sens1"))
+        slew = step["slew"] if step["slew"] is not None else self.slew
+        setpoint = (step["pitch"], step["roll"])
+        log.info("Step %d", index + 1, extra = {"fields": dict(step, tolerance = tolerance, slew = slew)})
+        leveler.emit("step", index = index, pitch = setpoint[0], roll = setpoint[1], dwell = step["dwell"],
+                     tolerance = tolerance, slew = slew)
+        begin = leveler.clock.time()
+
+        result = {"index": index, "rampRms": None, "rampMax": None, "holdRms": None, "holdMax": None,
+                  "inside": None, "relevels": 0}
+        outcome = DONE
+        if slew:
+            outcome, errors = self.ramp(previous, setpoint, slew, tolerance)
+            if errors:
+                result["rampRms"] = math.sqrt(sum(error * error for error in errors) / len(errors))
+                result["rampMax"] = max(abs(error) for error in errors)
+        self.setZero(*setpoint)
+        if outcome == DONE:
+            outcome = leveler.autoLevel()
+        if outcome == DONE and step["dwell"] > 0:
+            outcome = self.dwell(setpoint, step["dwell"], tolerance, result)
+
+        result.update(outcome = outcome, elapsed = leveler.clock.time() - begin)
+        self.results.append(result)
+        leveler.emit("stepDone", **result)
+        return outcome
+
+    #steers the rig along the ramp from start to end at slew minutes per second, returns the outcome and the error
+    #from the ramp of every reading
+    def ramp(self, start, end, slew, tolerance):
+        leveler = self.leveler
+        clock = leveler.clock
+        sensors = (leveler.pitch, leveler.roll)
+        duration = max(abs(b - a) for a, b in zip(start, end)) / slew
+        begin = clock.time()
+        errors = []
+        leveler.emit("status", text = "Ramping...")
+        while not leveler.relays.getPause():
+            elapsed = clock.time() - begin
+            if elapsed >= duration:
+                return DONE, errors
+            aim = along(start, end, min((elapsed + self.lead) / duration, 1.0))
+            self.setZero(*aim)
+            for i, sensor in enumerate(sensors):
+                reading = leveler.getReading(sensor)
+                if reading is None:
+                    continue
+                #error from the ramp at the time of the reading
+                errors.append(reading - along(start, end, min((clock.time() - begin) / duration, 1.0))[i])
+                if abs(reading - aim[i]) > tolerance:
+                    leveler.adapt(reading, sensor.getName())
+        return PAUSED, errors
+
+    #holds the rig at setpoint for seconds, an axis read more than tolerance out is leveled again
+    #fills in the hold statistics of result, returns DONE or the outcome of a leveling run that did not finish
+    def dwell(self, setpoint, seconds, tolerance, result):
+        leveler = self.leveler
+        clock = leveler.clock
+        sensors = (leveler.pitch, leveler.roll)
+        end = clock.time() + seconds
+        squares = 0.0
+        worst = 0.0
+        readings = 0
+        inside = 0
+        outcome = DONE
+        leveler.emit("status", text = "Holding...")
+        while clock.time() < end:
+            if leveler.relays.getPause():
+                outcome = PAUSED
+                break
+            out = False
+            for i, sensor in enumerate(sensors):
+                reading = leveler.getReading(sensor)
+                if reading is None:
+                    continue
+                error = reading - setpoint[i]
+                squares += error * error
+                worst = max(worst, abs(error))
+                readings += 1
+                inside += abs(error) <= tolerance
+                out = out or abs(error) > tolerance
+            if out:
+                result["relevels"] += 1
+                outcome = leveler.autoLevel()
+                if outcome != DONE:
+                    break
+            else:
+                clock.sleep(self.refresh)
+        if readings:
+            result.update(holdRms = math.sqrt(squares / readings), holdMax = worst, inside = inside / readings)
+        return outcome
+
+
+#new Leveler for the rig with nothing learned, the way a new `autoleveler level` run starts
+def coldLeveler(rig):
+    return Leveler(rig.pitch, rig.roll, rig.relays, rig.settings, clock = rig.leveler.clock,
+                   timeOut = rig.leveler.timeOut,
+                   estimator = None if rig.estimator is None else Estimator(rig.leveler.clock, rig.model),
+                   backlash = BacklashLearner(rig.model), drive = None if rig.drive is None else ContinuousDrive(rig.model),
+                   maxAge = rig.leveler.maxAge)
+
+
+#runs steps on a simulated rig, warm runs them as one Sequence, otherwise every step starts on a new Leveler
+#slew ramps between setpoints, the error of the simulated angle from the ramp is measured at every reading
+#returns a dictionary of the totals
+def simulate(settingsFile, rigName, levelName, steps, warm, slew=None, sim=None, seed=0, timeOut=TIME_OUT,
+             continuous=False):
+    from Rig import Rig
+    from Simulator import SimClock
+
+    clock = SimClock()
+    rig = Rig(settingsFile, rigName, levelName, clock = clock, timeOut = timeOut, continuous = continuous,
+              sim = dict(sim or {}, seed = seed))
+    rig.setZero(0.0, 0.0)
+    counts = {"pulses": 0, "takeUp": 0.0, "levelTime": 0.0, "relevels": 0}
+    outcomes = []
+    #setpoint of the last step and the ramp of the current step, (start time, from, to, seconds)
+    ramp = {"setpoint": (0.0, 0.0), "current": None}
+    rampErrors = []
+
+    def onEvent(event, data):
+        if event == "pulse":
+            counts["pulses"] += 1
+            counts["takeUp"] += data["takeUp"]
+        elif event == "finish":
+            counts["levelTime"] += data["elapsed"]
+        elif event == "step":
+            start = ramp["setpoint"]
+            end = (data["pitch"], data["roll"])
+            ramp["setpoint"] = end
+            if data["slew"]:
+                ramp["current"] = (clock.time(), start, end,
+                                   max(abs(b - a) for a, b in zip(start, end)) / data["slew"])
+        elif event == "reading" and ramp["current"] is not None:
+            begin, start, end, duration = ramp["current"]
+            elapsed = clock.time() - begin
+            if elapsed < duration:
+                target = along(start, end, elapsed / duration)
+                rampErrors.append(rig.sim.getAngle(data["axis"]) - target[0 if data["axis"] == "pitch" else 1])
+        elif event == "stepDone":
+            ramp["current"] = None
+            counts["relevels"] += data["relevels"]
+            outcomes.append(data["outcome"])
+
+    begin = clock.time()
+    if warm:
+        rig.leveler.addListener(onEvent)
+        Sequence(rig.leveler, steps, slew = slew).run()
+    else:
+        previous = (0.0, 0.0)
+        for step in steps:
+            leveler = coldLeveler(rig)
+            leveler.addListener(onEvent)
+            if Sequence(leveler, [step], slew = slew, start = previous).run() != DONE:
+                break
+            previous = (step["pitch"], step["roll"])
+    total = clock.time() - begin
+    rig.close()
+    return dict(counts, outcomes = outcomes, total = total,
+                rampRms = math.sqrt(sum(error * error for error in rampErrors) / len(rampErrors)) if rampErrors else None,
+                rampMax = max(abs(error) for error in rampErrors) if rampErrors else None)
+
+
+#runs a tilt profile on the simulated rig with backlash from runs seeds, one step at a time on new Levelers (cold),
+#as one Sequence (warm) and as one Sequence with a slew between setpoints, returns a report dictionary
+def bench(settingsFile, rigName, levelName, steps=BENCH_STEPS, dwell=BENCH_DWELL, backlash=BENCH_BACKLASH,
+          slew=BENCH_SLEW, runs=3, seed=0, timeOut=TIME_OUT):
+    steps = [{"pitch": pitch, "roll": roll, "dwell": dwell} for pitch, roll in steps]
+    sim = {"backlash": backlash}
+    report = {"rig": rigName, "level": levelName, "steps": len(steps), "dwell": dwell, "backlash": backlash,
+              "slew": slew, "runs": runs, "cases": []}
+    for name, warm, caseSlew in (("cold", False, None), ("warm", True, None), ("warm ramp", True, slew)):
+        results = [simulate(settingsFile, rigName, levelName, steps, warm, caseSlew, sim, seed + run, timeOut)
+                   for run in range(runs)]
+        case = {"name": name, "done": sum(result["outcomes"].count(DONE) for result in results)}
+        for key in ("pulses", "takeUp", "levelTime", "relevels", "total", "rampRms"):
+            values = [result[key] for result in results if result[key] is not None]
+            case[key] = float(sum(values) / len(values)) if values else None
+        maxima = [result["rampMax"] for result in results if result["rampMax"] is not None]
+        case["rampMax"] = float(max(maxima)) if maxima else None
+        report["cases"].append(case)
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    def cell(value):
+        return "-" if value is None else f"{value:.4f}"
+
+    lines = [f"{report['rig']} {report['level']}: {report['steps']} setpoints with {report['dwell']:g} s dwell, "
+             f"{report['backlash']:g} s simulated backlash, ramp at {report['slew']:g} min/s, mean of "
+             f"{report['runs']} runs",
+             f"{'':10} {'done':>5} {'pulses':>7} {'take-up s':>10} {'level s':>8} {'relevels':>9} {'total s':>8} "
+             f"{'ramp rms':>9} {'ramp max':>9}"]
+    for case in report["cases"]:
+        lines.append(f"{case['name']:10} {case['done']:5} {case['pulses']:7.1f} {case['takeUp']:10.2f} "
+                     f"{case['levelTime']:8.1f} {case['relevels']:9.1f} {case['total']:8.1f} "
+                     f"{cell(case['rampRms']):>9} {cell(case['rampMax']):>9}")
+    return "\n".join(lines)
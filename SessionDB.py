@@ -0,0 +1,259 @@
+# SessionDB.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Logs.py
+# Recorder.py
+# Replay.py
+# Rig.py
+# Relays.py
+# SessionDB.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page keeps a history of leveling runs in a local SQLite database (sessions.db). Every autoLevel() run is
+# summarised into one row of the runs table:
+#   start, end, elapsed     time.time() when leveling started and finished, seconds taken
+#   rig, level              preset used
+#   operator                who started the run
+#   priority                axis leveled first
+#   outcome                 done, timeout or paused
+#   pitchError, rollError   starting error in minutes (first readings minus zero)
+#   xl, l, m, s, xs         pulses of each size
+#   pulses, relaySeconds    total pulses and total relay on time
+#   overshoots              pulses that reversed the previous pulse direction on the same axis
+#
+# SessionDB.listener() builds the row from Leveler events on the control thread and only queues it. A writer thread
+# owns the database connection and inserts queued rows in batches of up to BATCH_SIZE in one transaction, so the
+# control loop never waits on the disk. The table is indexed on time, rig and preset so reports over thousands of
+# runs stay fast.
+#
+# Usage:
+#   python -m autoleveler level --zero 0,0 --history sessions.db --operator caleb
+#   python -m autoleveler history sessions.db --by rig,level
+#   python -m autoleveler history sessions.db --rig Midload --since 2023-06-01
+
+
+import queue
+import sqlite3
+import threading
+
+import numpy as np
+
+from Leveler import DONE
+
+HISTORY_DB = "sessions.db"
+
+#rows inserted per transaction at most
+BATCH_SIZE = 100
+
+#time-to-level percentiles in reports
+PERCENTILES = [50, 90, 95, 99]
+
+BUCKET_COLUMNS = {"XL": "xl", "L": "l", "M": "m", "S": "s", "XS": "xs"}
+
+COLUMNS = ["start", "end", "elapsed", "rig", "level", "operator", "priority", "outcome", "pitchError", "rollError",
+           "xl", "l", "m", "s", "xs", "pulses", "relaySeconds", "overshoots"]
+
+#report grouping columns
+GROUPS = ["rig", "level", "operator", "priority"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    elapsed REAL NOT NULL,
+    rig TEXT,
+    level TEXT,
+    operator TEXT,
+    priority TEXT,
+    outcome TEXT NOT NULL,
+    pitchError REAL,
+    rollError REAL,
+    xl INTEGER NOT NULL,
+    l INTEGER NOT NULL,
+    m INTEGER NOT NULL,
+    s INTEGER NOT NULL,
+    xs INTEGER NOT NULL,
+    pulses INTEGER NOT NULL,
+    relaySeconds REAL NOT NULL,
+    overshoots INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runsStart ON runs (start);
+CREATE INDEX IF NOT EXISTS runsRig ON runs (rig, start);
+CREATE INDEX IF NOT EXISTS runsPreset ON runs (rig, level, start);
+"""
+
+INSERT = f"INSERT INTO runs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    #readers do not block the writer thread
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class SessionDB:
+    #initializes database at path and starts the writer thread
+    def __init__(self, path=HISTORY_DB, batchSize=BATCH_SIZE):
+        self.path = path
+        self.batchSize = batchSize
+        self.rows = queue.SimpleQueue()
+        #create the table before the first run is reported
+        connect(path).close()
+        self.thread = threading.Thread(target = self.run, name = "session-db", daemon = True)
+        self.thread.start()
+
+    #queues a dictionary with the COLUMNS keys for insertion
+    def add(self, row):
+        self.rows.put(tuple(row[column] for column in COLUMNS))
+
+    #inserts everything queued and stops the writer thread
+    def close(self):
+        if self.thread.is_alive():
+            self.rows.put(None)
+            self.thread.join()
+
+    def run(self):
+        connection = connect(self.path)
+        try:
+            running = True
+            while running:
+                batch = [self.rows.get()]
+                #take whatever else is already waiting
+                while len(batch) < self.batchSize:
+                    try:
+                        batch.append(self.rows.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    running = False
+                    batch = [row for row in batch if row is not None]
+                if batch:
+                    with connection:
+                        connection.executemany(INSERT, batch)
+        finally:
+            connection.close()
+
+    #Leveler listener summarising each autoLevel() run
+    #settings is the Settings object used by the Leveler, clock provides the time stamps
+    def listener(self, settings, clock, operator=None):
+        run = None
+        lastDirection = {}
+
+        def onEvent(event, data):
+            nonlocal run
+            if event == "start":
+                rigName, levelName = settings.getPresetName()
+                run = {"start": clock.time(), "rig": rigName, "level": levelName, "operator": operator,
+                       "priority": settings.getPriority(), "pitchError": None, "rollError": None,
+                       "pulses": 0, "relaySeconds": 0.0, "overshoots": 0}
+                run.update({column: 0 for column in BUCKET_COLUMNS.values()})
+                lastDirection.clear()
+            elif run is None:
+                return
+            elif event == "reading":
+                key = data["axis"] + "Error"
+                if run[key] is None and data["difference"] is not None:
+                    run[key] = data["difference"]
+            elif event == "pulse":
+                run[BUCKET_COLUMNS[data["bucket"]]] += 1
+                run["pulses"] += 1
+                run["relaySeconds"] += data["pulse"]
+                previous = lastDirection.get(data["axis"])
+                if previous is not None and previous != data["direction"]:
+                    run["overshoots"] += 1
+                lastDirection[data["axis"]] = data["direction"]
+            elif event == "finish":
+                run["end"] = clock.time()
+                run["elapsed"] = data["elapsed"]
+                run["outcome"] = data["outcome"]
+                self.add(run)
+                run = None
+
+        return onEvent
+
+
+#returns runs matching the filters as a dictionary of NumPy arrays keyed by column
+#filters are column=value pairs, since and until limit the start time
+def query(path, since=None, until=None, **filters):
+    conditions = []
+    values = []
+    for column, value in filters.items():
+        if value is not None:
+            if column not in COLUMNS:
+                raise ValueError(f"Unknown column: {column}")
+            conditions.append(f"{column} = ?")
+            values.append(value)
+    if since is not None:
+        conditions.append("start >= ?")
+        values.append(since)
+    if until is not None:
+        conditions.append("start < ?")
+        values.append(until)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    connection = connect(path)
+    try:
+        rows = connection.execute(f"SELECT {', '.join(COLUMNS)} FROM runs{where} ORDER BY start", values).fetchall()
+    finally:
+        connection.close()
+    columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    return {column: np.array(data, dtype = object if column in GROUPS + ["outcome"] else float)
+            for column, data in zip(COLUMNS, columns)}
+
+
+#summarises runs from query(), time to level percentiles are over runs that converged
+def summarise(runs):
+    done = runs["outcome"] == DONE
+    elapsed = runs["elapsed"][done]
+    summary = {"runs": len(runs["start"]),
+               "done": int(done.sum()),
+               "timeout": int((runs["outcome"] == "timeout").sum()),
+               "paused": int((runs["outcome"] == "paused").sum()),
+               "timeToLevel": {f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(elapsed, PERCENTILES))}
+                              if len(elapsed) else {},
+               "meanPulses": {name: float(runs[column][done].mean()) if len(elapsed) else 0.0
+                              for name, column in BUCKET_COLUMNS.items()},
+               "meanOvershoots": float(runs["overshoots"][done].mean()) if len(elapsed) else 0.0}
+    return summary
+
+
+#summarises runs grouped by the given GROUPS columns, returns list of (group values, summary)
+def report(runs, by=()):
+    if not by:
+        return [((), summarise(runs))]
+    keys = list(zip(*(runs[column] for column in by)))
+    groups = []
+    for key in sorted(set(keys), key = lambda k: tuple(str(v) for v in k)):
+        mask = np.array([k == key for k in keys])
+        groups.append((key, summarise({column: data[mask] for column, data in runs.items()})))
+    return groups
+
+
+#returns report() as printable text
+def formatReport(groups, by=()):
+    header = [column for column in by] + ["runs", "done", "t/o", "paused"] + [f"p{p}" for p in PERCENTILES] \
+        + list(BUCKET_COLUMNS) + ["over"]
+    lines = [" ".join(f"{name:>9}" for name in header)]
+    for key, summary in groups:
+        cells = [str(value)[:9] for value in key]
+        cells += [summary["runs"], summary["done"], summary["timeout"], summary["paused"]]
+        cells += [f"{summary['timeToLevel'][f'p{p}']:.1f}" if summary["timeToLevel"] else "-" for p in PERCENTILES]
+        cells += [f"{summary['meanPulses'][name]:.1f}" for name in BUCKET_COLUMNS]
+        cells += [f"{summary['meanOvershoots']:.1f}"]
+        lines.append(" ".join(f"{cell:>9}" for cell in cells))
+    return "\n".join(lines)
@@ -27,6 +27,10 @@ LLR = 5
 T_LEVEL = 2
 INCH_LEVEL = 3
 
+#names used in settings.csv
+RIG_NAMES = {"Midload": MIDLOAD, "Light Load": LIGHT_LOAD, "ABCS Rig": ABCS_RIG, "LLR": LLR}
+LEVEL_NAMES = {"T-Level": T_LEVEL, "1 Level": INCH_LEVEL}
+
 #Last Rig and Level csv location
 LASTRIG_ROW = 1
 LASTRIG_COLUMN = 0
@@ -68,6 +72,20 @@ PITCH_INVERT = 19
 
 THRESHOLD = 20
 
+#reading filter chain, see Filters.py
+FILTER = 21
+
+#cross axis coupling, see Coupling.py
+PITCH_TO_ROLL = 22
+ROLL_TO_PITCH = 23
+COUPLING_COLUMNS = {"pitchToRoll": PITCH_TO_ROLL, "rollToPitch": ROLL_TO_PITCH}
+
+#preset setting names and their columns
+PRESET_COLUMNS = {"sens1": SENS1, "sens2": SENS2, "xLDiff": XLDIFF, "lDiff": LDIFF, "mDiff": MDIFF, "sDiff": SDIFF,
+                  "xLPulse": XLPULSE, "lPulse": LPULSE, "mPulse": MPULSE, "sPulse": SPULSE, "xSPulse": XSPULSE,
+                  "xLDelay": XLDELAY, "lDelay": LDELAY, "mDelay": MDELAY, "sDelay": SDELAY, "xSDelay": XSDELAY,
+                  "rollInvert": ROLL_INVERT, "pitchInvert": PITCH_INVERT, "threshold": THRESHOLD}
+
 
 
 
@@ -150,6 +168,9 @@ class Settings:
                 "rollInvert" : self.settings[self.rigPreset][ROLL_INVERT],
                 "pitchInvert" : self.settings[self.rigPreset][PITCH_INVERT],
                 "threshold" : self.settings[self.rigPreset][THRESHOLD],
+                "filter" : self.getFilterColumn(self.settings[self.rigPreset]),
+                "pitchToRoll" : self.getCouplingColumn(self.settings[self.rigPreset], PITCH_TO_ROLL),
+                "rollToPitch" : self.getCouplingColumn(self.settings[self.rigPreset], ROLL_TO_PITCH),
                 "pitchRaw" : self.pitchRaw,
                 "pitchCalc" : self.pitchCalc,
                 "rollRaw" : self.rollRaw,
@@ -160,6 +181,24 @@ class Settings:
         
         
 
+    #filter column of a preset row, rows saved before the column was added have no filter
+    def getFilterColumn(self, row):
+        return row[FILTER].strip() if len(row) > FILTER else ""
+
+    #coupling column of a preset row, an empty or missing column means the axes are independent
+    def getCouplingColumn(self, row, column):
+        return float(row[column]) if len(row) > column and row[column].strip() else 0.0
+
+    #saves the coupling of the current preset to settings.csv, see Coupling.py
+    def setCoupling(self, pitchToRoll, rollToPitch):
+        row = self.settings[self.rigPreset]
+        row.extend([""] * (ROLL_TO_PITCH + 1 - len(row)))
+        row[PITCH_TO_ROLL] = f"{pitchToRoll:.4f}"
+        row[ROLL_TO_PITCH] = f"{rollToPitch:.4f}"
+        self.updateCSV()
+        self.settingDict["pitchToRoll"] = pitchToRoll
+        self.settingDict["rollToPitch"] = rollToPitch
+
     def getPriority(self):
         return self.priority
     
@@ -225,6 +264,8 @@ class Settings:
             return self.settingDict[setting]
         elif(setting == "order"):
             return int(self.settingDict[setting])
+        elif(setting == "filter"):
+            return self.settingDict[setting]
         else:
             return float(self.settingDict[setting])
 
@@ -325,4 +366,44 @@ class Settings:
 
                 self.rigPreset = rigPreset
                 self.initDict()
-                break
\ No newline at end of file
+                break
+
+    #returns (rig name, level name) of the current preset
+    def getPresetName(self):
+        return self.settings[self.rigPreset][RIG], self.settings[self.rigPreset][LEVEL]
+
+    #selects rig and level preset by name without changing the last used preset in settings.csv
+    #used by the headless entry point so scripted runs do not change what the GUI opens with
+    def usePreset(self, rigName, levelName):
+        if rigName not in RIG_NAMES or levelName not in LEVEL_NAMES:
+            raise ValueError(f"Unknown preset: {rigName}, {levelName}")
+
+        for r in range (2, len(self.settings)):
+            if self.settings[r][RIG] == rigName and self.settings[r][LEVEL] == levelName:
+                self.rig = RIG_NAMES[rigName]
+                self.level = LEVEL_NAMES[levelName]
+                self.rigPreset = r
+                self.initDict()
+                return
+        raise ValueError(f"No preset for {rigName}, {levelName} in {self.csvFile}")
+
+    #returns preset values for rig and level by name as a dictionary of floats (with the coupling) and the filter string,
+    #current preset is not changed
+    def getPreset(self, rigName, levelName):
+        for r in range (2, len(self.settings)):
+            if self.settings[r][RIG] == rigName and self.settings[r][LEVEL] == levelName:
+                row = self.settings[r]
+                preset = {name: float(row[column]) for name, column in PRESET_COLUMNS.items()}
+                preset["filter"] = self.getFilterColumn(row)
+                for name, column in COUPLING_COLUMNS.items():
+                    preset[name] = self.getCouplingColumn(row, column)
+                return preset
+        raise ValueError(f"No preset for {rigName}, {levelName} in {self.csvFile}")
+
+    #changes values of the current preset in memory without writing settings.csv
+    #values is a dictionary of PRESET_COLUMNS names, used by the optimizer to try candidate presets
+    def setPresetValues(self, values):
+        for name, value in values.items():
+            if name not in PRESET_COLUMNS and name not in COUPLING_COLUMNS and name != "filter":
+                raise ValueError(f"Unknown preset setting: {name}")
+            self.settingDict[name] = value
@@ -0,0 +1,279 @@
+# Simulator.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# This page defines a simulated rig so the leveling engine can be run without the Pi, the relay module or the
+# Fredricks signal conditioner. A SimRig object stands in for both the serial ADC (write/read/inWaiting/close) and
+# the RPi.GPIO module (setmode/setup/output/cleanup). It keeps a pitch and roll angle in minutes which moves while
+# an actuator relay is energized, and answers ADC requests with raw codes found from the sensor calibration tables.
+#
+# Actuator model for each axis:
+#   rate      - minutes per second while the relay is on
+#   deadTime  - seconds after the relay turns on before the rig starts moving
+#   coast     - seconds the rig keeps moving after the relay turns off (movement decays exponentially)
+#   backlash  - seconds of relay on time lost taking up slack when the direction reverses
+# The same model is used for every direction unless a fitted model from SysId.py is given.
+#
+# Coupling (pitchToRoll, rollToPitch) makes one axis follow the other: roll also moves pitchToRoll minutes for every
+# minute the pitch actuators moved the rig, and pitch rollToPitch minutes per minute of roll movement.
+#
+# Drift (pitch, roll) in minutes per second tilts a standing rig slowly, the way a long test does (see StayOn.py).
+#
+# Redundant sensors answer on their own channels with their own calibration and noise, and a bias on a channel makes
+# that sensor read wrong (see Sensor.SensorArray).
+#
+# SimClock is a virtual clock for running the simulated rig faster than real time. Pass the same SimClock to Rig as
+# clock and every sleep() in the Sensor, Relays and Leveler objects only moves the clock forward.
+
+
+import math
+import random
+import time
+
+import numpy as np
+
+from Rig import LEFT_PIN, RIGHT_PIN, UP_PIN, DOWN_PIN
+
+#default actuator model
+RATE = 0.05         #minutes/second
+DEAD_TIME = 0.05    #seconds
+COAST = 0.05        #seconds
+BACKLASH = 0.0      #seconds
+
+#standard deviation of sensor noise
+NOISE = 0.0005      #minutes
+
+ROLL_CHANNEL = b'x'
+PITCH_CHANNEL = b'y'
+
+#axis and movement direction of each relay direction used by adapt()
+DIRECTION_AXES = {"left": ("roll", 1), "right": ("roll", -1), "up": ("pitch", -1), "down": ("pitch", 1)}
+
+#relay module is active low
+ON = 0
+OFF = 1
+
+#pulses are folded into the resting angle once coasting has died out
+COAST_SPAN = 8
+
+
+class SimClock:
+    #virtual clock providing time() and sleep() like the time module
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class SimAxis:
+    #one rig axis, angle in minutes
+    def __init__(self, angle, rate, deadTime, coast, backlash):
+        self.angle = angle
+        #resting angle before any movement, see getMoved()
+        self.origin = angle
+        #actuator model for each direction, 1 or -1
+        self.models = {1: (rate, deadTime, coast, backlash), -1: (rate, deadTime, coast, backlash)}
+
+        #direction of last movement, 1 or -1
+        self.lastDirection = 0
+        #pulses that are still moving the rig: [direction, on time, off time or None, lost time, rate, coast]
+        self.pulses = []
+
+    def setModel(self, direction, rate, deadTime, coast, backlash):
+        self.models[direction] = (rate, deadTime, coast, backlash)
+
+    def start(self, direction, now):
+        rate, deadTime, coast, backlash = self.models[direction]
+        lost = deadTime
+        if self.lastDirection == -direction:
+            lost += backlash
+        self.lastDirection = direction
+        self.pulses.append([direction, now, None, lost, rate, coast])
+
+    def stop(self, direction, now):
+        for pulse in self.pulses:
+            if pulse[0] == direction and pulse[2] is None:
+                pulse[2] = now
+
+    #movement of one pulse at time now
+    def travel(self, pulse, now):
+        direction, on, off, lost, rate, coast = pulse
+        end = now if off is None else min(now, off)
+        driven = max(0.0, end - on - lost)
+        move = rate * driven
+        if off is not None and now > off and driven > 0 and coast > 0:
+            move += rate * coast * (1 - math.exp(-(now - off) / coast))
+        return direction * move
+
+    def getAngle(self, now):
+        angle = self.angle
+        for pulse in list(self.pulses):
+            off = pulse[2]
+            if off is not None and now - off > COAST_SPAN * pulse[5]:
+                #pulse has finished moving the rig
+                self.angle += self.travel(pulse, off + COAST_SPAN * pulse[5])
+                angle = self.angle
+                self.pulses.remove(pulse)
+        for pulse in self.pulses:
+            angle += self.travel(pulse, now)
+        return angle
+
+    #minutes the actuators have moved the axis since the start
+    def getMoved(self, now):
+        return self.getAngle(now) - self.origin
+
+
+class SimRig:
+    #initializes simulated rig
+    #pitchCal and rollCal are (raw values, minutes) calibration tables, order is the polynomial order used by Sensor
+    #pitch and roll are the starting angles in minutes
+    #clock must provide time(), the time module is used unless the caller runs faster than real time
+    #model is a parameter dictionary from SysId.py, its directions replace rate, deadTime, coast and backlash
+    #coupling is (pitchToRoll, rollToPitch), the axes are independent by default
+    #drift is (pitch, roll) in minutes per second
+    #channels adds redundant sensors, {channel: (axis, (raw values, minutes))}, and bias {channel: minutes} is a
+    #constant error of the sensor on that channel (a faulty or badly mounted sensor)
+    def __init__(self, pitchCal, rollCal, order, pitch=0.0, roll=0.0, rate=RATE, deadTime=DEAD_TIME, coast=COAST,
+                 backlash=BACKLASH, noise=NOISE, pins=(LEFT_PIN, RIGHT_PIN, UP_PIN, DOWN_PIN), seed=None, clock=time,
+                 model=None, coupling=(0.0, 0.0), drift=(0.0, 0.0), channels=None, bias=None):
+        self.clock = clock
+        self.noise = noise
+        self.drift = {"pitch": drift[0], "roll": drift[1]}
+        self.start = clock.time()
+        #movement of the other axis that is added to each axis
+        self.coupling = {"roll": ("pitch", coupling[0]), "pitch": ("roll", coupling[1])}
+        self.random = random.Random(seed)
+
+        self.axes = {"pitch": SimAxis(pitch, rate, deadTime, coast, backlash),
+                     "roll": SimAxis(roll, rate, deadTime, coast, backlash)}
+        if model is not None:
+            for name, fit in model["directions"].items():
+                axis, direction = DIRECTION_AXES[name]
+                self.axes[axis].setModel(direction, fit["rate"], fit["deadTime"], fit["coast"], fit["backlash"])
+
+        #left raises roll, right lowers roll, up lowers pitch, down raises pitch
+        left, right, up, down = pins
+        self.pins = {left: ("roll", 1), right: ("roll", -1), up: ("pitch", -1), down: ("pitch", 1)}
+        self.levels = {}
+
+        self.tables = {PITCH_CHANNEL: ("pitch", inverseCalibration(*pitchCal, order)),
+                       ROLL_CHANNEL: ("roll", inverseCalibration(*rollCal, order))}
+        for channel, (axis, calibration) in (channels or {}).items():
+            self.tables[channel] = (axis, inverseCalibration(*calibration, order))
+        self.bias = {channel.encode() if isinstance(channel, str) else channel: minutes
+                     for channel, minutes in (bias or {}).items()}
+
+        #pending ADC reply
+        self.buffer = b''
+
+    #current angle of axis in minutes without noise
+    def getAngle(self, axis):
+        now = self.clock.time()
+        other, factor = self.coupling[axis]
+        angle = self.axes[axis].getAngle(now) + self.drift[axis] * (now - self.start)
+        if factor:
+            angle += factor * self.axes[other].getMoved(now)
+        return angle
+
+    #moves axis to angle without counting as actuator movement, the other axis does not follow
+    def setAngle(self, axis, angle):
+        simAxis = self.axes[axis]
+        shift = angle - self.getAngle(axis)
+        simAxis.angle += shift
+        simAxis.origin += shift
+
+    # serial.Serial stand-in - - - - - - - - - - - - - - - - - - - - - -
+
+    def isOpen(self):
+        return True
+
+    def write(self, data):
+        for byte in data:
+            channel = bytes([byte])
+            if channel in self.tables:
+                axis, (minutes, raw) = self.tables[channel]
+                angle = self.getAngle(axis) + self.random.gauss(0, self.noise) + self.bias.get(channel, 0.0)
+                code = int(round(float(np.interp(angle, minutes, raw))))
+                self.buffer += f"{code}\r".encode()
+
+    def read(self, size=1):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def close(self):
+        pass
+
+    # RPi.GPIO stand-in - - - - - - - - - - - - - - - - - - - - - - - -
+
+    BCM = 11
+    OUT = 0
+    LOW = ON
+    HIGH = OFF
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, initial=OFF):
+        self.output(pin, initial)
+
+    def output(self, pin, level):
+        if pin not in self.pins:
+            return
+        axis, direction = self.pins[pin]
+        now = self.clock.time()
+        if level == ON and self.levels.get(pin) != ON:
+            self.axes[axis].start(direction, now)
+        elif level == OFF and self.levels.get(pin) == ON:
+            self.axes[axis].stop(direction, now)
+        self.levels[pin] = level
+
+    def cleanup(self):
+        for pin in self.pins:
+            self.output(pin, OFF)
+
+
+#returns (minutes, raw) arrays for np.interp that undo the calibration polynomial fitted by Sensor
+#the fitted polynomial can fold back on itself outside the middle of the table so only the monotonic branch
+#around zero minutes is kept
+def inverseCalibration(sensorVals, minutes, order):
+    fit = np.polynomial.polynomial.Polynomial.fit(sensorVals, minutes, order)
+    raw = np.linspace(min(sensorVals), max(sensorVals), 20001)
+    angle = fit(raw)
+
+    centre = int(np.argmin(np.abs(angle)))
+    slope = np.sign(angle[min(centre + 1, len(angle) - 1)] - angle[max(centre - 1, 0)])
+    steps = np.sign(np.diff(angle)) == slope
+    lo = centre
+    while lo > 0 and steps[lo - 1]:
+        lo -= 1
+    hi = centre
+    while hi < len(steps) and steps[hi]:
+        hi += 1
+
+    raw = raw[lo:hi + 1]
+    angle = angle[lo:hi + 1]
+    if slope < 0:
+        raw = raw[::-1]
+        angle = angle[::-1]
+    return angle, raw
@@ -0,0 +1,321 @@
+# StayOn.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# Rig.py
+# Relays.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# StayOn.py
+# settings.csv
+
+
+# Overview:
+# Stay-On keeps a leveled rig level during a long test. It used to wait until an axis drifted past the preset's
+# threshold and then run a full autoLevel(), so every slow drift became a multi-pulse correction far from zero. Now
+# the StayOn object fits the drift rate of each axis from the readings it streams anyway and keeps the error inside a
+# hysteresis band of +-BAND times the threshold (at least sens1). When the error LEAD seconds ahead is predicted to
+# leave the band in the direction the axis is drifting, it gives one pulse against the drift (a nudge) sized by
+# adapt() to carry the error across to the other edge of the band, usually XS or S. Full leveling only runs when an
+# axis is past the threshold, a genuine disturbance.
+#
+# The drift fit is a least squares line through the errors of the axis with every reading weighted by
+# exp(-age / DRIFT_TIME). A nudge moves the rig, so each nudge starts a new segment: the slope is fitted across all
+# segments with a separate offset for each, so the rate learned before a nudge is kept. After a nudge the next one
+# waits for MIN_READINGS readings of the new segment, which is the hysteresis of the band: the error has to be seen
+# drifting out again before the rig is moved.
+#
+# The StayOn object is a Leveler listener: start() subscribes it to the readings of whoever samples the sensors (the
+# main loop of the GUI, run() on the command line), and every new sample of an axis updates its fit and decides what
+# is due. act() then takes that action, so leveling never runs inside a listener or nests inside the Stay-On loop. An
+# axis has to be past the threshold for CONFIRM samples in a row before it is leveled, and leveling runs start at most
+# every MIN_INTERVAL seconds; the interval doubles after each run that timed out or was paused, up to MAX_INTERVAL,
+# so a rig that cannot be leveled is not driven around the clock. Settings are read once per leveling run and the
+# fits are running sums, so CPU and memory stay flat however long Stay-On runs.
+#
+# Usage:
+#   python -m autoleveler stay --rig Midload --level T-Level --zero here
+#   python -m autoleveler stay --rig Midload --level T-Level --bench --sim-drift 0.0005,-0.0003
+
+
+import logging
+import math
+
+from Leveler import DONE, TIME_OUT
+
+log = logging.getLogger("autoleveler.stayon")
+
+#seconds between readings while waiting, same as READING_REFRESH in run_auto_leveler.py
+READING_REFRESH = 0.06
+
+#weight of a reading falls to 1/e after
+DRIFT_TIME = 120.0      #seconds
+
+#readings of a segment needed before a nudge, and seconds the fit must span before the rate is used
+MIN_READINGS = 20
+MIN_SPAN = 5.0          #seconds
+
+#seconds ahead the error is predicted
+LEAD = 5.0
+
+#half width of the hysteresis band as a part of the threshold, never narrower than sens1
+BAND = 0.1
+
+#samples in a row an axis has to be past the threshold before it is leveled
+CONFIRM = 3
+
+#seconds after a leveling run before the next one can start, doubled after every run that did not finish up to
+MIN_INTERVAL = 30.0
+MAX_INTERVAL = 600.0
+
+#Stay-On actions returned by step()
+WAIT = "wait"
+NUDGE = "nudge"
+LEVEL = "level"
+
+
+class DriftFit:
+    #drift rate of one axis in minutes per second
+    def __init__(self, driftTime=DRIFT_TIME):
+        self.driftTime = driftTime
+        self.reset()
+
+    def reset(self):
+        self.start = None
+        self.last = None
+        #within segment sums of finished segments
+        self.sxx = 0.0
+        self.sxy = 0.0
+        self.newSegment()
+
+    #starts a new segment after the rig was moved
+    def newSegment(self):
+        if self.start is not None and self.n > 0:
+            self.sxx += self.centredXX()
+            self.sxy += self.centredXY()
+        self.n = 0.0
+        self.count = 0
+        self.st = 0.0
+        self.sy = 0.0
+        self.stt = 0.0
+        self.sty = 0.0
+
+    def centredXX(self):
+        return self.stt - self.st * self.st / self.n
+
+    def centredXY(self):
+        return self.sty - self.st * self.sy / self.n
+
+    #adds the error of the axis read at time t
+    def add(self, t, error):
+        if self.start is None:
+            self.start = t
+            self.last = t
+        decay = math.exp(-(t - self.last) / self.driftTime)
+        for name in ("sxx", "sxy", "n", "st", "sy", "stt", "sty"):
+            setattr(self, name, getattr(self, name) * decay)
+        self.last = t
+
+        t -= self.start
+        self.n += 1
+        self.count += 1
+        self.st += t
+        self.sy += error
+        self.stt += t * t
+        self.sty += t * error
+
+    #drift rate, None until the fit spans MIN_SPAN seconds
+    def rate(self):
+        sxx = self.sxx + (self.centredXX() if self.n > 0 else 0.0)
+        if self.start is None or self.last - self.start < MIN_SPAN or sxx <= 0:
+            return None
+        return (self.sxy + (self.centredXY() if self.n > 0 else 0.0)) / sxx
+
+    #fitted error at time t, None until the current segment has MIN_READINGS readings
+    def predict(self, t):
+        rate = self.rate()
+        if rate is None or self.count < MIN_READINGS:
+            return None
+        return self.sy / self.n + rate * (t - self.start - self.st / self.n)
+
+
+class StayOn:
+    #keeps the rig of leveler level, clock is the leveler's clock unless given
+    #predict turns drift nudges on, without it Stay-On only levels past the threshold like before
+    def __init__(self, leveler, clock=None, predict=True, lead=LEAD, refresh=READING_REFRESH, band=BAND):
+        self.leveler = leveler
+        self.settings = leveler.settings
+        self.clock = clock or leveler.clock
+        self.predict = predict
+        self.lead = lead
+        self.refresh = refresh
+        self.band = band
+        self.fits = {"pitch": DriftFit(), "roll": DriftFit()}
+        self.active = False
+        self.arm()
+
+    #reads the preset's threshold and band, again after every leveling run in case the preset changed
+    def arm(self):
+        self.threshold = self.settings.getSetting("threshold")
+        self.bandWidth = max(self.settings.getSetting("sens1"), self.band * self.threshold)
+
+    def reset(self):
+        for fit in self.fits.values():
+            fit.reset()
+        #samples in a row past the threshold on each axis
+        self.above = {"pitch": 0, "roll": 0}
+        #action the latest samples call for: None, (NUDGE, axis, predicted) or (LEVEL, axis, error)
+        self.due = None
+        self.leveling = False
+
+    #subscribes to the readings of the leveler
+    def start(self):
+        if not self.active:
+            self.arm()
+            self.reset()
+            #no leveling run before the first one is rate limited
+            self.nextLevel = None
+            self.interval = MIN_INTERVAL
+            self.leveler.addListener(self.listener)
+            self.active = True
+
+    def stop(self):
+        if self.active:
+            self.leveler.removeListener(self.listener)
+            self.active = False
+
+    #Leveler listener, only looks at samples, the actions are taken by act()
+    def listener(self, event, data):
+        if event == "start":
+            self.leveling = True
+        elif event == "finish":
+            self.onFinish(data["outcome"])
+        elif event == "reading" and not self.leveling and data["difference"] is not None:
+            self.onSample(data["axis"], data["difference"])
+
+    #adds a new sample of axis and decides what is due
+    def onSample(self, axis, error):
+        fit = self.fits[axis]
+        fit.add(self.clock.time(), error)
+
+        self.above[axis] = self.above[axis] + 1 if abs(error) > self.threshold else 0
+        if self.above[axis] >= CONFIRM:
+            self.due = (LEVEL, axis, error)
+            return
+        if not self.predict or (self.due is not None and self.due[0] == LEVEL):
+            return
+        predicted = fit.predict(self.clock.time() + self.lead)
+        if predicted is not None and abs(predicted) >= self.bandWidth and predicted * fit.rate() > 0:
+            self.due = (NUDGE, axis, predicted)
+
+    def onFinish(self, outcome):
+        self.leveling = False
+        #the rig was moved a long way, the drift is fitted again
+        self.arm()
+        self.reset()
+        #leveling that did not finish is retried less and less often
+        self.interval = MIN_INTERVAL if outcome == DONE else min(2 * self.interval, MAX_INTERVAL)
+        self.nextLevel = self.clock.time() + self.interval
+
+    #takes the action the latest samples call for, returns WAIT, NUDGE or LEVEL
+    def act(self):
+        due = self.due
+        self.due = None
+        if due is None:
+            return WAIT
+        action, axis, value = due
+        leveler = self.leveler
+
+        if action == LEVEL:
+            if self.nextLevel is not None and self.clock.time() < self.nextLevel:
+                return WAIT
+            log.info("Stay-On leveling", extra = {"fields": {"axis": axis, "error": value}})
+            if leveler.autoLevel() == DONE:
+                leveler.emit("status", text = "Waiting...")
+            return LEVEL
+
+        sensor = leveler.pitch if axis == "pitch" else leveler.roll
+        fit = self.fits[axis]
+        log.info("Stay-On nudge", extra = {"fields": {"axis": axis, "rate": fit.rate(), "predicted": value}})
+        #sized to carry the error across to the other edge of the band
+        leveler.adapt(sensor.getZero() + value, axis, margin = self.bandWidth)
+        fit.newSegment()
+        return NUDGE
+
+    #samples both sensors once, the listener sees the new readings, and acts on them
+    def step(self):
+        self.leveler.getReading(self.leveler.pitch)
+        self.leveler.getReading(self.leveler.roll)
+        return self.act()
+
+    #runs until stayOn is False or the leveler is paused, seconds limits the time if given
+    def run(self, relays, seconds=None):
+        end = None if seconds is None else self.clock.time() + seconds
+        self.start()
+        self.leveler.emit("status", text = "Waiting...")
+        try:
+            while relays.getStayOn() and not relays.getPause():
+                if end is not None and self.clock.time() >= end:
+                    break
+                self.step()
+                self.clock.sleep(self.refresh)
+        finally:
+            self.stop()
+
+
+#holds a leveled simulated rig for seconds with drift (pitch, roll) in minutes per second, with and without nudges
+#returns a report dictionary
+def bench(settingsFile, rigName, levelName, drift, seconds=3600, seed=0, sim=None, timeOut=TIME_OUT):
+    from Rig import Rig
+    from Simulator import SimClock
+
+    report = {"rig": rigName, "level": levelName, "drift": list(drift), "seconds": seconds}
+    for name, predict in (("threshold", False), ("predictive", True)):
+        clock = SimClock()
+        rig = Rig(settingsFile, rigName, levelName, clock = clock, timeOut = timeOut,
+                  sim = dict(sim or {}, seed = seed, drift = drift))
+        rig.setZero(0.0, 0.0)
+        counts = {"pulses": 0, "levels": 0, "relaySeconds": 0.0}
+
+        def onEvent(event, data):
+            if event == "pulse":
+                counts["pulses"] += 1
+                counts["relaySeconds"] += data["pulse"]
+            elif event == "start":
+                counts["levels"] += 1
+
+        rig.leveler.addListener(onEvent)
+        stayOn = StayOn(rig.leveler, predict = predict)
+        stayOn.start()
+        squares = 0.0
+        worst = 0.0
+        samples = 0
+        end = clock.time() + seconds
+        while clock.time() < end:
+            stayOn.step()
+            clock.sleep(READING_REFRESH)
+            for axis in ("pitch", "roll"):
+                error = rig.sim.getAngle(axis)
+                squares += error * error
+                worst = max(worst, abs(error))
+            samples += 2
+        rig.close()
+        report[name] = dict(counts, rms = math.sqrt(squares / samples), max = worst)
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    lines = [f"{report['rig']} {report['level']}: drift pitch {report['drift'][0]:g}, roll {report['drift'][1]:g} "
+             f"min/s for {report['seconds']:g} s",
+             f"{'':11} {'pulses':>7} {'levels':>7} {'relay s':>8} {'rms min':>9} {'max min':>9}"]
+    for name in ("threshold", "predictive"):
+        result = report[name]
+        lines.append(f"{name:11} {result['pulses']:7} {result['levels']:7} {result['relaySeconds']:8.2f} "
+                     f"{result['rms']:9.5f} {result['max']:9.5f}")
+    return "\n".join(lines)
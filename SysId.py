@@ -0,0 +1,244 @@
+# SysId.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Control.py
+# ControlClient.py
+# Leveler.py
+# Logs.py
+# Optimizer.py
+# Recorder.py
+# Replay.py
+# Rig.py
+# Relays.py
+# SessionDB.py
+# Sensor.py
+# Settings.py
+# Simulator.py
+# SysId.py
+# settings.csv
+
+
+# Overview:
+# This page fits the actuator model used by Simulator.py to recorded telemetry (Recorder.py), separately for each of
+# the four relay directions. Every sample taken after a pulse finished, and before the next pulse on the same axis,
+# is a measurement of how far that pulse moved the rig:
+#
+#   y = rate * (duration - deadTime - backlash * reversed) + rate * coast * (1 - exp(-(t - off) / coast))
+#
+# where y is the movement since the last sample before the pulse, in the direction of the pulse, off is the time the
+# relay turned off and reversed is 1 if the previous pulse on the axis went the other way. For a fixed coast this is
+# linear in rate, rate * deadTime and rate * backlash, so coast is found by trying COAST_STEPS values at once and
+# solving every least squares problem together with NumPy. The fit is repeated without pulses too short to move the
+# rig past the dead time and without outliers, such as samples after the rig was moved by hand between runs.
+#
+# Samples taken long after the relay turned off only show the difference between coast and dead time, so when the
+# settle delays are long the shortest coast that fits as well as any other is reported. The simulated rig moves the
+# same either way.
+#
+# Movement directions follow adapt(): left and down raise the reading, right and up lower it. The fitted parameters
+# are saved as JSON:
+#   {"rig": "Midload", "pulses": 1234,
+#    "directions": {"left": {"rate": ..., "deadTime": ..., "coast": ..., "backlash": ..., "pulses": ..., "samples": ...,
+#                            "rms": ...},
+#                   "right": {...}, "up": {...}, "down": {...}}}
+# and can be used by the simulated rig with --sim-model, see Simulator.SimRig.
+#
+# Usage:
+#   python -m autoleveler sysid recordings --rig Midload --output midload.json
+#   python -m autoleveler optimize --rig Midload --level T-Level --sim-model midload.json
+
+
+import json
+
+import numpy as np
+
+import Recorder
+from Recorder import PULSE, SAMPLE, PITCH, ROLL, DIRECTIONS
+from Sensor import READ_DELAY
+
+#sign of the reading change for each direction
+DIRECTION_SIGNS = {"left": 1, "right": -1, "up": -1, "down": 1}
+
+#samples are time stamped after Sensor.read() waited for the reply, the angle was measured this much earlier
+READ_LAG = READ_DELAY
+
+#the reading before a pulse must be this recent, adapt() pulses straight after reading the sensor
+BEFORE_GAP = 1.0    #seconds
+#samples later than this after a pulse are not used, the rig may have been moved since
+AFTER_GAP = 5.0     #seconds
+
+#coast time constants tried, seconds
+COAST_STEPS = np.linspace(0.0, 2.0, 201)
+
+#fits within this factor of the best mean square error are treated as equal
+COAST_TOLERANCE = 1.01
+
+#directions with fewer pulses are not fitted
+MIN_PULSES = 5
+
+#before fitting, samples that moved less than SCREEN_LOW or more than SCREEN_HIGH times the median movement per
+#second of relay on time are dropped, then samples further than OUTLIER robust standard deviations from the fit
+SCREEN_LOW = 0.25
+SCREEN_HIGH = 4.0
+FIT_PASSES = 3
+OUTLIER = 4.0
+
+
+#returns a dictionary of arrays with one entry per sample taken after a pulse:
+#direction code, duration, reversed, seconds since the relay turned off, movement since the pulse started
+def responses(records):
+    rows = {"direction": [], "duration": [], "reversed": [], "since": [], "movement": [], "pulse": []}
+    pulseOffset = 0
+    for axis in (PITCH, ROLL):
+        samples = records[(records["kind"] == SAMPLE) & (records["axis"] == axis)].copy()
+        samples["t"] -= READ_LAG
+        pulses = records[(records["kind"] == PULSE) & (records["axis"] == axis)]
+        if not len(samples) or not len(pulses):
+            continue
+        pulses = pulses[np.argsort(pulses["t"], kind = "stable")]
+        starts = pulses["t"]
+        ends = starts + pulses["duration"]
+
+        #reading before each pulse
+        before = np.searchsorted(samples["t"], starts, side = "right") - 1
+
+        #pulse each sample follows, samples during a pulse or before the first one are dropped
+        owner = np.searchsorted(starts, samples["t"], side = "right") - 1
+        keep = (owner >= 0)
+        keep[keep] &= samples["t"][keep] >= ends[owner[keep]]
+        keep[keep] &= before[owner[keep]] >= 0
+        keep[keep] &= starts[owner[keep]] - samples["t"][before[owner[keep]]] <= BEFORE_GAP
+        keep[keep] &= samples["t"][keep] - ends[owner[keep]] <= AFTER_GAP
+        owner = owner[keep]
+        after = samples[keep]
+
+        directions = pulses["direction"]
+        reversedPulse = np.zeros(len(pulses), dtype = bool)
+        reversedPulse[1:] = (directions[1:] != directions[:-1]) & (directions[:-1] != 0)
+
+        signs = np.zeros(len(pulses))
+        for name, sign in DIRECTION_SIGNS.items():
+            signs[directions == DIRECTIONS[name]] = sign
+
+        rows["direction"].append(directions[owner])
+        rows["duration"].append(pulses["duration"][owner].astype(float))
+        rows["reversed"].append(reversedPulse[owner].astype(float))
+        rows["since"].append(after["t"] - ends[owner])
+        rows["movement"].append((after["minutes"] - samples["minutes"][before[owner]]) * signs[owner])
+        rows["pulse"].append(owner + pulseOffset)
+        pulseOffset += len(pulses)
+
+    return {key: np.concatenate(value) if value else np.zeros(0) for key, value in rows.items()}
+
+
+#least squares fit of the actuator model to responses of one direction
+#returns dictionary of rate, deadTime, coast, backlash, rms or None if the fit failed
+def fitDirection(duration, reversedPulse, since, movement, coasts=COAST_STEPS):
+    #shape (coasts, samples): coast part of the movement per unit rate
+    tau = np.maximum(coasts, 1e-9)[:, None]
+    shape = np.where(coasts[:, None] > 0, tau * (1 - np.exp(-since[None, :] / tau)), 0.0)
+
+    #columns: duration + coast term, -1 (rate * deadTime), -reversed (rate * backlash)
+    x = np.stack([duration[None, :] + shape,
+                  -np.ones_like(shape),
+                  -np.broadcast_to(reversedPulse, shape.shape)], axis = 2)
+    xtx = np.einsum("gni,gnj->gij", x, x)
+    xty = np.einsum("gni,n->gi", x, movement)
+    #backlash cannot be found without reversals
+    if not reversedPulse.any():
+        xtx[:, 2, 2] += 1.0
+    try:
+        beta = np.linalg.solve(xtx, xty[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return None
+    residual = movement[None, :] - np.einsum("gni,gi->gn", x, beta)
+    errors = (residual ** 2).mean(axis = 1)
+    #dead time, backlash and rate cannot be negative
+    errors[(beta[:, 0] <= 0) | (beta[:, 1] < 0) | (beta[:, 2] < 0)] = np.inf
+    if not np.isfinite(errors).any():
+        return None
+    #samples taken after coasting finished only show coast - deadTime, the shortest coast that fits is used
+    best = int(np.argmax(errors <= errors.min() * COAST_TOLERANCE))
+
+    rate, deadArea, backlashArea = beta[best]
+    return {"rate": float(rate),
+            "deadTime": float(deadArea / rate),
+            "coast": float(coasts[best]),
+            "backlash": float(backlashArea / rate),
+            "rms": float(np.sqrt(errors[best]))}
+
+
+#movement the fitted model predicts for responses
+def predict(fit, duration, reversedPulse, since):
+    driven = np.maximum(duration - fit["deadTime"] - fit["backlash"] * reversedPulse, 0.0)
+    coast = fit["coast"] * (1 - np.exp(-since / fit["coast"])) if fit["coast"] > 0 else 0.0
+    return fit["rate"] * (driven + np.where(driven > 0, coast, 0.0))
+
+
+#fits every direction in records, returns the parameter dictionary saved by save()
+def identify(records, rigName=None, since=None, until=None):
+    if since is not None:
+        records = records[records["t"] >= since]
+    if until is not None:
+        records = records[records["t"] < until]
+
+    data = responses(records)
+    params = {"rig": rigName, "pulses": int(len(np.unique(data["pulse"]))), "directions": {}}
+    for name in DIRECTION_SIGNS:
+        mask = data["direction"] == DIRECTIONS[name]
+        pulses = len(np.unique(data["pulse"][mask]))
+        if pulses < MIN_PULSES:
+            continue
+        #rough screen against samples where the sensor was out of range or the rig was moved by hand
+        perSecond = np.median(data["movement"][mask] / np.maximum(data["duration"][mask], 1e-3))
+        used = mask & (data["movement"] >= SCREEN_LOW * perSecond * data["duration"])
+        used &= data["movement"] <= SCREEN_HIGH * perSecond * data["duration"]
+
+        fit = None
+        for _ in range(FIT_PASSES):
+            if len(np.unique(data["pulse"][used])) < MIN_PULSES:
+                break
+            refit = fitDirection(data["duration"][used], data["reversed"][used], data["since"][used],
+                                 data["movement"][used])
+            if refit is None:
+                break
+            fit = refit
+            residual = data["movement"] - predict(fit, data["duration"], data["reversed"], data["since"])
+            spread = 1.4826 * np.median(np.abs(residual[used]))
+            #pulses shorter than the dead time hardly move the rig and do not follow the linear model
+            used &= data["duration"] - data["reversed"] * fit["backlash"] > fit["deadTime"]
+            used &= np.abs(residual) <= max(OUTLIER * spread, 1e-9)
+        if fit is not None:
+            fit["pulses"] = int(pulses)
+            fit["samples"] = int(used.sum())
+            params["directions"][name] = fit
+    return params
+
+
+#fits a recording directory, see identify()
+def identifyDirectory(directory, rigName=None, since=None, until=None):
+    return identify(Recorder.load(directory), rigName, since, until)
+
+
+def save(params, path):
+    with open(path, "w") as f:
+        json.dump(params, f, indent = 2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+#returns parameters as printable text
+def formatParams(params):
+    lines = [f"{params['rig'] or 'rig'}: {params['pulses']} pulses",
+             f"{'':6} {'rate':>8} {'dead':>7} {'coast':>7} {'backlash':>8} {'pulses':>7} {'rms':>8}"]
+    for name, fit in params["directions"].items():
+        lines.append(f"{name:6} {fit['rate']:8.4f} {fit['deadTime']:7.3f} {fit['coast']:7.3f} {fit['backlash']:8.3f}"
+                     f" {fit['pulses']:7} {fit['rms']:8.5f}")
+    return "\n".join(lines)
@@ -0,0 +1,183 @@
+# Timing.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Backends.py
+# Relays.py
+# Rig.py
+# Timing.py
+# settings.csv
+
+
+# Overview:
+# Relays.moveAct() used to hold a relay on with time.sleep(pulse). On a loaded Pi the sleep wakes up late by a
+# varying margin, which matters most for the 0.009 - 0.03 s XS pulses. This page times relay pulses for Relays.py:
+#
+# PulseTimer.sleep() holds the relay in one of two modes:
+#   sleep    clock.sleep(seconds), the old behaviour
+#   precise  time.sleep() until SPIN seconds before the end, then a spin on time.perf_counter_ns() for the rest
+# and PulseTimer.add() records the on time achieved against the one requested for every pulse: a histogram of the
+# error in BIN microsecond bins (the first and last bins collect everything beyond them), and the count, mean, largest
+# and standard deviation of the error. On a simulated clock both modes just move the clock.
+#
+# bench() compares the modes on FakeGPIO relays (see Backends.py) while `load` processes keep the CPUs busy, and
+# reports the on time error and the CPU time of the pulsing thread per pulse.
+#
+# Usage:
+#   python -m autoleveler level --rig Midload --level T-Level --precise
+#   python -m autoleveler timing --load 4 --pulses 200
+
+
+import math
+import multiprocessing
+import time
+
+import numpy as np
+
+#precise mode stops sleeping this long before the end of a pulse and spins for the rest
+SPIN = 0.001    #seconds
+
+#pulse on time error histogram, BIN microseconds wide from LOWEST to HIGHEST microseconds
+BIN = 100
+LOWEST = -500
+HIGHEST = 5000
+
+#pulse modes
+SLEEP = "sleep"
+PRECISE = "precise"
+
+#XS pulse lengths of settings.csv used by the benchmark
+BENCH_PULSES = (0.009, 0.018, 0.03)
+
+
+class PulseTimer:
+    #clock must provide time() and sleep(), pulses are timed with time.perf_counter_ns() when it is the time module
+    def __init__(self, clock=time, precise=False, spin=SPIN):
+        self.clock = clock
+        self.precise = precise
+        self.spin = spin
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * ((HIGHEST - LOWEST) // BIN + 2)
+        self.count = 0
+        self.sum = 0.0
+        self.sumSquares = 0.0
+        self.worst = 0.0
+
+    #nanosecond timestamp pulses are measured with
+    def now(self):
+        if self.clock is time:
+            return time.perf_counter_ns()
+        return round(self.clock.time() * 1e9)
+
+    #waits seconds, finishing with a spin in precise mode
+    def sleep(self, seconds):
+        if not self.precise or self.clock is not time:
+            self.clock.sleep(seconds)
+            return
+        end = time.perf_counter_ns() + round(seconds * 1e9)
+        coarse = seconds - self.spin
+        if coarse > 0:
+            time.sleep(coarse)
+        while time.perf_counter_ns() < end:
+            pass
+
+    #records a pulse of requested seconds that was on for achieved nanoseconds
+    def add(self, requested, achieved):
+        error = achieved / 1e3 - requested * 1e6     #microseconds
+        index = min(max(int(math.floor((error - LOWEST) / BIN)) + 1, 0), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += error
+        self.sumSquares += error * error
+        if abs(error) > abs(self.worst):
+            self.worst = error
+
+    #[(low, high, count)] of the on time error in microseconds, low of the first and high of the last bin are None
+    def getHistogram(self):
+        histogram = []
+        for index, count in enumerate(self.counts):
+            low = None if index == 0 else LOWEST + (index - 1) * BIN
+            high = None if index == len(self.counts) - 1 else LOWEST + index * BIN
+            histogram.append((low, high, count))
+        return histogram
+
+    #count, mean, std and largest on time error in microseconds
+    def getSummary(self):
+        if self.count == 0:
+            return {"pulses": 0, "mean": None, "std": None, "max": None}
+        mean = self.sum / self.count
+        return {"pulses": self.count, "mean": mean, "std": math.sqrt(max(self.sumSquares / self.count - mean * mean, 0)),
+                "max": self.worst}
+
+
+#returns the non empty bins of a PulseTimer histogram as printable text
+def formatHistogram(histogram):
+    lines = []
+    top = max((count for low, high, count in histogram), default = 0)
+    for low, high, count in histogram:
+        if count == 0:
+            continue
+        label = f"< {high}" if low is None else f">= {low}" if high is None else f"{low} - {high}"
+        lines.append(f"{label:>14} us {count:6} {'#' * round(40 * count / top)}")
+    return "\n".join(lines)
+
+
+#keeps a CPU busy until stopped
+def burn(stop):
+    while not stop.is_set():
+        pass
+
+
+#pulses FakeGPIO relays in both modes while load processes keep the CPUs busy, returns a report dictionary
+def bench(pulses=200, load=0, lengths=BENCH_PULSES):
+    from Backends import FakeGPIO
+    from Relays import Relays
+
+    report = {"pulses": pulses, "load": load, "lengths": list(lengths)}
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target = burn, args = (stop,), daemon = True) for _ in range(load)]
+    for worker in workers:
+        worker.start()
+    try:
+        for mode in (SLEEP, PRECISE):
+            gpio = FakeGPIO()
+            relays = Relays(16, 12, 20, 21, gpio = gpio, precise = mode == PRECISE)
+            cpu = time.thread_time()
+            for i in range(pulses):
+                relays.moveUp(lengths[i % len(lengths)])
+                #relays rest between pulses like the settle delays
+                time.sleep(0.002)
+            cpu = time.thread_time() - cpu
+            #on time between the relay output changes, measured by the fake backend
+            achieved = PulseTimer()
+            errors = []
+            for i, duration in enumerate(gpio.durations()):
+                achieved.add(lengths[i % len(lengths)], duration * 1e9)
+                errors.append(1e6 * (duration - lengths[i % len(lengths)]))
+            report[mode] = dict(achieved.getSummary(), median = float(np.median(errors)),
+                                p95 = float(np.percentile(errors, 95)), cpuPerPulse = 1e6 * cpu / pulses,
+                                histogram = achieved.getHistogram())
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+    return report
+
+
+#returns bench() report as printable text
+def formatReport(report):
+    lines = [f"{report['pulses']} pulses of {', '.join(f'{length:g}' for length in report['lengths'])} s "
+             f"with {report['load']} busy processes",
+             f"{'':8} {'median us':>9} {'p95 us':>8} {'mean us':>8} {'std us':>8} {'max us':>8} {'cpu us/pulse':>13}"]
+    for mode in (SLEEP, PRECISE):
+        result = report[mode]
+        lines.append(f"{mode:8} {result['median']:9.1f} {result['p95']:8.1f} {result['mean']:8.1f} "
+                     f"{result['std']:8.1f} {result['max']:8.1f} {result['cpuPerPulse']:13.1f}")
+    for mode in (SLEEP, PRECISE):
+        lines += ["", f"{mode} on time error:", formatHistogram(report[mode]["histogram"])]
+    return "\n".join(lines)
@@ -0,0 +1,761 @@
+# autoleveler.py
+# Caleb Greenfield
+# 3/7/23
+
+# AutoLevel Project:
+# run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# MultiRig.py
+# Rig.py
+# Relays.py
+# SessionDB.py
+# Sensor.py
+# Sequence.py
+# Settings.py
+# Simulator.py
+# settings.csv
+
+
+# Overview:
+# Headless command line entry point for scripted leveling and use over SSH. It uses the same Sensor, Relays, Settings
+# and Leveler objects as the GUI but never imports tkinter or matplotlib.
+#
+# Usage:
+#   python -m autoleveler level --rig Midload --level T-Level --zero 0,0
+#   python -m autoleveler level --zero here --sim --sim-tilt 2.5,-1.0
+#   python -m autoleveler serve --socket /tmp/autoleveler.sock      (control API, see Control.py)
+#   python -m autoleveler replay recordings --rig Midload --level T-Level   (see Replay.py)
+#   python -m autoleveler history sessions.db --by rig,level                (see SessionDB.py)
+#   python -m autoleveler optimize --rig Midload --level T-Level --method bayes  (see Optimizer.py)
+#   python -m autoleveler sysid recordings --rig Midload --output midload.json   (see SysId.py)
+#   python -m autoleveler noise --rig Midload --level T-Level --seconds 120     (see Noise.py)
+#   python -m autoleveler coupling --rig Midload --level T-Level --sim-coupling 0.3,-0.2   (see Coupling.py)
+#   python -m autoleveler stay --rig Midload --level T-Level --zero here      (Stay-On, see StayOn.py)
+#   python -m autoleveler drive --rig Midload --level T-Level --runs 20      (continuous drive, see Drive.py)
+#   python -m autoleveler timing --load 4                                    (relay pulse timing, see Timing.py)
+#   python -m autoleveler buttons --presses 40                               (E-stop latency, see Buttons.py)
+#   python -m autoleveler multi stations.json                                (several rigs, see MultiRig.py)
+#   python -m autoleveler sensors --rig Midload --level T-Level              (redundant sensors, see Sensor.py)
+#   python -m autoleveler sequence profile.csv --rig Midload --level T-Level (setpoint sequence, see Sequence.py)
+#
+# Progress is written to stdout as one JSON object per line, log messages go to stderr (see Logs.py). Ctrl+C or SIGTERM pauses leveling the same way the
+# GUI Pause button does. The exit status gives the outcome of the run:
+#   0 - converged
+#   1 - error
+#   3 - timed out
+#   4 - paused
+
+
+import argparse
+import asyncio
+import datetime
+import getpass
+import json
+import signal
+import sys
+import time
+
+from Leveler import DONE, TIMEOUT, PAUSED, TIME_OUT, MAX_AGE
+from Rig import Rig, SETTINGS_FILE
+from Settings import Settings
+from Logs import setupLogging
+from Acquisition import Acquisition, IDLE, IDLE_AFTER, STILL
+from Backends import HARDWARE_FILE, loadHardware
+
+EXIT_DONE = 0
+EXIT_ERROR = 1
+EXIT_TIMEOUT = 3
+EXIT_PAUSED = 4
+
+EXIT_CODES = {DONE: EXIT_DONE, TIMEOUT: EXIT_TIMEOUT, PAUSED: EXIT_PAUSED}
+
+
+#writes one JSON line to stdout
+def writeEvent(event, data):
+    line = {"event": event, "t": round(time.time(), 3)}
+    line.update(data)
+    sys.stdout.write(json.dumps(line) + "\n")
+    sys.stdout.flush()
+
+
+#parses "pitch,roll" in minutes
+def parsePair(text):
+    try:
+        pitchValue, rollValue = (float(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected pitch,roll in minutes, got {text!r}")
+    return pitchValue, rollValue
+
+
+#parses --sim-coupling "pitchToRoll,rollToPitch"
+def parseCoupling(text):
+    try:
+        pitchToRoll, rollToPitch = (float(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected pitchToRoll,rollToPitch, got {text!r}")
+    return pitchToRoll, rollToPitch
+
+
+#parses --zero, either "here" or "pitch,roll"
+def parseZero(text):
+    if text == "here":
+        return text
+    return parsePair(text)
+
+
+#builds a Rig from the common command line options
+def openRig(args):
+    sim = None
+    if args.sim:
+        sim = {"seed": args.seed}
+        if args.sim_tilt is not None:
+            sim["pitch"], sim["roll"] = args.sim_tilt
+        if args.sim_rate is not None:
+            sim["rate"] = args.sim_rate
+        if args.sim_model is not None:
+            import SysId
+            sim["model"] = SysId.load(args.sim_model)
+        if args.sim_coupling is not None:
+            sim["coupling"] = args.sim_coupling
+        if args.sim_drift is not None:
+            sim["drift"] = args.sim_drift
+    model = None
+    if args.model is not None:
+        import SysId
+        model = SysId.load(args.model)
+    return Rig(settingsFile = args.settings, rigName = args.rig, levelName = args.level, port = args.port,
+               sim = sim, timeOut = args.timeout, record = args.record, history = args.history,
+               operator = args.operator, estimate = args.estimate, model = model, learnCoupling = args.learn_coupling,
+               continuous = args.continuous, maxAge = args.max_age, hardware = loadHardware(args.hardware),
+               precise = args.precise)
+
+
+def level(args):
+    rig = openRig(args)
+    try:
+        leveler = rig.leveler
+        leveler.addListener(writeEvent)
+
+        #Ctrl+C and SIGTERM act as the pause button
+        def pauseHandler(signum, frame):
+            rig.relays.setPause(True)
+        signal.signal(signal.SIGINT, pauseHandler)
+        signal.signal(signal.SIGTERM, pauseHandler)
+
+        if args.priority is not None:
+            rig.settings.setPriority(args.priority)
+
+        if args.zero == "here":
+            zeroP, zeroR = rig.saveZero()
+        else:
+            rig.setZero(*args.zero)
+            zeroP, zeroR = args.zero
+        writeEvent("zero", {"pitch": zeroP, "roll": zeroR})
+
+        outcome = leveler.autoLevel()
+        return EXIT_CODES[outcome]
+    finally:
+        rig.close()
+
+
+#keeps the rig level until interrupted, or compares Stay-On with and without drift nudges on the simulated rig
+def stay(args):
+    import StayOn
+
+    if args.bench:
+        sim = {}
+        if args.sim_rate is not None:
+            sim["rate"] = args.sim_rate
+        report = StayOn.bench(args.settings, args.rig, args.level, args.sim_drift or (0.0005, -0.0003),
+                              args.seconds or 3600, args.seed or 0, sim, args.timeout)
+        if args.json:
+            writeEvent("stay", report)
+        else:
+            print(StayOn.formatReport(report))
+        return EXIT_DONE
+
+    rig = openRig(args)
+    try:
+        rig.leveler.addListener(writeEvent)
+
+        #Ctrl+C and SIGTERM act as the pause button
+        def pauseHandler(signum, frame):
+            rig.relays.setPause(True)
+        signal.signal(signal.SIGINT, pauseHandler)
+        signal.signal(signal.SIGTERM, pauseHandler)
+
+        if args.zero == "here":
+            zeroP, zeroR = rig.saveZero()
+        else:
+            rig.setZero(*args.zero)
+            zeroP, zeroR = args.zero
+        writeEvent("zero", {"pitch": zeroP, "roll": zeroR})
+
+        rig.relays.setStayOn(True)
+        StayOn.StayOn(rig.leveler, predict = not args.no_predict).run(rig.relays, args.seconds)
+        rig.relays.setStayOn(False)
+        return EXIT_PAUSED if rig.relays.getPause() else EXIT_DONE
+    finally:
+        rig.close()
+
+
+#runs the control API until interrupted
+def serve(args):
+    from Control import RigWorker, ControlServer
+
+    rig = openRig(args)
+    acquisition = Acquisition(clock = rig.leveler.clock, idle = args.idle_period, idleAfter = args.idle_after,
+                              still = args.still)
+    worker = RigWorker(rig, acquisition = acquisition)
+    server = ControlServer(worker, path = args.socket, port = args.tcp)
+    worker.start()
+    try:
+        asyncio.run(server.serveForever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+        rig.close()
+    return EXIT_DONE
+
+
+#runs the control API for every station of a stations file until interrupted, or compares one simulated station with
+#several in one process, see MultiRig.py
+def multi(args):
+    import MultiRig
+    from Control import ControlServer
+
+    if args.bench is not None:
+        if args.rig is None or args.level is None:
+            raise ValueError("--bench needs --rig and --level")
+        report = MultiRig.bench(args.settings, args.rig, args.level, args.bench, args.seconds, args.tilt, args.seed,
+                                args.timeout)
+        if args.json:
+            writeEvent("multi", report)
+        else:
+            print(MultiRig.formatReport(report))
+        return EXIT_DONE
+
+    stations = MultiRig.MultiRig(MultiRig.loadStations(args.stations), args.settings, args.hardware,
+                                 timeOut = args.timeout, record = args.record, idle = args.idle_period,
+                                 idleAfter = args.idle_after, still = args.still)
+    if not stations.workers:
+        raise RuntimeError("no station could be opened")
+    server = ControlServer(stations, path = args.socket, port = args.tcp)
+    stations.start()
+    try:
+        asyncio.run(server.serveForever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stations.stop()
+    return EXIT_DONE
+
+
+#compares batched and one by one reading of redundant sensors on the simulated rig, see Sensor.py
+def sensors(args):
+    import Sensor
+
+    report = Sensor.bench(args.settings, args.rig, args.level, args.most, args.cycles, args.fault, args.seed)
+    if args.json:
+        writeEvent("sensors", report)
+    else:
+        print(Sensor.formatReport(report))
+    return EXIT_DONE
+
+
+#levels to and holds each setpoint of a sequence file in turn, or compares steps run one at a time with one sequence
+#on the simulated rig, see Sequence.py
+def sequence(args):
+    import Sequence
+
+    if args.bench:
+        if args.rig is None or args.level is None:
+            raise ValueError("--bench needs --rig and --level")
+        report = Sequence.bench(args.settings, args.rig, args.level, slew = args.slew or Sequence.BENCH_SLEW,
+                                runs = args.runs, seed = args.seed or 0, timeOut = args.timeout)
+        if args.json:
+            writeEvent("sequence", report)
+        else:
+            print(Sequence.formatReport(report))
+        return EXIT_DONE
+
+    if args.file is None:
+        raise ValueError("a sequence file is required")
+    steps = Sequence.loadSequence(args.file)
+    rig = openRig(args)
+    try:
+        rig.leveler.addListener(writeEvent)
+
+        #Ctrl+C and SIGTERM act as the pause button
+        def pauseHandler(signum, frame):
+            rig.relays.setPause(True)
+        signal.signal(signal.SIGINT, pauseHandler)
+        signal.signal(signal.SIGTERM, pauseHandler)
+
+        if args.priority is not None:
+            rig.settings.setPriority(args.priority)
+
+        outcome = Sequence.Sequence(rig.leveler, steps, slew = args.slew).run()
+        return EXIT_CODES[outcome]
+    finally:
+        rig.close()
+
+
+#parses a date or date and time into time.time() seconds
+def parseTime(text):
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date like 2023-06-01 or 2023-06-01T08:00, got {text!r}")
+
+
+#replays a recording through a preset, see Replay.py
+def replay(args):
+    import Replay
+
+    settings = Settings(args.settings)
+    settings.setSettings()
+    candidate = settings.getPreset(args.rig, args.level)
+    baseline = None
+    if args.baseline_rig is not None:
+        baselineSettings = Settings(args.baseline_settings or args.settings)
+        baselineSettings.setSettings()
+        baseline = baselineSettings.getPreset(args.baseline_rig, args.baseline_level or args.level)
+
+    report = Replay.replayDirectory(args.directory, candidate, baseline, args.since, args.until)
+    if args.json:
+        writeEvent("replay", report)
+    else:
+        print(Replay.formatReport(report, args.show))
+    return EXIT_DONE
+
+
+#parses --by, a comma separated list of SessionDB.GROUPS columns
+def parseGroups(text):
+    from SessionDB import GROUPS
+
+    groups = [group for group in text.split(",") if group]
+    for group in groups:
+        if group not in GROUPS:
+            raise argparse.ArgumentTypeError(f"expected columns from {', '.join(GROUPS)}, got {group!r}")
+    return groups
+
+
+#time to level report from the session database, see SessionDB.py
+def history(args):
+    import SessionDB
+
+    runs = SessionDB.query(args.database, since = args.since, until = args.until, rig = args.rig, level = args.level,
+                           operator = args.operator)
+    groups = SessionDB.report(runs, args.by)
+    if args.json:
+        writeEvent("history", {"groups": [dict(zip(args.by, key), **summary) for key, summary in groups]})
+    else:
+        print(SessionDB.formatReport(groups, args.by))
+    return EXIT_DONE
+
+
+#parses --params, a comma separated list of Optimizer.PARAMETERS
+def parseParameters(text):
+    from Optimizer import PARAMETERS
+
+    names = [name for name in text.split(",") if name]
+    for name in names:
+        if name not in PARAMETERS:
+            raise argparse.ArgumentTypeError(f"expected settings from {', '.join(PARAMETERS)}, got {name!r}")
+    return names
+
+
+#searches for a better preset on the simulated rig, see Optimizer.py
+def optimize(args):
+    import Optimizer
+
+    model = {}
+    for key, value in (("rate", args.sim_rate), ("deadTime", args.sim_dead_time), ("coast", args.sim_coast),
+                       ("backlash", args.sim_backlash)):
+        if value is not None:
+            model[key] = value
+    if args.sim_model is not None:
+        import SysId
+        model["model"] = SysId.load(args.sim_model)
+
+    optimizer = Optimizer.Optimizer(args.settings, args.rig, args.level, model = model, names = args.params,
+                                    runs = args.runs, tilt = args.tilt, seed = args.seed, timeOut = args.timeout,
+                                    maxOvershoots = args.max_overshoots, workers = args.workers)
+    report = optimizer.run(args.method, args.budget, args.grid_points)
+    if args.write is not None:
+        Optimizer.writeSettings(args.settings, args.write, report["row"])
+    if args.json:
+        writeEvent("optimize", report)
+    else:
+        print(Optimizer.formatReport(report))
+    return EXIT_DONE
+
+
+#fits the actuator model to a recording, see SysId.py
+def sysid(args):
+    import SysId
+
+    params = SysId.identifyDirectory(args.directory, args.rig, args.since, args.until)
+    if args.output is not None:
+        SysId.save(params, args.output)
+    if args.json:
+        writeEvent("sysid", params)
+    else:
+        print(SysId.formatParams(params))
+    return EXIT_DONE
+
+
+#sensor noise characterization of a rig standing still, see Noise.py
+def noise(args):
+    import Noise
+
+    if args.recording is not None:
+        import Recorder
+        data = Noise.fromRecording(Recorder.load(args.recording), args.since, args.until)
+        preset = None
+        if args.rig is not None:
+            settings = Settings(args.settings)
+            settings.setSettings()
+            preset = settings.getPreset(args.rig, args.level)
+    else:
+        rig = openRig(args)
+        try:
+            preset = rig.settings.getPreset(*rig.settings.getPresetName())
+            data = Noise.capture(rig, args.seconds)
+        finally:
+            rig.close()
+
+    report = Noise.characterize(data)
+    if args.json:
+        writeEvent("noise", report)
+    else:
+        print(Noise.formatReport(report, preset))
+    return EXIT_DONE
+
+
+#compares independent and decoupled leveling of a coupled simulated rig, see Coupling.py
+def coupling(args):
+    import Coupling
+
+    sim = {}
+    if args.sim_rate is not None:
+        sim["rate"] = args.sim_rate
+    if args.sim_model is not None:
+        import SysId
+        sim["model"] = SysId.load(args.sim_model)
+    report = Coupling.bench(args.settings, args.rig, args.level, args.sim_coupling, args.runs, args.tilt, args.seed,
+                            sim, args.timeout)
+    if args.json:
+        writeEvent("coupling", report)
+    else:
+        print(Coupling.formatReport(report))
+    return EXIT_DONE
+
+
+#compares XL pulses with continuous drive from large tilts on the simulated rig, see Drive.py
+def drive(args):
+    import Drive
+
+    sim = {}
+    if args.sim_rate is not None:
+        sim["rate"] = args.sim_rate
+    if args.sim_model is not None:
+        import SysId
+        sim["model"] = SysId.load(args.sim_model)
+    report = Drive.bench(args.settings, args.rig, args.level, args.runs, args.tilts, args.seed, sim, args.timeout)
+    if args.json:
+        writeEvent("drive", report)
+    else:
+        print(Drive.formatReport(report))
+    return EXIT_DONE
+
+
+#compares sleep and precise relay pulses under load, see Timing.py
+def timing(args):
+    import Timing
+
+    report = Timing.bench(args.pulses, args.load)
+    if args.json:
+        writeEvent("timing", report)
+    else:
+        print(Timing.formatReport(report))
+    return EXIT_DONE
+
+
+#compares the polled pause with the E-stop button on fake relays, see Buttons.py
+def buttons(args):
+    import Buttons
+
+    report = Buttons.bench(args.presses, seed = args.seed)
+    if args.json:
+        writeEvent("buttons", report)
+    else:
+        print(Buttons.formatReport(report))
+    return EXIT_DONE
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog = "autoleveler", description = "Headless auto leveler")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    loggingParent = argparse.ArgumentParser(add_help = False)
+    loggingParent.add_argument("--log-level", default = "INFO", choices = ["DEBUG", "INFO", "WARNING", "ERROR"],
+                               help = "lowest log level written to stderr (default: %(default)s)")
+    loggingParent.add_argument("--log-file", help = "also write JSON log lines to this rotating file")
+
+    common = argparse.ArgumentParser(add_help = False, parents = [loggingParent])
+    common.add_argument("--settings", default = SETTINGS_FILE, help = "settings file (default: %(default)s)")
+    common.add_argument("--rig", help = "rig name in settings file, e.g. Midload")
+    common.add_argument("--level", help = "level name in settings file, e.g. T-Level")
+    common.add_argument("--hardware", default = HARDWARE_FILE, metavar = "FILE",
+                        help = "relay and ADC backends (default: %(default)s, see Backends.py)")
+    common.add_argument("--port", help = "ADC serial port, replaces the one in --hardware")
+    common.add_argument("--sim", action = "store_true", help = "use the simulated rig instead of the hardware")
+    common.add_argument("--sim-tilt", type = parsePair, help = "simulated starting pitch,roll in minutes")
+    common.add_argument("--sim-rate", type = float, help = "simulated actuator rate in minutes/second")
+    common.add_argument("--sim-model", metavar = "FILE", help = "simulate the actuators fitted by sysid")
+    common.add_argument("--sim-coupling", type = parseCoupling, metavar = "P2R,R2P",
+                        help = "simulated roll movement per minute of pitch movement and pitch per minute of roll")
+    common.add_argument("--sim-drift", type = parsePair, help = "simulated drift of pitch,roll in minutes/second")
+    common.add_argument("--seed", type = int, help = "simulator random seed")
+    common.add_argument("--record", metavar = "DIR", help = "record telemetry to ring files in DIR (see Recorder.py)")
+    common.add_argument("--timeout", type = float, default = TIME_OUT,
+                        help = "seconds before leveling gives up (default: %(default)s)")
+    common.add_argument("--estimate", action = "store_true", help = "level on Kalman filter estimates (see Estimator.py)")
+    common.add_argument("--model", metavar = "FILE", help = "actuator model fitted by sysid, used by --estimate")
+    common.add_argument("--history", metavar = "DB", help = "add a summary of each run to this database (see SessionDB.py)")
+    common.add_argument("--operator", default = getpass.getuser(), help = "operator name in --history (default: %(default)s)")
+    common.add_argument("--learn-coupling", action = "store_true",
+                        help = "update the preset's axis coupling in the settings file after each run (see Coupling.py)")
+    common.add_argument("--continuous", action = "store_true",
+                        help = "drive large errors in one move instead of XL pulses (see Drive.py)")
+    common.add_argument("--precise", action = "store_true",
+                        help = "finish relay pulses with a short spin for accurate on times (see Timing.py)")
+    common.add_argument("--max-age", type = float, default = MAX_AGE,
+                        help = "seconds a reading is reused between pulses, 0 reads every time (default: %(default)s)")
+
+    levelParser = commands.add_parser("level", parents = [common], help = "level the rig once")
+    levelParser.add_argument("--zero", type = parseZero, default = "here",
+                             help = "zero point as pitch,roll in minutes or 'here' to average the current position")
+    levelParser.add_argument("--priority", choices = ["pitch", "roll"], help = "axis leveled first")
+    levelParser.set_defaults(func = level)
+
+    stayParser = commands.add_parser("stay", parents = [common], help = "keep the rig level (Stay-On)")
+    stayParser.add_argument("--zero", type = parseZero, default = "here",
+                            help = "'here' (default) or pitch,roll zero point in minutes")
+    stayParser.add_argument("--seconds", type = float, help = "stop after this many seconds")
+    stayParser.add_argument("--no-predict", action = "store_true",
+                            help = "only level past the threshold, no drift nudges")
+    stayParser.add_argument("--bench", action = "store_true",
+                            help = "compare with and without drift nudges on the simulated rig (default drift 0.0005,-0.0003)")
+    stayParser.add_argument("--json", action = "store_true", help = "write the --bench report as one JSON line")
+    stayParser.set_defaults(func = stay)
+
+    serveParser = commands.add_parser("serve", parents = [common], help = "run the local control API")
+    serveParser.add_argument("--socket", default = "/tmp/autoleveler.sock", help = "Unix socket path (default: %(default)s)")
+    serveParser.add_argument("--tcp", type = int, metavar = "PORT", help = "listen on localhost TCP port instead")
+    serveParser.add_argument("--idle-period", type = float, default = IDLE,
+                             help = "seconds between readings while the rig is quiet (default: %(default)s)")
+    serveParser.add_argument("--idle-after", type = float, default = IDLE_AFTER,
+                             help = "seconds without movement or commands before sampling slows down (default: %(default)s)")
+    serveParser.add_argument("--still", type = float, default = STILL,
+                             help = "movement in minutes that counts as motion (default: %(default)s)")
+    serveParser.set_defaults(func = serve)
+
+    multiParser = commands.add_parser("multi", parents = [loggingParent], help = "run the control API for several rigs")
+    multiParser.add_argument("stations", nargs = "?", default = "stations.json",
+                             help = "stations file (default: %(default)s, see MultiRig.py)")
+    multiParser.add_argument("--settings", default = SETTINGS_FILE, help = "settings file (default: %(default)s)")
+    multiParser.add_argument("--hardware", default = HARDWARE_FILE, metavar = "FILE",
+                             help = "backends of stations without their own (default: %(default)s)")
+    multiParser.add_argument("--socket", default = "/tmp/autoleveler.sock", help = "Unix socket path (default: %(default)s)")
+    multiParser.add_argument("--tcp", type = int, metavar = "PORT", help = "listen on localhost TCP port instead")
+    multiParser.add_argument("--record", metavar = "DIR", help = "record each station's telemetry to DIR/<station>")
+    multiParser.add_argument("--timeout", type = float, default = TIME_OUT,
+                             help = "seconds before leveling gives up (default: %(default)s)")
+    multiParser.add_argument("--idle-period", type = float, default = IDLE,
+                             help = "seconds between readings while a station is quiet (default: %(default)s)")
+    multiParser.add_argument("--idle-after", type = float, default = IDLE_AFTER,
+                             help = "seconds without movement or commands before sampling slows down (default: %(default)s)")
+    multiParser.add_argument("--still", type = float, default = STILL,
+                             help = "movement in minutes that counts as motion (default: %(default)s)")
+    multiParser.add_argument("--bench", type = int, metavar = "N",
+                             help = "compare one simulated station with N in one process instead")
+    multiParser.add_argument("--rig", help = "rig name of the --bench stations")
+    multiParser.add_argument("--level", help = "level name of the --bench stations")
+    multiParser.add_argument("--seconds", type = float, default = 10,
+                             help = "idle sampling time of --bench (default: %(default)s)")
+    multiParser.add_argument("--tilt", type = float, default = 0.2,
+                             help = "largest --bench starting tilt in minutes (default: %(default)s)")
+    multiParser.add_argument("--seed", type = int, default = 0, help = "--bench random seed (default: %(default)s)")
+    multiParser.add_argument("--json", action = "store_true", help = "write the --bench report as one JSON line")
+    multiParser.set_defaults(func = multi)
+
+    sensorsParser = commands.add_parser("sensors", parents = [loggingParent],
+                                        help = "benchmark redundant sensors on the simulated rig")
+    sensorsParser.add_argument("--settings", default = SETTINGS_FILE, help = "settings file (default: %(default)s)")
+    sensorsParser.add_argument("--rig", required = True, help = "rig name in settings file")
+    sensorsParser.add_argument("--level", required = True, help = "level name in settings file")
+    sensorsParser.add_argument("--most", type = int, default = 4, help = "most sensors per axis (default: %(default)s)")
+    sensorsParser.add_argument("--cycles", type = int, default = 200, help = "reading pairs per case (default: %(default)s)")
+    sensorsParser.add_argument("--fault", type = float, default = 0.05,
+                               help = "error in minutes of the sensor that goes bad (default: %(default)s)")
+    sensorsParser.add_argument("--seed", type = int, default = 0, help = "simulator random seed (default: %(default)s)")
+    sensorsParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    sensorsParser.set_defaults(func = sensors)
+
+    sequenceParser = commands.add_parser("sequence", parents = [common], help = "level to a list of setpoints in turn")
+    sequenceParser.add_argument("file", nargs = "?", help = "JSON or CSV sequence file (see Sequence.py)")
+    sequenceParser.add_argument("--slew", type = float,
+                                help = "ramp between setpoints at this many minutes/second (default: jump)")
+    sequenceParser.add_argument("--priority", choices = ["pitch", "roll"], help = "axis leveled first")
+    sequenceParser.add_argument("--bench", action = "store_true",
+                                help = "compare steps run one at a time with one sequence on the simulated rig")
+    sequenceParser.add_argument("--runs", type = int, default = 3, help = "--bench runs per case (default: %(default)s)")
+    sequenceParser.add_argument("--json", action = "store_true", help = "write the --bench report as one JSON line")
+    sequenceParser.set_defaults(func = sequence)
+
+    replayParser = commands.add_parser("replay", parents = [loggingParent], help = "replay a recording through a preset")
+    replayParser.add_argument("directory", help = "recording directory (see --record)")
+    replayParser.add_argument("--settings", default = SETTINGS_FILE, help = "settings file of the candidate preset")
+    replayParser.add_argument("--rig", required = True, help = "candidate rig name")
+    replayParser.add_argument("--level", required = True, help = "candidate level name")
+    replayParser.add_argument("--baseline-settings", help = "compare against a preset from this file")
+    replayParser.add_argument("--baseline-rig", help = "compare against this rig's preset instead of the recorded pulses")
+    replayParser.add_argument("--baseline-level", help = "level of the baseline preset (default: --level)")
+    replayParser.add_argument("--since", type = parseTime, help = "first date to replay")
+    replayParser.add_argument("--until", type = parseTime, help = "date to stop replaying")
+    replayParser.add_argument("--show", type = int, default = 20, help = "changes to list (default: %(default)s)")
+    replayParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    replayParser.set_defaults(func = replay)
+
+    historyParser = commands.add_parser("history", parents = [loggingParent], help = "time to level report from --history")
+    historyParser.add_argument("database", help = "session database (see --history)")
+    historyParser.add_argument("--rig", help = "only runs on this rig")
+    historyParser.add_argument("--level", help = "only runs with this level")
+    historyParser.add_argument("--operator", help = "only runs by this operator")
+    historyParser.add_argument("--since", type = parseTime, help = "first date to report")
+    historyParser.add_argument("--until", type = parseTime, help = "date to stop reporting")
+    historyParser.add_argument("--by", type = parseGroups, default = [], help = "group by columns, e.g. rig,level")
+    historyParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    historyParser.set_defaults(func = history)
+
+    optimizeParser = commands.add_parser("optimize", parents = [loggingParent],
+                                         help = "search for a better preset on the simulated rig")
+    optimizeParser.add_argument("--settings", default = SETTINGS_FILE, help = "settings file (default: %(default)s)")
+    optimizeParser.add_argument("--rig", required = True, help = "rig name in settings file")
+    optimizeParser.add_argument("--level", required = True, help = "level name in settings file")
+    optimizeParser.add_argument("--method", choices = ["grid", "random", "bayes"], default = "bayes",
+                                help = "search method (default: %(default)s)")
+    optimizeParser.add_argument("--params", type = parseParameters, default = None,
+                                help = "comma separated settings to search (default: all pulse, delay and diff settings)")
+    optimizeParser.add_argument("--budget", type = int, default = 100,
+                                help = "candidates for random and bayes, and the most grid may try (default: %(default)s)")
+    optimizeParser.add_argument("--grid-points", type = int, default = 3,
+                                help = "values per setting for grid, grid-points ** settings must be within --budget, "
+                                       "so grid needs a short --params list (default: %(default)s)")
+    optimizeParser.add_argument("--runs", type = int, default = 20,
+                                help = "simulated runs per candidate (default: %(default)s)")
+    optimizeParser.add_argument("--tilt", type = float, default = 1.0,
+                                help = "largest starting tilt in minutes (default: %(default)s)")
+    optimizeParser.add_argument("--seed", type = int, default = 0,
+                                help = "scenario and search seed (default: %(default)s)")
+    optimizeParser.add_argument("--sim-rate", type = float, help = "simulated actuator rate in minutes/second")
+    optimizeParser.add_argument("--sim-dead-time", type = float, help = "simulated actuator dead time in seconds")
+    optimizeParser.add_argument("--sim-coast", type = float, help = "simulated actuator coast time constant in seconds")
+    optimizeParser.add_argument("--sim-backlash", type = float, help = "simulated backlash in seconds of relay on time")
+    optimizeParser.add_argument("--sim-model", metavar = "FILE", help = "simulate the actuators fitted by sysid")
+    optimizeParser.add_argument("--max-overshoots", type = float, default = 2,
+                                help = "95th percentile of overshoots per run allowed (default: %(default)s)")
+    optimizeParser.add_argument("--timeout", type = float, default = TIME_OUT,
+                                help = "seconds before a run times out (default: %(default)s)")
+    optimizeParser.add_argument("--workers", type = int, help = "worker processes (default: one per CPU)")
+    optimizeParser.add_argument("--write", metavar = "FILE",
+                                help = "write a copy of the settings file with the candidate preset")
+    optimizeParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    optimizeParser.set_defaults(func = optimize)
+
+    sysidParser = commands.add_parser("sysid", parents = [loggingParent], help = "fit the actuator model to a recording")
+    sysidParser.add_argument("directory", help = "recording directory (see --record)")
+    sysidParser.add_argument("--rig", help = "rig name saved with the parameters")
+    sysidParser.add_argument("--since", type = parseTime, help = "first date to use")
+    sysidParser.add_argument("--until", type = parseTime, help = "date to stop using")
+    sysidParser.add_argument("--output", metavar = "FILE", help = "save the parameters as JSON for --sim-model")
+    sysidParser.add_argument("--json", action = "store_true", help = "write the parameters as one JSON line")
+    sysidParser.set_defaults(func = sysid)
+
+    noiseParser = commands.add_parser("noise", parents = [common], help = "characterize sensor noise with the rig still")
+    noiseParser.add_argument("--seconds", type = float, default = 60, help = "capture time (default: %(default)s)")
+    noiseParser.add_argument("--recording", metavar = "DIR", help = "use the samples of a recording instead of the rig")
+    noiseParser.add_argument("--since", type = parseTime, help = "start of a still period in the recording")
+    noiseParser.add_argument("--until", type = parseTime, help = "end of the still period in the recording")
+    noiseParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    noiseParser.set_defaults(func = noise)
+
+    couplingParser = commands.add_parser("coupling", parents = [loggingParent],
+                                         help = "benchmark decoupled leveling on the simulated rig")
+    couplingParser.add_argument("--settings", default = SETTINGS_FILE, help = "settings file (default: %(default)s)")
+    couplingParser.add_argument("--rig", required = True, help = "rig name in settings file")
+    couplingParser.add_argument("--level", required = True, help = "level name in settings file")
+    couplingParser.add_argument("--sim-coupling", type = parseCoupling, default = "0.3,-0.2", metavar = "P2R,R2P",
+                                help = "simulated coupling (default: %(default)s)")
+    couplingParser.add_argument("--runs", type = int, default = 20, help = "simulated runs per case (default: %(default)s)")
+    couplingParser.add_argument("--tilt", type = float, default = 0.3,
+                                help = "largest starting tilt in minutes (default: %(default)s)")
+    couplingParser.add_argument("--seed", type = int, default = 0, help = "random seed (default: %(default)s)")
+    couplingParser.add_argument("--sim-rate", type = float, help = "simulated actuator rate in minutes/second")
+    couplingParser.add_argument("--sim-model", metavar = "FILE", help = "simulate the actuators fitted by sysid")
+    couplingParser.add_argument("--timeout", type = float, default = TIME_OUT,
+                                help = "seconds before a simulated run times out (default: %(default)s)")
+    couplingParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    couplingParser.set_defaults(func = coupling)
+
+    driveParser = commands.add_parser("drive", parents = [loggingParent],
+                                      help = "benchmark continuous drive on the simulated rig")
+    driveParser.add_argument("--settings", default = SETTINGS_FILE, help = "settings file (default: %(default)s)")
+    driveParser.add_argument("--rig", required = True, help = "rig name in settings file")
+    driveParser.add_argument("--level", required = True, help = "level name in settings file")
+    driveParser.add_argument("--runs", type = int, default = 20, help = "simulated runs per case (default: %(default)s)")
+    driveParser.add_argument("--tilts", type = parsePair, default = "1.2,2.5", metavar = "MIN,MAX",
+                             help = "range of the starting tilts in minutes (default: %(default)s)")
+    driveParser.add_argument("--seed", type = int, default = 0, help = "random seed (default: %(default)s)")
+    driveParser.add_argument("--sim-rate", type = float, help = "simulated actuator rate in minutes/second")
+    driveParser.add_argument("--sim-model", metavar = "FILE", help = "simulate the actuators fitted by sysid")
+    driveParser.add_argument("--timeout", type = float, default = 3 * TIME_OUT,
+                             help = "seconds before a simulated run times out (default: %(default)s)")
+    driveParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    driveParser.set_defaults(func = drive)
+
+    timingParser = commands.add_parser("timing", parents = [loggingParent],
+                                       help = "benchmark relay pulse timing on fake relays")
+    timingParser.add_argument("--pulses", type = int, default = 200, help = "pulses per mode (default: %(default)s)")
+    timingParser.add_argument("--load", type = int, default = 0,
+                              help = "busy processes running during the benchmark (default: %(default)s)")
+    timingParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    timingParser.set_defaults(func = timing)
+
+    buttonsParser = commands.add_parser("buttons", parents = [loggingParent],
+                                        help = "benchmark the E-stop button on fake relays")
+    buttonsParser.add_argument("--presses", type = int, default = 40, help = "presses per mode (default: %(default)s)")
+    buttonsParser.add_argument("--seed", type = int, default = 0, help = "random seed (default: %(default)s)")
+    buttonsParser.add_argument("--json", action = "store_true", help = "write the report as one JSON line")
+    buttonsParser.set_defaults(func = buttons)
+
+    args = parser.parse_args(argv)
+    if args.command in ("level", "serve", "noise", "stay", "sequence") and (args.rig is None) != (args.level is None):
+        parser.error("--rig and --level must be given together")
+
+    setupLogging(level = args.log_level, file = args.log_file)
+
+    try:
+        return args.func(args)
+    except (IOError, ValueError, RuntimeError) as e:
+        writeEvent("error", {"message": str(e)})
+        return EXIT_ERROR
+
+
+if __name__ == "__main__":
+    sys.exit(main())
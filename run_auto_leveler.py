@@ -4,9 +4,18 @@
 
 # AutoLevel Project:
 # run_auto_leveler.py
+# autoleveler.py
+# Leveler.py
+# Rig.py
 # Relays.py
 # Sensor.py
 # Settings.py
+# Simulator.py
+# StayOn.py
+# Acquisition.py
+# Backends.py
+# Buttons.py
+# hardware.json
 # settings.csv
 
 
@@ -48,6 +57,8 @@
 # Settings are saved to the settings.csv file which should always be in the same directory as this file.
 #
 # This file uses the functions defined in Sensor.py, Relays.py, and Settings.py to perform the main autoleveling functions.
+# The autoLevel() and adapt() functions themselves are defined in Leveler.py so they can also be run without the GUI
+# (see autoleveler.py). The GUI follows their progress through showEvent().
 
 
 # Status: Functional
@@ -60,6 +71,7 @@
 # Autoleveling could be made faster by triggering overlapping pitch and roll pulses so that they could both be leveled at the same time.
 #
 # Relay pulses can not be interupted via software since a pulse is implemented by calling .sleep() for a set time
+# by the Pause button. An E-stop button wired to a GPIO pin (see Buttons.py) does cut them short.
 
 
 
@@ -67,9 +79,15 @@
 from Sensor import *
 from Relays import *
 from Settings import *
-
-#used for communication with sensors
-import serial
+from Leveler import *
+from Rig import *
+from Backends import HARDWARE_FILE, loadHardware, openADC, openRelayOutput
+from Recorder import Recorder
+from SessionDB import SessionDB, HISTORY_DB
+from StayOn import StayOn
+from Buttons import Buttons, BUTTONS
+from Acquisition import Acquisition
+from Logs import setupLogging
 
 #gui packages
 import tkinter as tk
@@ -88,8 +106,8 @@ import numpy as np
 import csv
 
 import time
-
-SETTINGS_FILE = "settings.csv"
+#operator name for the session history
+import getpass
 
 PITCH_RAW = [36112, 32564, 31163, 30462, 29730, 27540, 23575]
 PITCH_MNTS = [7, 3, 1, 0, -1, -3.5, -8]
@@ -97,18 +115,15 @@ PITCH_MNTS = [7, 3, 1, 0, -1, -3.5, -8]
 ROLL_RAW = [37064, 34036, 32642, 31910, 31251, 29702, 26029]
 ROLL_MNTS = [7, 3, 1, 0, -1, -3, -7]
 
-#GPIO PINS - BCM
-LEFT_PIN = 16
-RIGHT_PIN = 12
-UP_PIN = 20
-DOWN_PIN = 21
-
-#program halts if autoleveling takes longer than:
-TIME_OUT = 90  #seconds
 #display color refreshes every:
 COLOR_REFRESH = 150 #ms
 #program calls new reading every:
 READING_REFRESH = 0.06 #ms
+#while the rig is quiet readings slow down to one pair every IDLE_REFRESH seconds after IDLE_AFTER seconds without
+#movement of more than STILL minutes, leveling or clicks, see Acquisition.py
+IDLE_REFRESH = 1.0
+IDLE_AFTER = 30.0
+STILL = 0.005
 #readings displayed with given number of decimals:
 OUTPUT_FORMAT = '%.2f'
 #GUI Page dimensions:
@@ -116,13 +131,10 @@ WINDOW_SIZE = "1918x1014"
 
 RANGE = 20000
 
-#Serial connection settings:
-PORT = "/dev/ttyAMA0" 
-BAUDRATE = 9600
-BYTESIZE = serial.EIGHTBITS
-PARITY = serial.PARITY_NONE
-STOPBITS = serial.STOPBITS_ONE
-TIMEOUT = 1
+#telemetry ring files, see Recorder.py
+RECORD_DIR = "recordings"
+#rotating JSON log, see Logs.py
+LOG_FILE = "autoleveler.log"
 
 # GUI helper functions - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -280,6 +292,7 @@ def stayOn():
             display.configure(text = "")
             #change color of button to original color
             stayOnButton.configure(highlightbackground = '#d9d9d9')
+            stayOnMonitor.stop()
             #refresh GUI
             tab1.update()
         else:
@@ -289,8 +302,9 @@ def stayOn():
                 relays.setStayOn(True)
                 #Change button color to green
                 stayOnButton.configure(highlightbackground = 'green')
-                #begin loop
-                stayOnLoop()
+                #subscribe monitor to the readings of the main loop
+                stayOnMonitor.start()
+                display.configure(text = "Waiting...")
                 #refresh GUI
                 tab1.update()
     else:
@@ -300,35 +314,29 @@ def stayOn():
             smallDisplay["text"] = "Zero not taken"
         stayOnButton.configure(highlightbackground = '#d9d9d9')
         relays.setStayOn(False)
+        stayOnMonitor.stop()
         tab1.update()
 
-#gets reading from sensors and updates GUI        
+#gets reading from sensors, GUI is updated by showEvent()
 def getReading(sensor):
-    reading = sensor.read()
-    if sensor.getName() == "pitch":
-        yData.configure(text = OUTPUT_FORMAT%reading)
-        yDiff.configure(text = OUTPUT_FORMAT%(reading - sensor.getZero()))
-    else:
-        xData.configure(text = OUTPUT_FORMAT%reading)
-        xDiff.configure(text = OUTPUT_FORMAT%(reading - sensor.getZero()))
-    
-    #refresh GUI
-    tab1.update()
-    return reading
+    return leveler.getReading(sensor)
 
-#loops continuously and calls autolevel function if difference > threshold
-def stayOnLoop():
-    display.configure(text = "Waiting...")
-    while relays.getStayOn():
-        getReading(pitch)
-        getReading(roll)
-        time.sleep(READING_REFRESH)
-        if abs(pitch.getDifference()) > settings.getSetting("threshold") or abs(roll.getDifference()) > settings.getSetting("threshold"):
-            autoLevel()
-        if relays.getPause():
-            stayOn()
-            display.configure(text = "")
-            break
+#called by the main loop, shows a pause engaged by the E-stop button (see Buttons.py)
+def showPause():
+    if relays.getPause() and pauseButton.cget("highlightbackground") != 'red':
+        pauseButton.configure(highlightbackground = 'red')
+        display["text"] = "Paused.."
+
+#called by the main loop after each reading, nudges against drift and calls autolevel function if difference >
+#threshold, see StayOn.py
+def stayOnCheck():
+    if not relays.getStayOn():
+        return
+    if relays.getPause():
+        stayOn()
+        display.configure(text = "")
+        return
+    stayOnMonitor.act()
 
 #updates color based off of difference, updates every 150 ms      
 def displayColor():
@@ -359,277 +367,34 @@ def displayColor():
 
     tab1.after(COLOR_REFRESH, displayColor)
 
-#Allows for variable movement response given distance from zero point. Also allows for uniqe delays for each type of movement
-#input requires actuator to be moved, current reading from sensors, and axis to be moved
-def adapt(reading, axis):
-
-    directions = relays.getDirections()
-
-    #calc difference between zero point and current reading
-    if axis == "roll":
-        difference = reading - roll.getZero()
-        if difference > 0:
-            act = directions["right"]  #right
+#updates GUI with progress reported by the leveling engine, see Leveler.py
+def showEvent(event, data):
+    if event == "reading":
+        reading = data["value"]
+        if data["axis"] == "pitch":
+            yData.configure(text = OUTPUT_FORMAT%reading)
+            yDiff.configure(text = OUTPUT_FORMAT%data["difference"])
         else:
-            act = directions["left"]  #left
-        print(f'reading!: {reading}  zero:{roll.getZero()}')
-    else:
-        difference = reading - pitch.getZero()
-        if difference > 0:
-            act = directions["up"]  #up
-        else:
-            act = directions["down"]  #down
-        print(f'reading!: {reading}  zero:{pitch.getZero()}')
-    print(f'DIFF!: {difference}  act{act}  axis: {axis}')
-    
-    difference = abs(difference)
-    
-    #Extra long pulse    
-    if difference > settings.getSetting("xLDiff"):
-        #move actuator for pulse length
-        relays.moveAct(act, settings.getSetting("xLPulse"))
-        #delay for given delay
-        time.sleep(settings.getSetting("xLDelay"))
-        #update display
-        smallDisplay2['text'] = "Pulse: XL"
-        print("\t Pulse: XL")
-        
-    #Long pulse
-    elif difference <= settings.getSetting("xLDiff") and difference > settings.getSetting("lDiff"):
-        relays.moveAct(act, settings.getSetting("lPulse"))
-        time.sleep(settings.getSetting("lDelay"))
-        smallDisplay2['text'] = "Pulse: L"
-        print("\t Pulse: L")
-        
-    #Medium pulse
-    elif difference <= settings.getSetting("lDiff") and difference > settings.getSetting("mDiff"):
-        relays.moveAct(act, settings.getSetting("mPulse"))
-        time.sleep(settings.getSetting("mDelay"))
-        smallDisplay2['text'] = "Pulse: M"
-        print("\t Pulse: M")
-        
-    #Small pulse
-    elif difference <= settings.getSetting("mDiff") and difference > settings.getSetting("sDiff"):
-        relays.moveAct(act, settings.getSetting("sPulse"))
-        time.sleep(settings.getSetting("sDelay"))
-        smallDisplay2['text'] = "Pulse: S"
-        print("\t Pulse: S")
-        
-    #Extra small pulse     FIXME::::::::::::
-    elif difference <= settings.getSetting("sDiff"):
-        relays.moveAct(act, settings.getSetting("xSPulse"))
-        time.sleep(settings.getSetting("xSDelay"))
-        smallDisplay2['text'] = "Pulse: XS"
-        print("\t Pulse: XS")
-    else:
-        print("ADAPT ERROR")
-    
-    #update GUI
+            xData.configure(text = OUTPUT_FORMAT%reading)
+            xDiff.configure(text = OUTPUT_FORMAT%data["difference"])
+    elif event == "status":
+        display['text'] = data["text"]
+    elif event == "move":
+        smallDisplay["text"] = data["text"]
+    elif event == "pulse":
+        smallDisplay2['text'] = "Pulse: " + data["bucket"]
+    elif event == "finish":
+        smallDisplay["text"] = "Time elapsed: {}".format(round(data["elapsed"], 2))
+        smallDisplay2['text'] = ""
+        if data["outcome"] == DONE and relays.getStayOn():
+            display.configure(text = "Waiting...")
+
+    #refresh GUI
     tab1.update()
 
-#performs autoleveling function when called
+#performs autoleveling function when called, returns DONE, TIMEOUT or PAUSED
 def autoLevel():
-    printSettings()
-    #do not run if zero point is still equal to (0,0) or if eStop is engaged
-    if(not relays.getPause()):
-
-        #set display
-        display['text'] = 'Leveling...'
-        #save start time
-        start = time.time()
-        print("\n------------Leveling------------")
-        
-        zeroRoll = roll.getZero()
-        zeroPitch = pitch.getZero()
-        sens1 = settings.getSetting("sens1")
-        sens2 = settings.getSetting("sens2")
-
-        if settings.getPriority() == "roll":
-            first = roll
-            second = pitch
-            zeroFirst = zeroRoll
-            zeroSecond = zeroPitch
-            firstAxis = "roll"
-            secondAxis = "pitch"
-            firstPos = "Roll Right"
-            firstNeg = "Roll Left"
-            firstClose = "--Roll Close--"
-            secondPos = "Pitch Up"
-            secondNeg = "Pitch Down"
-            secondClose = "--Roll Close--"
-        else:
-            first = pitch
-            second = roll
-            zeroFirst = zeroPitch
-            zeroSecond = zeroRoll
-            firstAxis = "pitch"
-            secondAxis = "roll"
-            firstPos = "--Pitch Up--"
-            firstNeg = "--Pitch Down--"
-            firstClose = "--Pitch Close--"
-            secondPos = "--Roll Right--"
-            secondNeg = "--Roll Left--"
-            secondClose = "--Roll Close--"
-
-        r = getReading(roll)
-        p = getReading(pitch)
-        
-        #while current reading is not within sensitivity setting 1 continue to loop
-        while not ((r < zeroRoll+sens1 
-                and r > zeroRoll-sens1 
-                and p < zeroPitch+sens1 
-                and p > zeroPitch-sens1) 
-                or relays.getPause()):
-            
-            #If FIRST is not within sens2 
-            f = getReading(first)
-            if not(f < zeroFirst+sens2 and f > zeroFirst-sens2):
-                #loop until Ax is within sens2 or eStop is engaged
-                while not((f < zeroFirst+sens2 and f > zeroFirst-sens2) or relays.getPause()):
-                    #udpate Ax and Ay
-                    f = getReading(first)
-
-                    #print data for terminal output
-                    print("\n______________________________________________________________")
-                    print(roll)
-                    print(pitch)
-
-                    #if reading is greater than zero+sens2 move right using adapt() function
-                    if(f >= zeroFirst+sens2):
-                        print(firstPos)
-                        smallDisplay["text"] = firstPos
-                        tab1.update()
-                        adapt(f, firstAxis)
-                    
-                    #if reading is less than zero-sens2 move left
-                    elif(f <= zeroFirst-sens2):
-                        print(firstNeg)
-                        smallDisplay["text"] = firstNeg
-                        tab1.update()
-                        adapt(f, firstAxis)
-
-                    #else X is close, do nothing     
-                    else:
-                        print(firstClose)
-                        smallDisplay["text"] = firstClose
-                        tab1.update()
-
-            #same process for Y
-            #If Y is not within sens2 adjust until within sens2
-            s = getReading(second)
-            if not(s < zeroSecond+sens2 and s > zeroSecond-sens2):
-                while not ((s < zeroSecond+sens2 and s > zeroSecond-sens2) or relays.getPause()):
-                    s = getReading(second)
-
-                    print("\n______________________________________________________________")
-                    print(roll)
-                    print(pitch)
-
-                    if(s >= zeroSecond+sens2):
-                        print(secondPos)
-                        smallDisplay["text"] = secondPos
-                        tab1.update()
-                        adapt(s, secondAxis)
-
-                                
-                    elif(s <= zeroSecond-sens2):
-                        print(secondNeg)
-                        print(f'Z-{first.getZero()} read - {s}')
-                        smallDisplay["text"] = secondNeg
-                        tab1.update()
-                        adapt(s, secondAxis)
-                                
-                    else:   
-                        print(secondClose)
-                        smallDisplay["text"] = secondClose
-                        tab1.update()
-
-            #after getting X and Y within sens2, the program will bypass the above 2 while loops and attempt to get rig within sens1
-            if not relays.getPause():            
-                r = getReading(roll)
-                p = getReading(pitch)
-                
-                #terminal output
-                print("\n______________________________________________________________")
-                print(roll)
-                print(pitch)
-            
-                #if X is greater than zero+sens1 move right
-                if(r >= zeroRoll+sens1):
-                    print("  --Roll right--")
-                    smallDisplay["text"] = "--Roll right--"
-                    tab1.update()
-                    adapt(r, "roll")
-
-                #if X is less than zero-sens1 move left     
-                elif(r <= zeroRoll-sens1):
-                    print("  --Roll left--")
-                    smallDisplay["text"] =  "--Roll left--"
-                    tab1.update()
-                    adapt(r, "roll")
-
-                #else X is good do nothing            
-                else:
-                    print("  --Roll good--")
-                    smallDisplay["text"] =  "--Roll good--"
-                    tab1.update()
-
-                #if Y is greater than zero+sens1 move up
-                if(p >= zeroPitch+sens1):
-                    print("  --Pitch up--")
-                    smallDisplay["text"] =  "--Pitch up--"
-                    tab1.update()
-                    adapt(p, "pitch")
-
-                #if Y is less than zero-sens1 move down                
-                elif(p <= zeroPitch-sens1):
-                    print("  --Pitch down--")
-                    smallDisplay["text"] =  "--Pitch down--"
-                    tab1.update()
-                    adapt(p, "pitch")
-
-                #else Y is good, do nothing                
-                else:
-                    print("  --Pitch good--")
-                    smallDisplay["text"] = "--Pitch good--"
-                    tab1.update()
-
-                #check time elapsed, if elapsed time exceeds 90 seconds quit
-                end = time.time()
-                if end - start > 90:
-                    display['text'] = 'Time Out'
-                    smallDisplay["text"] = "Time elapsed: {}".format(round(end-start, 2))
-                    smallDisplay2['text'] = ""
-                    return False
-
-        # *** END OUTER WHILE LOOP ***
-        #while loop exits here only if Ax and Ay are within sens1, eStop has been engaged, or 90 seconds has elapsed. If none of these happen
-        # the while loop will continue to loop from the beginning. Each if statement will be checked again meaning X or Y may be changed even if 
-        #they were level at one point. It is also possible that the program may reenter the initial while loops that adjust X and Y within sens2.
-
-        #if eStop has been engaged set necessary displays
-        if relays.getPause():
-            display['text'] = 'Paused..'
-            end = time.time()
-            smallDisplay["text"] = "Time elapsed: {}".format(round(end-start, 2))
-            smallDisplay2['text'] = ""
-
-        #else eStop has not been engaged, set necessary displays
-        else:
-            end = time.time()
-            smallDisplay["text"] = "Time elapsed: {}".format(round(end-start, 2))
-            display.configure(text = 'Done')
-            smallDisplay2['text'] = ""
-            if relays.getStayOn():
-                display.configure(text = "Waiting...")
-            if display.cget("text") == 'Paused..':
-                display['text'] = ""
-            #playsound('Sounds/ding.mp3')
-            return True
-    
-    #executes if pause was set before level button was pressed or if zero is still equal to (0,0)
-    else:
-        smallDisplay["text"] = "Zero not taken"
+    return leveler.autoLevel()
 
 #executes when Set Zero is clicked, averages 5 points
 def saveZeros():
@@ -708,27 +473,6 @@ def plot(title, coefficients, x,y, label, frame):
     #canvas.get_tk_widget().pack()
   
 
-#not needed
-#verify settings are set correctly
-def printSettings():
-    print(settings.getSetting("sens1"))
-    print(settings.getSetting("sens2"))
-    print(settings.getSetting("xLDiff"))
-    print(settings.getSetting("lDiff"))
-    print(settings.getSetting("mDiff"))
-    print(settings.getSetting("sDiff"))
-    print(settings.getSetting("xLPulse"))
-    print(settings.getSetting("lPulse"))
-    print(settings.getSetting("mPulse"))
-    print(settings.getSetting("sPulse"))
-    print(settings.getSetting("xSPulse"))
-
-    print(settings.getSetting("xLDelay"))
-    print(settings.getSetting("lDelay"))
-    print(settings.getSetting("mDelay"))
-    print(settings.getSetting("sDelay"))
-    print(settings.getSetting("xSDelay"))
-
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -739,6 +483,9 @@ def printSettings():
 
 #if __name__ == "__main__":
 
+#log to terminal and LOG_FILE from a background thread
+setupLogging(file = LOG_FILE)
+
 #uses Tkinter package
 root = Tk()
 root.title("Auto Leveler")
@@ -758,20 +505,12 @@ tabs.add(tab2, text ='Settings')
 tabs.add(tab3, text ='Sensor Setup')
 tabs.pack(expand = 1, fill ="both")
 
+#relay and ADC backends, see Backends.py
+hardware = loadHardware(HARDWARE_FILE)
+
 #initialize ADC
 try:
-    ADC = serial.Serial(port = PORT, 
-                        baudrate = BAUDRATE,
-                        bytesize=BYTESIZE,
-                        parity = PARITY,
-                        stopbits=STOPBITS,
-                        timeout = TIMEOUT)
-    
-    if(ADC.isOpen() == False):
-        print("Serial Port Error")
-        GPIO.cleanup()
-        exit()
-    
+    ADC = openADC(hardware["adc"])
 except IOError as e:
     print(e)
 
@@ -779,7 +518,8 @@ except IOError as e:
 settings = Settings(SETTINGS_FILE)
 
 #initalize relays
-relays = Relays(LEFT_PIN, RIGHT_PIN, UP_PIN, DOWN_PIN)
+relays = Relays(*hardware["relays"].get("pins", (LEFT_PIN, RIGHT_PIN, UP_PIN, DOWN_PIN)),
+                gpio = openRelayOutput(hardware["relays"]))
 
 
 
@@ -1102,8 +842,37 @@ save.grid(row = 7, column = 8, columnspan = 2, pady = 10)
 # RUN PROGRAM - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 #initalize sensors
-pitch = Sensor("pitch", ADC, pitchRaw, pitchCalc, settings.getSetting("data"), settings.getSetting("order"))
-roll = Sensor("roll", ADC, rollRaw, rollCalc, settings.getSetting("data"), settings.getSetting("order"))
+#an axis with redundant sensors in hardware.json is read through a SensorArray (see Sensor.py)
+pitch = withRedundant(Sensor("pitch", ADC, pitchRaw, pitchCalc, settings.getSetting("data"), settings.getSetting("order")),
+                      hardware["sensors"])
+roll = withRedundant(Sensor("roll", ADC, rollRaw, rollCalc, settings.getSetting("data"), settings.getSetting("order")),
+                     hardware["sensors"])
+
+#initialize leveling engine
+leveler = Leveler(pitch, roll, relays, settings)
+leveler.addListener(showEvent)
+
+#record readings and pulses
+recorder = Recorder(RECORD_DIR)
+leveler.addListener(recorder.listener(time))
+
+#keep a summary of every leveling run
+history = SessionDB(HISTORY_DB)
+leveler.addListener(history.listener(settings, time, getpass.getuser()))
+
+#Stay-On monitor, subscribed to the readings while Stay On is set
+stayOnMonitor = StayOn(leveler, refresh = READING_REFRESH)
+
+#samples slowly while the rig is quiet, any click or key press speeds sampling up again
+acquisition = Acquisition(fast = READING_REFRESH, idle = IDLE_REFRESH, idleAfter = IDLE_AFTER, still = STILL)
+leveler.addListener(acquisition.listener)
+root.bind_all("<ButtonPress>", lambda event: acquisition.wake("gui"), add = "+")
+root.bind_all("<KeyPress>", lambda event: acquisition.wake("gui"), add = "+")
+
+#E-stop and jog buttons on spare GPIO pins, if hardware.json gives them pins
+buttons = None
+if any(hardware["buttons"].get(name) is not None for name in BUTTONS):
+    buttons = Buttons(relays, hardware["buttons"], settings, leveler)
 
 plot("Pitch", pitch.getCoefficients(), pitchRaw, pitchCalc, "Pitch", frame_pitch)
 plot("Roll", roll.getCoefficients(), rollRaw, rollCalc, "Roll", frame_roll)
@@ -1116,7 +885,9 @@ try:
     while True:
         getReading(pitch)
         getReading(roll)
-        time.sleep(READING_REFRESH)
+        stayOnCheck()
+        showPause()
+        acquisition.wait(tab1.update)
     #never reached
     root.mainloop()
 
@@ -1129,8 +900,12 @@ except KeyboardInterrupt:
     
 finally:
     print("Program end")
+    if buttons is not None:
+        buttons.close()
+    recorder.close()
+    history.close()
     ADC.close()
-    GPIO.cleanup()
+    relays.cleanup()
     exit()
     
 
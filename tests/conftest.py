@@ -0,0 +1,19 @@
+# conftest.py
+# Shared fixtures for the tests. The modules of the project are flat files in the directory above this one.
+
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+#copy of settings.csv, tests may change the last used preset or the priority
+@pytest.fixture
+def settingsFile(tmp_path):
+    path = tmp_path / "settings.csv"
+    shutil.copy(os.path.join(ROOT, "settings.csv"), path)
+    return str(path)
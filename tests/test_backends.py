@@ -0,0 +1,137 @@
+# test_backends.py
+# The hardware configuration, the fake relay backend on the simulated rig and the TCP serial bridge ADC.
+
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from Backends import (DEFAULT_HARDWARE, FakeGPIO, TcpADC, loadHardware, openADC, openRelayOutput)
+from Rig import Rig
+from Simulator import SimClock
+
+
+@pytest.fixture
+def hardwareFile(tmp_path):
+    def write(config):
+        path = tmp_path / "hardware.json"
+        path.write_text(json.dumps(config))
+        return str(path)
+    return write
+
+
+def test_defaults_without_a_file(tmp_path):
+    assert loadHardware(None) == DEFAULT_HARDWARE
+    assert loadHardware(str(tmp_path / "missing.json")) == DEFAULT_HARDWARE
+
+
+def test_file_is_merged_over_defaults(hardwareFile):
+    hardware = loadHardware(hardwareFile({"relays": {"backend": "fake"}, "adc": {"transport": "tcp", "tcpPort": 5000}}))
+    assert hardware["relays"] == {"backend": "fake", "chip": DEFAULT_HARDWARE["relays"]["chip"]}
+    assert hardware["adc"]["transport"] == "tcp"
+    assert hardware["adc"]["tcpPort"] == 5000
+    assert hardware["adc"]["host"] == DEFAULT_HARDWARE["adc"]["host"]
+    assert hardware["buttons"] == {}
+    #the defaults themselves are not changed
+    assert DEFAULT_HARDWARE["adc"]["transport"] == "serial"
+
+
+def test_unknown_backend_and_transport_are_rejected(hardwareFile):
+    with pytest.raises(ValueError, match = "relay backend"):
+        loadHardware(hardwareFile({"relays": {"backend": "pigpio"}}))
+    with pytest.raises(ValueError, match = "ADC transport"):
+        loadHardware(hardwareFile({"adc": {"transport": "usb"}}))
+
+
+def test_fake_relays_time_pulses_on_the_sim_clock(hardwareFile, settingsFile):
+    hardware = loadHardware(hardwareFile({"relays": {"backend": "fake"}, "adc": {"transport": "sim"}}))
+    rig = Rig(settingsFile, "Midload", "T-Level", clock = SimClock(), hardware = hardware, sim = {"seed": 0})
+    try:
+        gpio = rig.relays.GPIO
+        assert isinstance(gpio, FakeGPIO)
+        directions = rig.relays.getDirections()
+        before = rig.sim.getAngle("pitch")
+        requested = [("up", 0.18), ("down", 0.5), ("left", 1.5), ("right", 0.009)]
+        for direction, pulse in requested:
+            rig.relays.moveAct(directions[direction], pulse)
+        assert [pin for pin, on, off in gpio.pulses()] == [directions[direction] for direction, pulse in requested]
+        assert gpio.durations() == pytest.approx([pulse for direction, pulse in requested], abs = 1e-6)
+        assert gpio.durations(directions["left"]) == pytest.approx([1.5], abs = 1e-6)
+        #the fake backend also drove the simulated actuators
+        assert rig.sim.getAngle("pitch") != before
+    finally:
+        rig.close()
+
+
+def test_fake_relays_without_a_rig():
+    gpio = openRelayOutput({"backend": "fake"})
+    gpio.setup(16, gpio.OUT, initial = gpio.HIGH)
+    gpio.output(16, gpio.LOW)
+    time.sleep(0.01)
+    gpio.output(16, gpio.HIGH)
+    gpio.output(16, gpio.LOW)
+    #a pulse still on is left out
+    assert len(gpio.pulses()) == 1
+    assert 0.01 <= gpio.durations()[0] < 0.5
+    gpio.clear()
+    assert gpio.pulses() == []
+
+
+#serial bridge on a local port answering every channel byte with a code like the ADC
+@pytest.fixture
+def bridge():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    received = []
+
+    def serve():
+        connection, address = server.accept()
+        with connection:
+            while True:
+                data = connection.recv(16)
+                if not data:
+                    break
+                for byte in data:
+                    received.append(bytes([byte]))
+                    connection.sendall(b"%d\r" % (1000 + byte))
+
+    thread = threading.Thread(target = serve, daemon = True)
+    thread.start()
+    yield server.getsockname()[1], received
+    server.close()
+    thread.join(5)
+
+
+def test_tcp_adc_reads_replies(bridge):
+    port, received = bridge
+    adc = openADC({"transport": "tcp", "host": "127.0.0.1", "tcpPort": port})
+    try:
+        assert isinstance(adc, TcpADC)
+        assert adc.inWaiting() == 0
+        adc.write(b"y")
+        deadline = time.time() + 5
+        while adc.inWaiting() < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        assert adc.inWaiting() == 5
+        assert adc.read(5) == b"1121\r"
+        assert adc.inWaiting() == 0
+
+        #read() waits for bytes that have not arrived yet
+        adc.write(b"xy")
+        assert adc.read(10) == b"1120\r1121\r"
+        assert received == [b"y", b"x", b"y"]
+    finally:
+        adc.close()
+    assert not adc.isOpen()
+
+
+def test_tcp_adc_read_times_out(bridge):
+    port, received = bridge
+    adc = TcpADC("127.0.0.1", port, timeout = 0.05)
+    try:
+        assert adc.read(1) == b""
+    finally:
+        adc.close()
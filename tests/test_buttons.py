@@ -0,0 +1,141 @@
+# test_buttons.py
+# The E-stop and jog buttons on fake relays: bounce on the stop pin, jogs only while the button is held and never
+# while leveling or paused, and a stop that cancels a pending jog so no relay comes back on.
+
+import time
+
+import pytest
+
+from Backends import FakeGPIO
+from Buttons import Buttons
+from Relays import Relays
+from Settings import Settings
+from Simulator import SimClock
+
+LEFT, RIGHT, UP, DOWN = 16, 12, 20, 21
+STOP_PIN = 26
+UP_PIN = 5
+DEBOUNCE = 0.02
+
+
+@pytest.fixture
+def settings(settingsFile):
+    settings = Settings(settingsFile)
+    settings.setSettings()
+    settings.usePreset("Midload", "T-Level")
+    return settings
+
+
+#relays and buttons on a FakeGPIO, debounce replaces DEBOUNCE
+@pytest.fixture
+def board(settings):
+    made = []
+
+    def make(debounce=DEBOUNCE):
+        gpio = FakeGPIO()
+        relays = Relays(LEFT, RIGHT, UP, DOWN, gpio = gpio, clock = SimClock())
+        buttons = Buttons(relays, {"stop": STOP_PIN, "up": UP_PIN, "debounce": debounce}, settings = settings)
+        made.append(buttons)
+        return gpio, relays, buttons
+
+    yield make
+    for buttons in made:
+        buttons.close()
+
+
+#waits until condition() is true, returns its last value
+def waitFor(condition, seconds=2.0):
+    deadline = time.monotonic() + seconds
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+#relay pins turned on after event index start
+def turnedOn(gpio, start=0):
+    return [pin for t, pin, level in gpio.events[start:] if level == gpio.LOW]
+
+
+def test_stop_turns_relays_off_and_ignores_bounce(board):
+    gpio, relays, buttons = board(debounce = 1.0)
+    assert relays.energize(UP)
+    gpio.press(STOP_PIN)
+    assert relays.isHalted()
+    assert relays.getPause()
+    assert all(gpio.levels[pin] == gpio.HIGH for pin in (LEFT, RIGHT, UP, DOWN))
+    #contact bounce turns the relays off again but is not another stop
+    for _ in range(3):
+        gpio.unpress(STOP_PIN)
+        gpio.press(STOP_PIN)
+    assert buttons.getLatency()["stops"] == 1
+    assert relays.isHalted()
+
+    #no relay turns on until the pause is removed
+    stopped = len(gpio.events)
+    assert not relays.energize(DOWN)
+    relays.moveUp(0.1)
+    assert turnedOn(gpio, stopped) == []
+    relays.setPause(False)
+    assert not relays.isHalted()
+    assert relays.energize(DOWN)
+
+
+def test_held_jog_pulses_one_relay(board, settings):
+    gpio, relays, buttons = board()
+    gpio.press(UP_PIN)
+    assert waitFor(lambda: gpio.pulses())
+    gpio.unpress(UP_PIN)
+    [(pin, on, off)] = gpio.pulses()
+    assert pin == relays.getDirections()["up"]
+    assert (off - on) / 1e9 == pytest.approx(settings.getSetting("xSPulse"), abs = 0.1)
+    assert turnedOn(gpio) == [pin]
+
+
+def test_released_jog_does_not_move(board):
+    gpio, relays, buttons = board()
+    gpio.press(UP_PIN)
+    gpio.unpress(UP_PIN)
+    time.sleep(DEBOUNCE * 5)
+    assert gpio.events == []
+
+
+def test_jog_refused_while_leveling_or_paused(board):
+    gpio, relays, buttons = board()
+    buttons.listener("start", {})
+    gpio.press(UP_PIN)
+    time.sleep(DEBOUNCE * 5)
+    gpio.unpress(UP_PIN)
+    assert gpio.events == []
+
+    buttons.listener("finish", {})
+    relays.setPause(True)
+    gpio.press(UP_PIN)
+    time.sleep(DEBOUNCE * 5)
+    gpio.unpress(UP_PIN)
+    assert gpio.events == []
+
+
+def test_stop_cancels_jog_under_way(board, settings):
+    gpio, relays, buttons = board()
+    up = relays.getDirections()["up"]
+    gpio.press(UP_PIN)
+    assert waitFor(lambda: gpio.levels[up] == gpio.LOW)
+    gpio.press(STOP_PIN)
+    stopped = len(gpio.events)
+    assert gpio.levels[up] == gpio.HIGH
+    assert buttons.jogging is None
+    #past the end of the jog, its release timer was cancelled and nothing turns on again
+    time.sleep(settings.getSetting("xSPulse") + DEBOUNCE * 5)
+    assert turnedOn(gpio, stopped) == []
+    assert relays.isHalted()
+
+
+def test_stop_cancels_jog_waiting_out_the_debounce(board):
+    gpio, relays, buttons = board(debounce = 0.2)
+    gpio.press(UP_PIN)
+    gpio.press(STOP_PIN)
+    #the pause is removed and the jog button is still held when its debounce ends, only a cancelled jog stays off
+    relays.setPause(False)
+    time.sleep(0.4)
+    gpio.unpress(UP_PIN)
+    assert turnedOn(gpio) == []
@@ -0,0 +1,146 @@
+# test_control.py
+# Drives ControlServer over a Unix socket with ControlClient, against a RigWorker on the simulated rig.
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from Control import ControlServer, RigWorker, Subscriber, LEVELING
+from ControlClient import ControlClient, ControlError, main as clientMain
+from Leveler import DONE
+from Rig import Rig
+from Simulator import SimClock
+
+
+#runs a ControlServer on its own event loop thread, the worker is started by the test when it needs it
+@pytest.fixture
+def served(tmp_path, settingsFile):
+    rig = Rig(settingsFile, "Midload", "T-Level", clock = SimClock(),
+              sim = {"pitch": 0.05, "roll": -0.05, "seed": 0})
+    worker = RigWorker(rig)
+    path = str(tmp_path / "control.sock")
+    server = ControlServer(worker, path = path)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target = loop.run_forever, daemon = True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+    yield rig, worker, server, path
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    if worker.running:
+        worker.stop()
+    rig.close()
+
+
+def connect(path):
+    return ControlClient(path, timeout = 10)
+
+
+#reads pushed events until one named event arrives, returns the events read
+def readUntil(client, event):
+    events = []
+    while True:
+        message = client.receive()
+        if "event" in message:
+            events.append(message)
+            if message["event"] == event:
+                return events
+
+
+def test_status(served):
+    rig, worker, server, path = served
+    worker.start()
+    with connect(path) as client:
+        status = client.status()
+    assert status["rig"] == "Midload"
+    assert status["level"] == "T-Level"
+    assert status["paused"] is False
+    assert status["state"] in ("idle", LEVELING)
+
+
+def test_level_wait(served):
+    rig, worker, server, path = served
+    worker.start()
+    with connect(path) as client:
+        client.setZero(0.0, 0.0)
+        assert client.level(wait = True) == DONE
+        assert client.status()["lastOutcome"] == DONE
+    assert abs(rig.sim.getAngle("pitch")) < rig.settings.getSetting("sens1") * 2
+    assert abs(rig.sim.getAngle("roll")) < rig.settings.getSetting("sens1") * 2
+
+
+def test_pause_resume(served):
+    rig, worker, server, path = served
+    worker.start()
+    with connect(path) as client:
+        client.pause()
+        assert client.status()["paused"] is True
+        with pytest.raises(ControlError, match = "paused"):
+            client.level()
+        client.resume()
+        assert client.status()["paused"] is False
+        assert client.level(wait = True) == DONE
+
+
+def test_zero(served):
+    rig, worker, server, path = served
+    worker.start()
+    with connect(path) as client:
+        reply = client.setZero(0.5, -0.25)
+        assert (reply["pitch"], reply["roll"]) == (0.5, -0.25)
+        assert client.status()["zero"] == {"pitch": 0.5, "roll": -0.25}
+
+
+def test_zero_needs_both_values():
+    with pytest.raises(SystemExit):
+        clientMain(["zero", "0.5"])
+
+
+def test_busy_before_worker_dequeues(served):
+    rig, worker, server, path = served
+    #the worker thread is not running yet, so the first level stays queued and the state stays idle
+    with connect(path) as client:
+        assert client.call("level") == {}
+        for cmd, args in (("level", {}), ("zero", {"pitch": 0, "roll": 0}),
+                          ("preset", {"rig": "Midload", "level": "T-Level"}),
+                          ("sequence", {"steps": [{"pitch": 0, "roll": 0}]})):
+            with pytest.raises(ControlError, match = "busy leveling"):
+                client.call(cmd, **args)
+        worker.start()
+        deadline = time.time() + 30
+        while worker.isBusy() and time.time() < deadline:
+            time.sleep(0.05)
+        assert not worker.isBusy()
+        assert client.status()["lastOutcome"] is not None
+        client.setZero(0.0, 0.0)
+
+
+def test_subscribe_fan_out(served):
+    rig, worker, server, path = served
+    worker.start()
+    with connect(path) as first, connect(path) as second, connect(path) as control:
+        first.call("subscribe")
+        second.call("subscribe")
+        control.setZero(0.0, 0.0)
+        assert control.level(wait = True) == DONE
+        for client in (first, second):
+            events = readUntil(client, "finish")
+            names = [event["event"] for event in events]
+            assert "start" in names
+            assert "reading" in names
+            assert events[-1]["outcome"] == DONE
+
+
+def test_slow_subscriber_drops_oldest():
+    async def fill():
+        subscriber = Subscriber(writer = None, size = 3)
+        for i in range(5):
+            subscriber.push(f"{i}\n".encode())
+        return subscriber, [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+
+    subscriber, lines = asyncio.run(fill())
+    assert subscriber.dropped == 2
+    assert lines == [b"2\n", b"3\n", b"4\n"]
@@ -0,0 +1,30 @@
+# test_filters.py
+# The median filter against the median of the last n readings worked out from scratch.
+
+import random
+
+import pytest
+
+from Filters import MedianFilter, parseChain
+
+
+@pytest.mark.parametrize("n", [1, 3, 5, 25])
+def test_median_matches_sorted_window(n):
+    rng = random.Random(n)
+    median = MedianFilter(n)
+    readings = []
+    for i in range(500):
+        #repeated values check that the right copy leaves the window
+        value = rng.choice([rng.gauss(0, 1), 0.5, -0.25])
+        readings.append(value)
+        window = sorted(readings[-n:])
+        assert median.update(value) == window[len(window) // 2]
+        if i == 250:
+            median.reset()
+            readings = []
+
+
+def test_chain_passes_no_signal_through():
+    chain = parseChain("median3 mean2")
+    assert chain.update(None) is None
+    assert chain.update(1.0) == 1.0
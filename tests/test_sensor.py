@@ -0,0 +1,66 @@
+# test_sensor.py
+# Replies of a batched SensorArray sweep are only used when every sensor answered.
+
+import pytest
+
+from Sensor import Sensor, SensorArray
+from Simulator import SimClock
+
+#raw calibration, a code of 1000 + 100 * minutes
+RAW = [0, 1000, 2000, 3000, 4000, 5000, 6000]
+MINUTES = [(code - 1000) / 100 for code in RAW]
+
+
+#ADC answering each channel byte written with the code of that channel, silent channels never answer
+class FakeADC:
+    def __init__(self, codes, silent=()):
+        self.codes = codes
+        self.silent = set(silent)
+        self.buffer = b""
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+        for byte in data:
+            channel = bytes([byte])
+            if channel not in self.silent:
+                self.buffer += b"%d\r" % self.codes[channel]
+
+    def read(self, size=1):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+
+def makeArray(adc, channels):
+    clock = SimClock()
+    sensors = [Sensor("pitch", adc, RAW, MINUTES, False, 1, clock = clock, channel = channel) for channel in channels]
+    return SensorArray(sensors, clock = clock)
+
+
+def test_full_sweep_is_one_query():
+    adc = FakeADC({b"y": 1050, b"a": 1060, b"b": 1040})
+    array = makeArray(adc, [b"y", b"a", b"b"])
+    assert array.sweep() == pytest.approx([0.5, 0.6, 0.4])
+    assert adc.writes == [b"yab"]
+
+
+@pytest.mark.parametrize("silent", [b"y", b"a", b"b"])
+def test_short_sweep_is_read_channel_by_channel(silent):
+    codes = {b"y": 1050, b"a": 1060, b"b": 1040}
+    adc = FakeADC(codes, silent = [silent])
+    array = makeArray(adc, [b"y", b"a", b"b"])
+    expected = {b"y": 0.5, b"a": 0.6, b"b": 0.4}
+
+    values = array.sweep()
+    for channel, value in zip((b"y", b"a", b"b"), values):
+        if channel == silent:
+            assert value is None
+        else:
+            assert value == pytest.approx(expected[channel])
+    assert adc.writes == [b"yab", b"y", b"a", b"b"]
+
+    array.read()
+    assert [entry["silent"] for entry in array.getHealth()] == [int(channel == silent) for channel in (b"y", b"a", b"b")]
@@ -0,0 +1,50 @@
+# test_sequence.py
+# Setpoint sequences on the simulated rig.
+
+from Leveler import DONE, PAUSED
+from Rig import Rig
+from Sequence import Sequence
+from Simulator import SimClock
+
+
+def makeRig(settingsFile):
+    rig = Rig(settingsFile, "Midload", "T-Level", clock = SimClock(), sim = {"seed": 0})
+    rig.setZero(0.05, -0.05)
+    return rig
+
+
+def test_steps_reach_setpoints_and_zero_is_restored(settingsFile):
+    rig = makeRig(settingsFile)
+    try:
+        reached = []
+        rig.leveler.addListener(lambda event, data: reached.append(
+            (rig.sim.getAngle("pitch"), rig.sim.getAngle("roll"))) if event == "stepDone" else None)
+        steps = [{"pitch": 0.2, "roll": -0.1, "dwell": 5}, {"pitch": 0.0, "roll": 0.1, "slew": 0.01}]
+        sequence = Sequence(rig.leveler, steps)
+        assert sequence.run() == DONE
+        assert [result["outcome"] for result in sequence.results] == [DONE, DONE]
+        assert sequence.results[1]["rampRms"] is not None
+        band = 2 * rig.settings.getSetting("sens1")
+        for (pitch, roll), step in zip(reached, steps):
+            assert abs(pitch - step["pitch"]) < band
+            assert abs(roll - step["roll"]) < band
+        assert (rig.pitch.getZero(), rig.roll.getZero()) == (0.05, -0.05)
+    finally:
+        rig.close()
+
+
+def test_zero_is_restored_after_a_pause(settingsFile):
+    rig = makeRig(settingsFile)
+    try:
+        #pause part way along the ramp
+        def onEvent(event, data):
+            if event == "pulse":
+                rig.relays.setPause(True)
+
+        rig.leveler.addListener(onEvent)
+        sequence = Sequence(rig.leveler, [{"pitch": 0.3, "roll": 0.0, "slew": 0.01}, {"pitch": 0.0, "roll": 0.0}])
+        assert sequence.run() == PAUSED
+        assert len(sequence.results) == 1
+        assert (rig.pitch.getZero(), rig.roll.getZero()) == (0.05, -0.05)
+    finally:
+        rig.close()